@@ -0,0 +1,238 @@
+"""
+Headless HTTP API, driving the same `BotBackend` sessions as the web UI without Gradio. Responses are streamed as
+Server-Sent Events.
+
+    POST   /sessions                      create a session, {"model": "GPT-4", "rollback_policy": "always"} optional
+    GET    /sessions                      list the sessions
+    DELETE /sessions/{id}                 close a session and shut down its kernel
+    POST   /sessions/{id}/files           upload files (multipart/form-data)
+    POST   /sessions/{id}/messages        send {"content": "..."}, the response is streamed as events
+    POST   /sessions/{id}/interrupt       stop generating or interrupt the running code
+
+Events: text, function_call, code, code_finished, output, execution_finished, tool_result, kernel_suspended, error and
+done.
+"""
+import argparse
+import asyncio
+import json
+import shutil
+import uuid
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from response_parser import *
+
+SSE_HEADERS = {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+class APISession:
+    def __init__(self, session_id, bot_backend_future):
+        self.session_id = session_id
+        self.bot_backend_future = bot_backend_future  # the kernel starts in the background
+        self.history = []
+        self.busy = False
+        self.turn = None  # future of the running turn
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    async def get_bot_backend(self) -> BotBackend:
+        return await self.bot_backend_future
+
+    def info(self):
+        return {
+            'session_id': self.session_id,
+            'ready': self.bot_backend_future.done(),
+            'busy': self.busy,
+            'created_at': self.created_at,
+            'last_used': self.last_used
+        }
+
+
+class APIServer:
+    """
+    Owns the sessions. Blocking work (kernel start, chat completion requests, code execution) runs in a thread pool,
+    the event loop only streams events.
+    """
+
+    def __init__(self, max_workers=64):
+        self.sessions: Dict[str, APISession] = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='api-session')
+
+    def run_blocking(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def get_session(self, request) -> APISession:
+        session = self.sessions.get(request.match_info['session_id'])
+        if session is None:
+            raise web.HTTPNotFound(text='Unknown session')
+        session.last_used = time.time()
+        return session
+
+    @staticmethod
+    def create_bot_backend(model_choice, rollback_policy):
+        bot_backend = BotBackend()
+        if model_choice:
+            bot_backend.update_gpt_model_choice(model_choice)
+        if rollback_policy is not None:
+            bot_backend.jupyter_kernel.set_rollback_policy(rollback_policy)
+        return bot_backend
+
+    async def create_session(self, request):
+        body = await request.json() if request.can_read_body else {}
+        model_choice = body.get('model')
+        if model_choice is not None and model_choice not in config['model']:
+            raise web.HTTPBadRequest(text=f'Unknown model: {model_choice}')
+        # which failed or successful code cells are rolled back, with the "cell_rollback" config
+        rollback_policy = body.get('rollback_policy')
+        if rollback_policy is not None and rollback_policy not in ROLLBACK_POLICIES:
+            raise web.HTTPBadRequest(text=f'Unknown rollback policy: {rollback_policy}')
+        session_id = uuid.uuid4().hex
+        self.sessions[session_id] = APISession(
+            session_id, self.run_blocking(self.create_bot_backend, model_choice, rollback_policy)
+        )
+        return web.json_response({'session_id': session_id}, status=201)
+
+    async def list_sessions(self, request):
+        return web.json_response([session.info() for session in self.sessions.values()])
+
+    async def delete_session(self, request):
+        session = self.get_session(request)
+        del self.sessions[session.session_id]
+        try:
+            bot_backend = await session.get_bot_backend()
+        except Exception:
+            return web.Response(status=204)
+        if session.busy:
+            bot_backend.stop_response()
+        if session.turn is not None:
+            # a running turn could otherwise restart the kernel after it is shut down
+            await session.turn
+        await self.run_blocking(bot_backend.jupyter_kernel.shutdown)
+        return web.Response(status=204)
+
+    async def upload_files(self, request):
+        session = self.get_session(request)
+        bot_backend = await session.get_bot_backend()
+        if session.busy:
+            raise web.HTTPConflict(text='A response is being generated')
+        filenames = []
+        reader = await request.multipart()
+        while (field := await reader.next()) is not None:
+            if not field.filename:
+                continue
+            # the upload is written next to the content store, so that it can be linked into it
+            filename = os.path.basename(field.filename)
+            upload_dir = f'cache/upload_{uuid.uuid4().hex}'
+            os.makedirs(upload_dir)
+            path = os.path.join(upload_dir, filename)
+            try:
+                with open(path, 'wb') as f:
+                    while chunk := await field.read_chunk():
+                        f.write(chunk)
+                bot_msg = [f'📁[{filename}]', None]
+                session.history.append(bot_msg)
+                await self.run_blocking(functools.partial(bot_backend.add_file_message, path=path, bot_msg=bot_msg))
+            finally:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+            filenames.append(filename)
+        return web.json_response({'files': filenames})
+
+    async def send_message(self, request):
+        session = self.get_session(request)
+        body = await request.json()
+        if not isinstance(body.get('content'), str):
+            raise web.HTTPBadRequest(text='"content" must be a string')
+        bot_backend = await session.get_bot_backend()
+        if session.busy:
+            raise web.HTTPConflict(text='A response is being generated')
+        session.busy = True
+        try:
+            response = web.StreamResponse(headers=SSE_HEADERS)
+            await response.prepare(request)
+            await self.stream_response(session, bot_backend, body['content'], response)
+            return response
+        finally:
+            session.busy = False
+
+    async def stream_response(self, session: APISession, bot_backend: BotBackend, content: str, response):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def hook(event, data):
+            loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+        def run_turn():
+            start_time = time.time()
+            bot_backend.add_text_message(user_text=content)
+            session.history.append([content, None])
+            try:
+                for _ in stream_bot_response(bot_backend=bot_backend, history=session.history):
+                    pass
+            except Exception as e:
+                hook('error', {'message': f'{type(e).__name__}: {e}'})
+            finally:
+                bot_backend.metrics.observe('lci_turn_seconds', time.time() - start_time)
+                hook('done', {
+                    'context_window_tokens': bot_backend.context_window_tokens,
+                    'sliced': bot_backend.sliced
+                })
+
+        bot_backend.add_event_hook(hook)
+        turn = session.turn = self.run_blocking(run_turn)
+        try:
+            while True:
+                event, data = await events.get()
+                await response.write(f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'.encode())
+                if event == 'done':
+                    break
+        except ConnectionResetError:
+            # the client went away, the turn is stopped like from the stop button of the web UI
+            bot_backend.stop_response()
+        finally:
+            await turn
+            session.turn = None
+            bot_backend.remove_event_hook(hook)
+
+    async def interrupt(self, request):
+        session = self.get_session(request)
+        if session.busy:
+            bot_backend = await session.get_bot_backend()
+            bot_backend.stop_response()
+        return web.json_response({'interrupted': session.busy})
+
+    async def close(self, app):
+        for session in list(self.sessions.values()):
+            if session.bot_backend_future.done() and not session.bot_backend_future.exception():
+                session.bot_backend_future.result().jupyter_kernel.shutdown()
+        self.sessions.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_app(max_workers=64):
+    server = APIServer(max_workers=max_workers)
+    app = web.Application(client_max_size=1024 ** 3)
+    app.add_routes([
+        web.post('/sessions', server.create_session),
+        web.get('/sessions', server.list_sessions),
+        web.delete('/sessions/{session_id}', server.delete_session),
+        web.post('/sessions/{session_id}/files', server.upload_files),
+        web.post('/sessions/{session_id}/messages', server.send_message),
+        web.post('/sessions/{session_id}/interrupt', server.interrupt),
+    ])
+    app.on_cleanup.append(server.close)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=64, help='threads running responses and code executions')
+    args = parser.parse_args()
+
+    if not os.path.exists('cache'):
+        os.mkdir('cache')
+    if config.get('metrics_port'):
+        from metrics import start_metrics_server
+        start_metrics_server(config['metrics_port'])
+    web.run_app(create_app(max_workers=args.workers), host=args.host, port=args.port)
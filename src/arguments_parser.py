@@ -0,0 +1,187 @@
+import re
+
+JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+STRING_SPECIAL_CHARS = re.compile(r'[\\"\n]')
+
+
+def collapse_pieces(pieces):
+    """
+    Join `pieces` into a single piece in place, so that the next join only copies the text added since then.
+    :return: the joined text
+    """
+    if len(pieces) > 1:
+        pieces[:] = [''.join(pieces)]
+    return pieces[0] if pieces else ''
+
+
+class CodeArgumentsParser:
+    """
+    Incremental parser for the streamed arguments of `execute_code`, e.g. '{"code": "print(1)"}'.
+    Each call of `feed` only processes the new delta, the decoded code string is available through `code` at any time.
+
+    Like `parse_json`, it tolerates the non-standard JSON that GPT may generate: raw newlines and unescaped quotes in
+    the string value. A quote only ends the string when it is followed by '}' and nothing else. When the value
+    contains raw newlines, the raw text of the value is returned instead of the decoded one, as `parse_json` does.
+    """
+
+    def __init__(self):
+        self.state = 'begin'
+        self.decoded_pieces = []
+        self.raw_pieces = []
+        self.raw_newline = False
+        self.pending = ''  # escape sequence or possible end of string, waiting for more characters
+        self.high_surrogate = None
+        self._code = None
+
+    def feed(self, delta: str):
+        index = 0
+        while index < len(delta):
+            index = getattr(self, f'_parse_{self.state}')(delta, index)
+        self._code = None
+
+    def _parse_begin(self, delta, index):
+        position = delta.find('{', index)
+        if position == -1:
+            return len(delta)
+        self.state = 'key'
+        return position + 1
+
+    def _parse_key(self, delta, index):
+        position = delta.find('"', index)
+        if position == -1:
+            return len(delta)
+        self.state = 'key_string'
+        return position + 1
+
+    def _parse_key_string(self, delta, index):
+        position = delta.find('"', index)
+        if position == -1:
+            return len(delta)
+        self.state = 'colon'
+        return position + 1
+
+    def _parse_colon(self, delta, index):
+        position = delta.find(':', index)
+        if position == -1:
+            return len(delta)
+        self.state = 'value'
+        return position + 1
+
+    def _parse_value(self, delta, index):
+        position = delta.find('"', index)
+        if position == -1:
+            return len(delta)
+        self.state = 'string'
+        return position + 1
+
+    def _parse_string(self, delta, index):
+        match = STRING_SPECIAL_CHARS.search(delta, index)
+        end = match.start() if match else len(delta)
+        if end > index:
+            self._add_text(delta[index:end])
+        if match is None:
+            return end
+
+        char = delta[end]
+        if char == '\n':
+            self._add_text(char)
+            self.raw_newline = True
+        elif char == '\\':
+            self.pending = char
+            self.state = 'escape'
+        else:
+            self.pending = char
+            self.state = 'quote'
+        return end + 1
+
+    def _parse_escape(self, delta, index):
+        char = delta[index]
+        self.pending += char
+        if self.pending[1] == 'u':
+            if len(self.pending) < 6:
+                return index + 1
+            try:
+                code_point = int(self.pending[2:], 16)
+            except ValueError:
+                self._add_text(self.pending)
+            else:
+                self._add_code_point(code_point, raw=self.pending)
+        elif char in JSON_ESCAPES:
+            self._add_text(JSON_ESCAPES[char], raw=self.pending)
+        else:
+            self._add_text(self.pending)
+        self.pending = ''
+        self.state = 'string'
+        return index + 1
+
+    def _parse_quote(self, delta, index):
+        # an unescaped quote, it ends the string only if it is followed by '}'
+        char = delta[index]
+        if char.isspace():
+            self.pending += char
+        elif char == '}':
+            self.pending += char
+            self.state = 'closed'
+        else:
+            self._revert_pending()
+            return index
+        return index + 1
+
+    def _parse_closed(self, delta, index):
+        char = delta[index]
+        if char.isspace():
+            self.pending += char
+            return index + 1
+        # more text after '}', the quote was part of the code
+        self._revert_pending()
+        return index
+
+    def _revert_pending(self):
+        pending, self.pending = self.pending, ''
+        self.state = 'string'
+        self._add_text(pending)
+        if '\n' in pending:
+            self.raw_newline = True
+
+    def _add_text(self, text, raw=None):
+        if self.high_surrogate is not None:
+            self.decoded_pieces.append(chr(self.high_surrogate))
+            self.high_surrogate = None
+        self.decoded_pieces.append(text)
+        self.raw_pieces.append(text if raw is None else raw)
+
+    def _add_code_point(self, code_point, raw):
+        if self.high_surrogate is not None and 0xDC00 <= code_point <= 0xDFFF:
+            combined = 0x10000 + ((self.high_surrogate - 0xD800) << 10) + (code_point - 0xDC00)
+            self.high_surrogate = None
+            self.decoded_pieces.append(chr(combined))
+            self.raw_pieces.append(raw)
+        elif 0xD800 <= code_point <= 0xDBFF:
+            self._add_text('', raw=raw)
+            self.high_surrogate = code_point
+        else:
+            self._add_text(chr(code_point), raw=raw)
+
+    @property
+    def code(self):
+        """
+        :return: the code decoded so far, None if the code string has not started yet
+        """
+        if self.state in ('begin', 'key', 'key_string', 'colon', 'value'):
+            return None
+        if self._code is None:
+            if self.raw_newline:
+                self._code = collapse_pieces(self.raw_pieces).strip('\n')
+            else:
+                self._code = collapse_pieces(self.decoded_pieces)
+                if self.high_surrogate is not None:
+                    self._code += chr(self.high_surrogate)
+        return self._code
+
+    def finish(self):
+        """
+        :return: the complete code string if the arguments have been parsed successfully otherwise None
+        """
+        if self.state not in ('quote', 'closed'):
+            return None
+        return self.code
@@ -0,0 +1,303 @@
+"""
+Run a batch of tasks without the web UI. Each task is a line of a JSONL file:
+
+    {"id": "sales-2023", "prompt": "Plot the monthly sales.", "files": ["data/sales_2023.csv"]}
+
+`id` defaults to the line number, `files` are relative to the tasks file, and `model` and `timeout` may override the
+command line options. With `--template`, tasks without a prompt get the template formatted with their fields, e.g.
+`--template "Summarize {name}"` for {"files": [...], "name": "..."}.
+
+Each task runs on its own `BotBackend` and kernel, `--workers` at a time. In the output directory, a task gets
+`<id>/notebook.ipynb` and the files its code created in `<id>/work_dir/`, and a record is appended to `results.jsonl`.
+Tasks already recorded there are skipped, so an interrupted batch can be resumed by running it again.
+
+Usage (from the `src` directory):
+    python batch_runner.py tasks.jsonl --output-dir batch_results --workers 4 --timeout 600
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import shutil
+import statistics
+import threading
+from response_parser import *
+from notebook_serializer import NotebookRecorder
+
+# seconds a task may run past its timeout to stop cleanly, after which it is abandoned and its kernel shut down
+TIMEOUT_GRACE_PERIOD = 30
+
+
+def load_tasks(path, template=None):
+    tasks = []
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            task = json.loads(line)
+            task['id'] = str(task.get('id', line_number))
+            if 'prompt' not in task:
+                if template is None:
+                    raise ValueError(f'Task {task["id"]} has no prompt and no --template is given')
+                task['prompt'] = template.format(**task)
+            task['files'] = [os.path.join(base_dir, file) for file in task.get('files', [])]
+            tasks.append(task)
+    return tasks
+
+
+def load_results(path):
+    """
+    :return: the last record of each task id
+    """
+    results = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # last line of a crashed run
+                    results[record['id']] = record
+    return results
+
+
+class BatchRunner:
+    def __init__(self, output_dir, workers=4, timeout=None, model_choice=None):
+        self.output_dir = output_dir
+        self.workers = workers
+        self.timeout = timeout
+        self.model_choice = model_choice
+        self.results_path = os.path.join(output_dir, 'results.jsonl')
+        self.stopping = False
+        self._running = set()  # bot backends of the running tasks
+        self._lock = threading.Lock()
+
+    def run_task(self, task):
+        task_dir = os.path.join(self.output_dir, task['id'])
+        os.makedirs(task_dir, exist_ok=True)
+        record = {'id': task['id'], 'status': 'ok', 'started_at': time.time()}
+        try:
+            bot_backend = self.create_bot_backend(task, task_dir)
+        except Exception as e:
+            record.update(
+                status='error', duration=time.time() - record['started_at'], errors=[f'{type(e).__name__}: {e}']
+            )
+            return record
+        try:
+            timeout = task.get('timeout', self.timeout)
+            if not timeout:
+                return self.run_session(task, task_dir, bot_backend, record)
+            # the timeout of the session only takes effect between two steps of the response, which a stalled API
+            # response or a hung tool may never reach: the task is abandoned at a hard deadline
+            session = concurrent.futures.Future()
+
+            def run_session():
+                try:
+                    session.set_result(self.run_session(task, task_dir, bot_backend, record))
+                except BaseException as e:
+                    session.set_exception(e)
+
+            threading.Thread(target=run_session, name=f'batch-session-{task["id"]}', daemon=True).start()
+            try:
+                return session.result(timeout=timeout + TIMEOUT_GRACE_PERIOD)
+            except concurrent.futures.TimeoutError:
+                bot_backend.stop_response()
+                return dict(
+                    record, status='timeout', duration=time.time() - record['started_at'],
+                    errors=[f'The task did not stop within {TIMEOUT_GRACE_PERIOD}s of its timeout and was abandoned']
+                )
+        finally:
+            # also on a timeout or a KeyboardInterrupt; an abandoned session stops once its kernel is shut down
+            self.close_bot_backend(bot_backend)
+
+    def run_session(self, task, task_dir, bot_backend: BotBackend, record):
+        tool_calls = []
+        errors = []
+
+        def hook(event, data):
+            if event == 'function_call':
+                tool_calls.append(data['name'])
+            elif event == 'error':
+                errors.append(data['message'])
+
+        bot_backend.add_event_hook(hook)
+        with self._lock:
+            self._running.add(bot_backend)
+
+        timeout = task.get('timeout', self.timeout)
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            bot_backend.stop_response()
+
+        timer = threading.Timer(timeout, on_timeout) if timeout else None
+        input_files = {}  # name -> (size, mtime) in the work dir, to tell unchanged inputs from outputs
+        try:
+            history = []
+            for path in task['files']:
+                filename = os.path.basename(path)
+                bot_msg = [f'📁[{filename}]', None]
+                history.append(bot_msg)
+                bot_backend.add_file_message(path=path, bot_msg=bot_msg)
+                input_stat = os.stat(os.path.join(bot_backend.jupyter_work_dir, filename))
+                input_files[filename] = (input_stat.st_size, input_stat.st_mtime_ns)
+            bot_backend.add_text_message(user_text=task['prompt'])
+            history.append([task['prompt'], None])
+            if timer is not None:
+                timer.start()
+            for history, event in stream_bot_response(bot_backend=bot_backend, history=history):
+                # after an interrupted execution, the model would be asked to go on
+                if (timed_out.is_set() or self.stopping) and not bot_backend.code_executing:
+                    bot_backend.update_stop_generating_state(stop_generating=True)
+            if errors:
+                record['status'] = 'error'
+        except Exception as e:
+            record['status'] = 'error'
+            errors.append(f'{type(e).__name__}: {e}')
+        finally:
+            if timer is not None:
+                timer.cancel()
+            with self._lock:
+                self._running.discard(bot_backend)
+            bot_backend.remove_event_hook(hook)
+        if timed_out.is_set():
+            record['status'] = 'timeout'
+
+        answers = [
+            message['content'] for message in bot_backend.conversation
+            if message['role'] == 'assistant' and 'name' not in message and message['content']
+        ]
+        record.update(
+            duration=time.time() - record['started_at'],
+            answer=answers[-1] if answers else None,
+            tool_calls=len(tool_calls),
+            errors=errors,
+            context_window_tokens=bot_backend.context_window_tokens,
+            notebook=bot_backend.notebook.path,
+            output_files=self.collect_output_files(bot_backend, input_files, os.path.join(task_dir, 'work_dir'))
+        )
+        return record
+
+    def create_bot_backend(self, task, task_dir):
+        bot_backend = BotBackend()
+        bot_backend.notebook = NotebookRecorder(
+            path=os.path.join(task_dir, 'notebook.ipynb'), cache_dir=f'cache/temp_{bot_backend.unique_id}'
+        )
+        model_choice = task.get('model', self.model_choice)
+        if model_choice:
+            bot_backend.update_gpt_model_choice(model_choice)
+        return bot_backend
+
+    @staticmethod
+    def collect_output_files(bot_backend: BotBackend, input_files, dest_dir):
+        """
+        Copy the files of the work dir, except the unchanged inputs, to `dest_dir`.
+        :return: their paths relative to `dest_dir`
+        """
+        output_files = []
+        work_dir = bot_backend.jupyter_work_dir
+        for root, _, filenames in os.walk(work_dir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                relative_path = os.path.relpath(path, work_dir)
+                st = os.stat(path)
+                if input_files.get(relative_path) == (st.st_size, st.st_mtime_ns):
+                    continue
+                os.makedirs(os.path.join(dest_dir, os.path.dirname(relative_path)), exist_ok=True)
+                shutil.copy2(path, os.path.join(dest_dir, relative_path))
+                output_files.append(relative_path)
+        return output_files
+
+    @staticmethod
+    def close_bot_backend(bot_backend: BotBackend):
+        try:
+            bot_backend.notebook.flush()
+        except Exception as e:
+            print(f'Failed to write notebook {bot_backend.notebook.path}: {e}')
+        bot_backend.jupyter_kernel.shutdown()
+        shutil.rmtree(bot_backend.jupyter_work_dir, ignore_errors=True)
+
+    def write_record(self, record):
+        with self._lock:
+            with open(self.results_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def stop(self):
+        self.stopping = True
+        with self._lock:
+            running = list(self._running)
+        for bot_backend in running:
+            bot_backend.stop_response()
+
+    def run(self, tasks, retry_failed=False):
+        os.makedirs(self.output_dir, exist_ok=True)
+        previous_results = load_results(self.results_path)
+        pending_tasks = [
+            task for task in tasks
+            if task['id'] not in previous_results or (retry_failed and previous_results[task['id']]['status'] != 'ok')
+        ]
+        print(f'{len(tasks)} tasks, {len(tasks) - len(pending_tasks)} already done, {len(pending_tasks)} to run '
+              f'with {self.workers} workers')
+
+        records = []
+        start_time = time.time()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch-task')
+        futures = {executor.submit(self.run_task, task): task for task in pending_tasks}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
+                record = future.result()
+                if self.stopping:
+                    continue  # not recorded, the task runs again on resume
+                self.write_record(record)
+                records.append(record)
+                elapsed = time.time() - start_time
+                print(f'[{len(records)}/{len(pending_tasks)}] {record["id"]}: {record["status"]} in '
+                      f'{record["duration"]:.1f}s, {len(records) / elapsed * 60:.1f} tasks/min')
+        except KeyboardInterrupt:
+            print('Stopping, the unfinished tasks will run again when the batch is resumed...')
+            self.stop()
+            executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            executor.shutdown()
+        print_summary(records, time.time() - start_time)
+        return records
+
+
+def print_summary(records, elapsed):
+    if not records:
+        return
+    statuses = collections.Counter(record['status'] for record in records)
+    durations = sorted(record['duration'] for record in records)
+    print(f'{len(records)} tasks in {elapsed:.1f}s ({len(records) / elapsed * 60:.1f} tasks/min): '
+          + ', '.join(f'{count} {status}' for status, count in sorted(statuses.items())))
+    print(f'task duration: median {statistics.median(durations):.1f}s, '
+          f'p90 {durations[min(int(len(durations) * 0.9), len(durations) - 1)]:.1f}s, max {durations[-1]:.1f}s, '
+          f'{sum(record.get("tool_calls", 0) for record in records)} tool calls')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a JSONL file of tasks, see batch_runner.py for the format')
+    parser.add_argument('tasks', help='JSONL file of tasks')
+    parser.add_argument('--output-dir', default='batch_results', help='notebooks, output files and results.jsonl')
+    parser.add_argument('--workers', type=int, default=4, help='number of tasks running at the same time')
+    parser.add_argument(
+        '--timeout', type=float, default=None,
+        help='seconds before a task is stopped, it is abandoned if it has not stopped 30s later'
+    )
+    parser.add_argument('--model', default=None, help='model choice, e.g. "GPT-3.5" (default: GPT-4)')
+    parser.add_argument('--template', default=None, help='prompt of the tasks without one, formatted with their fields')
+    parser.add_argument('--retry-failed', action='store_true', help='run again the tasks that failed or timed out')
+    args = parser.parse_args()
+
+    if not os.path.exists('cache'):
+        os.mkdir('cache')
+    BatchRunner(
+        output_dir=args.output_dir, workers=args.workers, timeout=args.timeout, model_choice=args.model
+    ).run(load_tasks(args.tasks, template=args.template), retry_failed=args.retry_failed)
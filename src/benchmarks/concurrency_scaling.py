@@ -0,0 +1,50 @@
+"""
+Show how the web UI scales with concurrent sessions: every turn runs a cell that keeps a core busy for `--cpu-seconds`,
+so throughput should grow linearly with the number of sessions up to the number of cores (or to the
+"max_concurrent_executions" of the "queue" config), and stay flat beyond it.
+
+Usage (from the `src` directory, next to your `config.json`):
+    python benchmarks/concurrency_scaling.py --turns 5 --cpu-seconds 1
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import *
+
+CPU_BOUND_CODE = "import time\nstart = time.process_time()\nwhile time.process_time() - start < {cpu_seconds}:\n    pass"
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    default_sessions = sorted({1, 2, 4, 8, 16, 32, cpu_count, 2 * cpu_count} & set(range(1, 2 * cpu_count + 1)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, nargs='+', default=default_sessions,
+                        help='numbers of concurrent sessions')
+    parser.add_argument('--turns', type=int, default=5, help='user messages per session')
+    parser.add_argument('--cpu-seconds', type=float, default=1.0, help='CPU time of the cell run by each turn')
+    add_mock_api_arguments(parser, token_rate=0, latency=0)
+    args = parser.parse_args()
+    args.code = CPU_BOUND_CODE.format(cpu_seconds=args.cpu_seconds)
+    api_base = use_mock_api(args)
+
+    scheduler = get_execution_scheduler(config.get('queue'))
+    print(f'{cpu_count} cores, {scheduler.max_concurrent_executions} concurrent executions, '
+          f'queue concurrency {QUEUE_CONCURRENCY}, mock API at {api_base}')
+    print(f'{"sessions":>8} {"turns/s":>8} {"speedup":>8} {"efficiency":>10} {"p50 (s)":>8} {"p99 (s)":>8}')
+    single_throughput = None
+    for num_sessions in args.sessions:
+        result = asyncio.run(run_load(num_sessions, args.turns))
+        single_throughput = single_throughput or result['throughput'] / num_sessions
+        speedup = result['throughput'] / single_throughput
+        print(f'{num_sessions:>8} {result["throughput"]:>8.2f} {speedup:>8.2f} {speedup / num_sessions:>10.0%} '
+              f'{result["p50"]:>8.2f} {result["p99"]:>8.2f}')
+        for error in result['errors']:
+            print(f'  session failed: {error!r}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Measure the time between an interrupt request and the kernel reporting idle while a cell floods stdout.
+
+Usage (from the `src` directory):
+    python benchmarks/interrupt_latency.py --rounds 10 --warmup 1.0
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jupyter_backend import JupyterKernel
+
+HEAVY_STDOUT_CODE = "while True:\n    print('x' * 200)"
+
+
+def measure_interrupt_latency(kernel, warmup):
+    interrupt_time = []
+    timer = threading.Timer(warmup, lambda: (interrupt_time.append(time.time()), kernel.send_interrupt_signal()))
+    timer.start()
+    output_count = 0
+    for _ in kernel.execute_code_stream(HEAVY_STDOUT_CODE):
+        output_count += 1
+    idle_time = time.time()
+    timer.join()
+    return idle_time - interrupt_time[0], output_count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=10, help='number of interrupted cells')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds of output before interrupting')
+    args = parser.parse_args()
+
+    kernel = JupyterKernel(work_dir=tempfile.mkdtemp(prefix='interrupt_latency_'))
+    latencies = []
+    try:
+        for index in range(args.rounds):
+            latency, output_count = measure_interrupt_latency(kernel, args.warmup)
+            latencies.append(latency)
+            print(f'round {index + 1}: {latency * 1000:.1f} ms ({output_count} outputs received)')
+    finally:
+        kernel.kernel_client.stop_channels()
+        kernel.kernel_manager.shutdown_kernel(now=True)
+
+    latencies.sort()
+    print(f'interrupt-to-idle latency over {args.rounds} rounds: '
+          f'min {latencies[0] * 1000:.1f} ms, '
+          f'median {statistics.median(latencies) * 1000:.1f} ms, '
+          f'max {latencies[-1] * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
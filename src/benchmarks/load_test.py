@@ -0,0 +1,182 @@
+"""
+End-to-end load test: N simulated sessions send user messages through `web_ui.bot` (and thus `BotBackend`,
+`parse_response` and real Jupyter kernels) against the local mock of the chat completions API in
+`benchmarks/mock_openai_server.py`. Sessions run on one event loop, as in the Gradio queue.
+Reports throughput, turn latency percentiles and memory growth per session.
+
+Usage (from the `src` directory, next to your `config.json`, whose API settings are overridden):
+    python benchmarks/load_test.py --sessions 1 4 16 --turns 20 --token-rate 50 --latency 0.3
+    python benchmarks/load_test.py --api-base http://127.0.0.1:8001/v1  # mock server started separately
+
+Memory is read from /proc (Linux only), it covers this process and the kernels of the sessions.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if not os.path.exists('config.json'):
+    sys.exit('config.json not found, please run this benchmark from the `src` directory.')
+
+import web_ui
+from web_ui import *
+from mock_openai_server import DEFAULT_CODE, MockChatCompletionsScript, start_mock_server
+
+
+def rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def total_rss_mb(bot_backends):
+    kernel_pids = {bot_backend.jupyter_kernel.kernel_pid() for bot_backend in bot_backends} - {None}
+    return rss_mb(os.getpid()) + sum(rss_mb(pid) for pid in kernel_pids)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class SimulatedSession:
+    def __init__(self, index):
+        self.index = index
+        self.state_dict = {'bot_backend': None}
+        self.history = []
+        self.turn_seconds = []
+        self.frames = 0
+        self.error = None
+        initialization(self.state_dict)
+
+    @property
+    def bot_backend(self) -> BotBackend:
+        return get_bot_backend(self.state_dict)
+
+    async def run_turn(self, turn):
+        history, _ = add_text(self.state_dict, self.history, f'Session {self.index}, question {turn}: run the code.')
+        # gradio sends the chatbot value back as lists
+        history = [list(message) for message in history]
+        start_time = time.time()
+        async for outputs in bot(self.state_dict, history):
+            history = outputs[0]
+            self.frames += 1
+        self.turn_seconds.append(time.time() - start_time)
+        self.history = history
+
+    async def run(self, turns):
+        try:
+            for turn in range(turns):
+                await self.run_turn(turn)
+        except Exception as e:
+            self.error = e
+
+    def close(self):
+        self.bot_backend.jupyter_kernel.shutdown()
+        self.bot_backend._clear_all_files_in_work_dir(backup=False)
+        os.rmdir(self.bot_backend.jupyter_work_dir)
+
+
+async def run_load(num_sessions, turns):
+    base_rss = total_rss_mb([])
+    sessions = [SimulatedSession(index) for index in range(num_sessions)]
+    bot_backends = [session.bot_backend for session in sessions]
+    # a first turn warms up the kernels and the connections, memory growth is measured from there
+    for session in sessions:
+        await session.run_turn(turn=-1)
+    session_rss = total_rss_mb(bot_backends)
+    for session in sessions:
+        session.turn_seconds.clear()
+
+    start_time = time.time()
+    await asyncio.gather(*(session.run(turns) for session in sessions))
+    elapsed = time.time() - start_time
+    final_rss = total_rss_mb(bot_backends)
+
+    errors = [session.error for session in sessions if session.error is not None]
+    turn_seconds = [seconds for session in sessions for seconds in session.turn_seconds]
+    # latency of the first and the last tenth of the turns of each session, the history grows in between
+    tenth = max(turns // 10, 1)
+    early = [seconds for session in sessions for seconds in session.turn_seconds[:tenth]]
+    late = [seconds for session in sessions for seconds in session.turn_seconds[-tenth:]]
+    for session in sessions:
+        session.close()
+    return {
+        'sessions': num_sessions,
+        'turns': len(turn_seconds),
+        'errors': errors,
+        'throughput': len(turn_seconds) / elapsed if elapsed else 0.0,
+        'p50': percentile(turn_seconds, 0.5) if turn_seconds else 0.0,
+        'p99': percentile(turn_seconds, 0.99) if turn_seconds else 0.0,
+        'early_p50': statistics.median(early) if early else 0.0,
+        'late_p50': statistics.median(late) if late else 0.0,
+        'frames_per_turn': sum(session.frames for session in sessions) / max(len(turn_seconds) + num_sessions, 1),
+        'session_mb': (session_rss - base_rss) / num_sessions,
+        'growth_mb': (final_rss - session_rss) / num_sessions,
+    }
+
+
+def add_mock_api_arguments(parser, token_rate=50, latency=0.3, code=DEFAULT_CODE):
+    parser.add_argument('--token-rate', type=float, default=token_rate,
+                        help='chunks per second of the mock API, 0 for no limit')
+    parser.add_argument('--latency', type=float, default=latency, help='seconds before the first chunk of the mock API')
+    parser.add_argument('--tool-calls', type=int, default=1, help='requests calling execute_code per user message')
+    parser.add_argument('--parallel', type=int, default=1, help='parallel calls of execute_code per request')
+    parser.add_argument('--code', default=code, help='code executed by each tool call')
+    parser.add_argument('--api-base', help='API base of a mock server started separately')
+
+
+def use_mock_api(args):
+    """
+    Point the config at the mock API, started in this process unless `--api-base` is given.
+    :return: the API base
+    """
+    if args.api_base:
+        api_base = args.api_base
+    else:
+        script = MockChatCompletionsScript(
+            code=args.code, tool_calls=args.tool_calls, token_rate=args.token_rate, latency=args.latency,
+            parallel=args.parallel
+        )
+        api_base = f'http://127.0.0.1:{start_mock_server(script).server_port}/v1'
+    config.update({'API_TYPE': 'open_ai', 'API_base': api_base, 'API_VERSION': None, 'API_KEY': 'mock'})
+    for model in config['model'].values():
+        model['available'] = True
+    # workers of "backend_workers" would read the API settings from config.json, the sessions stay in this process
+    web_ui.BACKEND_WORKERS = 0
+    if not os.path.exists('cache'):
+        os.mkdir('cache')
+    return api_base
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 4, 16], help='numbers of concurrent sessions')
+    parser.add_argument('--turns', type=int, default=20, help='user messages per session')
+    add_mock_api_arguments(parser)
+    args = parser.parse_args()
+    api_base = use_mock_api(args)
+
+    print(f'{args.turns} turns per session, mock API at {api_base}')
+    print(f'{"sessions":>8} {"turns/s":>8} {"p50 (s)":>8} {"p99 (s)":>8} {"first p50":>10} {"last p50":>9} '
+          f'{"frames":>7} {"MB/session":>11} {"growth MB":>10}')
+    for num_sessions in args.sessions:
+        result = asyncio.run(run_load(num_sessions, args.turns))
+        print(f'{result["sessions"]:>8} {result["throughput"]:>8.2f} {result["p50"]:>8.2f} {result["p99"]:>8.2f} '
+              f'{result["early_p50"]:>10.2f} {result["late_p50"]:>9.2f} {result["frames_per_turn"]:>7.1f} '
+              f'{result["session_mb"]:>11.1f} {result["growth_mb"]:>10.1f}')
+        for error in result['errors']:
+            print(f'  session failed: {error!r}')
+
+
+if __name__ == '__main__':
+    main()
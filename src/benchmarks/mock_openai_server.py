@@ -0,0 +1,153 @@
+"""
+Local stand-in for the streaming chat completions API, to benchmark the app without calling OpenAI.
+
+Each answer to a user message is scripted: a few words of content, then `--tool-calls` requests calling `execute_code`
+(`--parallel` calls per request, followed by the code execution results sent back by the app), then a short analysis
+that ends the turn.
+Chunks are streamed at `--token-rate` chunks per second after `--latency` seconds, over kept-alive HTTP/1.1
+connections.
+
+Usage (from the `src` directory):
+    python benchmarks/mock_openai_server.py --port 8001 --token-rate 50 --latency 0.3
+then set "API_base" to "http://127.0.0.1:8001/v1" in `config.json`, or let `benchmarks/load_test.py` start it.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_CODE = "import math\nprint(sum(math.sqrt(i) for i in range(100000)))"
+INTRO_TEXT = 'I will run some code to answer your question.'
+ANALYSIS_TEXT = 'The code ran successfully, the result is shown above.'
+
+
+class MockChatCompletionsScript:
+    def __init__(self, code=DEFAULT_CODE, tool_calls=1, token_rate=0.0, latency=0.0, piece_length=4, parallel=1):
+        self.code = code
+        self.tool_calls = tool_calls
+        self.parallel = parallel
+        self.token_rate = token_rate
+        self.latency = latency
+        self.piece_length = piece_length
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def deltas(self, messages):
+        """
+        :return: the deltas of the answer to a conversation and its finish reason
+        """
+        # number of function results since the last user message
+        results = 0
+        for message in reversed(messages):
+            if message['role'] in ('function', 'tool'):
+                results += 1
+            elif message['role'] == 'user':
+                break
+
+        deltas = [{'role': 'assistant', 'content': ''}]
+        if results >= self.tool_calls * self.parallel:
+            deltas.extend({'content': word + ' '} for word in ANALYSIS_TEXT.split(' '))
+            return deltas, 'stop'
+
+        if results == 0:
+            deltas.extend({'content': word + ' '} for word in INTRO_TEXT.split(' '))
+        request_id = self.next_request_id()
+        arguments = json.dumps({'code': self.code})
+        # parallel calls are streamed one after the other
+        for call_index in range(self.parallel):
+            call_id = f'call_{request_id}_{call_index}'
+            deltas.append({'tool_calls': [
+                {'index': call_index, 'id': call_id, 'type': 'function',
+                 'function': {'name': 'execute_code', 'arguments': ''}}
+            ]})
+            for index in range(0, len(arguments), self.piece_length):
+                deltas.append({'tool_calls': [
+                    {'index': call_index, 'function': {'arguments': arguments[index:index + self.piece_length]}}
+                ]})
+        return deltas, 'tool_calls'
+
+    def next_request_id(self):
+        with self._lock:
+            self.request_count += 1
+            return self.request_count
+
+
+class MockChatCompletionsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keeps connections alive, the stream is sent with chunked transfer encoding
+    script: MockChatCompletionsScript = None
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        deltas, finish_reason = self.script.deltas(body.get('messages', []))
+        chunk_id = f'chatcmpl-mock-{self.script.next_request_id()}'
+        model = body.get('model', 'mock')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        time.sleep(self.script.latency)
+        interval = 1 / self.script.token_rate if self.script.token_rate else 0
+        next_send_time = time.time()
+        for index, delta in enumerate(deltas + [{}]):
+            choice = {'index': 0, 'delta': delta, 'finish_reason': None if index < len(deltas) else finish_reason}
+            chunk = {'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                     'choices': [choice]}
+            if interval:
+                next_send_time += interval
+                time.sleep(max(next_send_time - time.time(), 0))
+            self._write_chunk(f'data: {json.dumps(chunk)}\n\n')
+        self._write_chunk('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_server(script: MockChatCompletionsScript, port=0, host='127.0.0.1'):
+    """
+    Serve the script from a background thread.
+    :return: the server, its API base URL is `http://{host}:{server.server_port}/v1`
+    """
+    handler = type('ScriptedHandler', (MockChatCompletionsHandler,), {'script': script})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-openai-server', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--token-rate', type=float, default=0, help='chunks per second, 0 for no limit')
+    parser.add_argument('--latency', type=float, default=0, help='seconds before the first chunk')
+    parser.add_argument('--tool-calls', type=int, default=1, help='requests calling execute_code per user message')
+    parser.add_argument('--parallel', type=int, default=1, help='parallel calls of execute_code per request')
+    parser.add_argument('--code', default=DEFAULT_CODE, help='code executed by each tool call')
+    args = parser.parse_args()
+
+    script = MockChatCompletionsScript(
+        code=args.code, tool_calls=args.tool_calls, token_rate=args.token_rate, latency=args.latency,
+        parallel=args.parallel
+    )
+    server = start_mock_server(script, port=args.port)
+    print(f'serving chat completions at http://127.0.0.1:{server.server_port}/v1, press Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
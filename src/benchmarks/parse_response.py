@@ -0,0 +1,118 @@
+"""
+Measure the time `parse_response` spends per streamed chunk at different chat history lengths.
+A chunk stream is replayed up to its finish chunk (which would execute the code) against a minimal stand-in backend.
+
+Usage (from the `src` directory, next to your `config.json`):
+    python benchmarks/parse_response.py --history 10 100 1000
+    python benchmarks/parse_response.py --chunks recorded_chunks.jsonl
+
+A recorded stream is a JSONL file with one chunk per line, as written by `chunk.model_dump_json()`.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if not os.path.exists('config.json'):
+    sys.exit('config.json not found, please run this benchmark from the `src` directory.')
+
+from openai.types.chat import ChatCompletionChunk
+from response_parser import *
+from metrics import SessionMetrics
+
+SAMPLE_CODE = '\n'.join(
+    f"df['col_{index}'] = df['value'].rolling({index + 2}).mean()  # smooth column {index}" for index in range(60)
+)
+
+
+class StandInBackend(GPTResponseLog):
+    """
+    The parts of `BotBackend` that are used while a response is streamed, without an API client or a kernel.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.jupyter_kernel = SimpleNamespace(available_functions={'execute_code': None, 'python': None})
+        self.additional_tools = {}
+        self.metrics = SessionMetrics()
+
+
+def make_chunk(delta, finish_reason=None):
+    return ChatCompletionChunk.model_validate({
+        'id': 'benchmark', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'benchmark',
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+    })
+
+
+def synthesize_chunks(code, piece_length):
+    chunks = [make_chunk({'role': 'assistant', 'content': ''})]
+    for word in 'I will compute the rolling means of the value column.'.split(' '):
+        chunks.append(make_chunk({'content': word + ' '}))
+    chunks.append(make_chunk({'tool_calls': [
+        {'index': 0, 'id': 'call', 'type': 'function', 'function': {'name': 'execute_code', 'arguments': ''}}
+    ]}))
+    arguments = json.dumps({'code': code})
+    for index in range(0, len(arguments), piece_length):
+        chunks.append(make_chunk({'tool_calls': [
+            {'index': 0, 'function': {'arguments': arguments[index:index + piece_length]}}
+        ]}))
+    return chunks
+
+
+def load_chunks(path):
+    chunks = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                chunks.append(ChatCompletionChunk.model_validate_json(line))
+    return chunks
+
+
+def build_history(length):
+    history = []
+    for index in range(length - 1):
+        history.append([
+            f'Please plot column {index} of the data.',
+            f'Here is the plot of column {index}.\n🟢Finished:\n```python\n{SAMPLE_CODE}\n```'
+        ])
+    history.append([None, ''])
+    return history
+
+
+def replay(chunks, history_length):
+    bot_backend = StandInBackend()
+    history = build_history(history_length)
+    start_time = time.perf_counter()
+    for chunk in chunks:
+        for history, whether_exit in parse_response(chunk=chunk, history=history, bot_backend=bot_backend):
+            pass
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history', type=int, nargs='+', default=[10, 100, 1000], help='chat history lengths')
+    parser.add_argument('--chunks', help='JSONL file of recorded chunks, a synthetic stream is used if omitted')
+    parser.add_argument('--piece-length', type=int, default=8, help='arguments characters per synthetic chunk')
+    parser.add_argument('--repeat', type=int, default=5, help='number of replays per measurement')
+    args = parser.parse_args()
+
+    if args.chunks:
+        chunks = load_chunks(args.chunks)
+    else:
+        chunks = synthesize_chunks(SAMPLE_CODE, args.piece_length)
+    chunks = [chunk for chunk in chunks if not (chunk.choices and chunk.choices[0].finish_reason)]
+
+    print(f'replaying {len(chunks)} chunks')
+    print(f'{"history":>10} {"total (ms)":>12} {"per chunk (us)":>16}')
+    for history_length in args.history:
+        elapsed = min(replay(chunks, history_length) for _ in range(args.repeat))
+        print(f'{history_length:>10} {elapsed * 1000:>12.2f} {elapsed / len(chunks) * 1e6:>16.1f}')
+
+
+if __name__ == '__main__':
+    main()
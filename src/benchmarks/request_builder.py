@@ -0,0 +1,90 @@
+"""
+Measure the per-turn overhead of building a chat completion request, compared with deep-copying the request kwargs
+as `chat_completion` used to do. Token counts are filled in beforehand, so that only request construction is measured.
+
+Usage (from the `src` directory, next to your `config.json`):
+    python benchmarks/request_builder.py --messages 50 500 5000
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if not os.path.exists('config.json'):
+    sys.exit('config.json not found, please run this benchmark from the `src` directory.')
+
+from functional import *
+
+
+def build_conversation(num_messages, encoding_for_which_model):
+    conversation = []
+    for index in range(num_messages):
+        if index == 0:
+            message = Message({'role': 'system', 'content': system_msg})
+        elif index % 3 == 1:
+            message = Message({'role': 'user', 'content': f'Please analyse column {index} of the data. ' * 5})
+        elif index % 3 == 2:
+            message = Message({'role': 'assistant', 'name': 'execute_code',
+                               'content': '{"code": "import pandas as pd\\ndf = pd.read_csv(\'data.csv\')\\n'
+                                          'print(df.describe())"}'})
+        else:
+            message = Message({'role': 'function', 'name': 'execute_code', 'content': 'col  count  mean\n' * 20})
+        message.token_counts[encoding_for_which_model] = len(message['content']) // 4
+        conversation.append(message)
+    return conversation
+
+
+def build_kwargs_with_deepcopy(legacy_kwargs, kwargs_for_chat_completion, model, encoding_for_which_model):
+    # the deep copy `chat_completion` used to make, of plain dict messages and a list of tools
+    copy.deepcopy(legacy_kwargs)
+    return build_chat_completion_kwargs(kwargs_for_chat_completion, model, encoding_for_which_model)
+
+
+def time_per_call(function, repeat, **kwargs):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        function(**kwargs)
+    return (time.perf_counter() - start_time) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, nargs='+', default=[50, 500, 5000], help='conversation lengths')
+    parser.add_argument('--repeat', type=int, default=200, help='number of requests built per measurement')
+    args = parser.parse_args()
+
+    model = config['model']['GPT-4']['model_name']
+    encoding_for_which_model = 'gpt-4' if config['API_TYPE'] == 'azure' else model
+    SLICED_CONV_MESSAGE.token_counts[encoding_for_which_model] = len(SLICED_CONV_MESSAGE['content']) // 4
+
+    print(f'{"messages":>10} {"deepcopy (ms)":>15} {"builder (ms)":>15} {"speedup":>10}')
+    for num_messages in args.messages:
+        kwargs_for_chat_completion = {
+            'stream': True,
+            'messages': build_conversation(num_messages, encoding_for_which_model),
+            'tools': tuple(functions),
+            'tool_choice': 'auto',
+            'model': model
+        }
+        legacy_kwargs = dict(kwargs_for_chat_completion)
+        legacy_kwargs['messages'] = [dict(message) for message in kwargs_for_chat_completion['messages']]
+        legacy_kwargs['tools'] = list(functions)
+
+        deepcopy_time = time_per_call(
+            build_kwargs_with_deepcopy, args.repeat, legacy_kwargs=legacy_kwargs,
+            kwargs_for_chat_completion=kwargs_for_chat_completion, model=model,
+            encoding_for_which_model=encoding_for_which_model
+        )
+        builder_time = time_per_call(
+            build_chat_completion_kwargs, args.repeat, kwargs_for_chat_completion=kwargs_for_chat_completion,
+            model=model, encoding_for_which_model=encoding_for_which_model
+        )
+        print(f'{num_messages:>10} {deepcopy_time * 1000:>15.3f} {builder_time * 1000:>15.3f} '
+              f'{deepcopy_time / builder_time:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,21 @@
 import json
 import copy
 import shutil
-import openai
+import uuid
+import functools
+import tiktoken
 from jupyter_backend import *
 from tools import *
+from kernel_pool import get_kernel_pool
+from openai_clients import get_client_registry
+from snapshots import get_snapshot_engine, get_content_store
+from session_reaper import get_session_reaper
+from kernel_checkpoint import create_kernel_checkpoint
+from tool_log import ToolEventLog
+from metrics import SessionMetrics, register_session
+from arguments_parser import CodeArgumentsParser
 from typing import *
-from notebook_serializer import add_markdown_to_notebook, add_code_cell_to_notebook
+from notebook_serializer import create_notebook_recorder, add_markdown_to_notebook, add_code_cell_to_notebook
 
 functions = [
     {
@@ -44,6 +54,13 @@ You should:
 
 Note: If the user uploads a file, you will receive a system message "User uploaded a file: filename". Use the filename as the path in the code. '''
 
+kernel_suspended_msg = 'The Jupyter kernel was shut down to free resources, a new kernel will run the next code: ' \
+                       '{lost_variables}. The files in the working directory are kept.'
+
+kernel_suspended_in_turn_msg = 'The session was suspended to free resources, so this response stops here. A new ' \
+                               'kernel will run the next code, without the variables defined so far; the files in ' \
+                               'the working directory are kept. Send a message to continue.'
+
 with open('config.json') as f:
     config = json.load(f)
 
@@ -56,11 +73,73 @@ def get_config():
     return config
 
 
-def create_openai_client(api_type, api_base, api_version, api_key):
-    if api_type == "azure":
-        return openai.AzureOpenAI(api_version=api_version, azure_endpoint=api_base, api_key=api_key)
-    else:
-        return openai.OpenAI(base_url=api_base, api_key=api_key)
+@functools.lru_cache(maxsize=None)
+def get_encoder(encoding_for_which_model):
+    try:
+        return tiktoken.encoding_for_model(encoding_for_which_model)
+    except KeyError:
+        # a model unknown to tiktoken, e.g. an Azure deployment or a local model
+        return tiktoken.get_encoding('cl100k_base')
+
+
+class Message(dict):
+    """
+    An immutable conversation message that caches the number of tokens of its content for each encoding model.
+    Since messages never change once created, requests can share them instead of copying them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_counts = {}
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Message is immutable')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return Message, (dict(self),), self.__dict__
+
+    def count_tokens(self, encoding_for_which_model):
+        if encoding_for_which_model not in self.token_counts:
+            encoder = get_encoder(encoding_for_which_model)
+            self.token_counts[encoding_for_which_model] = len(encoder.encode(self['content'] or ''))
+        return self.token_counts[encoding_for_which_model]
+
+
+class ChatBubble:
+    """
+    The chatbot message that a function call is displayed in while the response is being streamed. The text shown
+    before the call is kept as `prefix`, each update only rewrites the display block after it, in place.
+    """
+
+    def __init__(self, message: List):
+        self.message = message
+        self.prefix = message[1] or ''
+
+    def update(self, display_block: str):
+        self.message[1] = self.prefix + display_block
+
+    def commit(self):
+        """
+        :return: a snapshot of the final message, later updates are no longer possible
+        """
+        snapshot = list(self.message)
+        self.message = None
+        return snapshot
+
+
+# the state of one tool call of a response, see `GPTResponseLog.start_tool_call`
+TOOL_CALL_ATTRIBUTES = (
+    'function_name', 'function_args_str', 'code_arguments_parser', 'code_str', 'display_code_block', 'current_bubble',
+    'function_call_started_at'
+)
 
 
 class GPTResponseLog:
@@ -69,58 +148,146 @@ class GPTResponseLog:
         self.content = ''
         self.function_name = None
         self.function_args_str = ''
+        self.code_arguments_parser = CodeArgumentsParser()
         self.code_str = ''
         self.display_code_block = ''
         self.finish_reason = 'stop'
-        self.bot_history = None
+        self.current_bubble = None
+        self.request_sent_at = None
+        self.first_token_at = None
+        self.streamed_chunks = 0
+        self.function_call_started_at = None  # time the function name was received
+        self.function_executed_at = None  # time the function call was complete and started running
+        self.tool_call_index = None  # index of the tool call being streamed, None before the first one
+        self.pending_tool_calls = []  # previous tool calls of the response, their arguments are complete
         self.stop_generating = False
         self.code_executing = False
         self.interrupt_signal_sent = False
+        self.event_hooks = []  # called with (event, data) as the response is parsed, e.g. by the API server
+
+    @staticmethod
+    def _initial_values():
+        return {'assistant_role_name': '',
+                'content': '',
+                'function_name': None,
+                'function_args_str': '',
+                'code_arguments_parser': CodeArgumentsParser(),
+                'code_str': '',
+                'display_code_block': '',
+                'finish_reason': 'stop',
+                'current_bubble': None,
+                'request_sent_at': None,
+                'first_token_at': None,
+                'streamed_chunks': 0,
+                'function_call_started_at': None,
+                'function_executed_at': None,
+                'tool_call_index': None,
+                'pending_tool_calls': [],
+                'stop_generating': False,
+                'code_executing': False,
+                'interrupt_signal_sent': False}
 
     def reset_gpt_response_log_values(self, exclude=None):
         if exclude is None:
             exclude = []
 
-        attributes = {'assistant_role_name': '',
-                      'content': '',
-                      'function_name': None,
-                      'function_args_str': '',
-                      'code_str': '',
-                      'display_code_block': '',
-                      'finish_reason': 'stop',
-                      'bot_history': None,
-                      'stop_generating': False,
-                      'code_executing': False,
-                      'interrupt_signal_sent': False}
-
+        attributes = self._initial_values()
         for attr_name in exclude:
             del attributes[attr_name]
         for attr_name, value in attributes.items():
             setattr(self, attr_name, value)
 
+    def add_event_hook(self, hook: Callable[[str, Dict], None]):
+        self.event_hooks.append(hook)
+
+    def remove_event_hook(self, hook: Callable[[str, Dict], None]):
+        self.event_hooks.remove(hook)
+
+    def emit(self, event: str, **data):
+        for hook in self.event_hooks:
+            hook(event, data)
+
     def set_assistant_role_name(self, assistant_role_name: str):
         self.assistant_role_name = assistant_role_name
 
     def add_content(self, content: str):
         self.content += content
 
+    def update_request_sent_at(self, request_sent_at: float):
+        self.request_sent_at = request_sent_at
+
+    def mark_token_received(self):
+        """
+        :return: True for the first token of the response
+        """
+        self.streamed_chunks += 1
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+            return True
+        return False
+
     def set_function_name(self, function_name: str):
         self.function_name = function_name
+        self.function_call_started_at = time.time()
+
+    def start_tool_call(self, index: int):
+        """
+        Parallel tool calls are streamed one after the other: when the call `index` starts, the previous one is
+        complete and is set aside in `pending_tool_calls`.
+        :return: whether a previous call was set aside
+        """
+        if self.tool_call_index is None or index == self.tool_call_index:
+            self.tool_call_index = index
+            return False
+        self.pending_tool_calls.append({attr_name: getattr(self, attr_name) for attr_name in TOOL_CALL_ATTRIBUTES})
+        initial_values = self._initial_values()
+        for attr_name in TOOL_CALL_ATTRIBUTES:
+            setattr(self, attr_name, initial_values[attr_name])
+        self.tool_call_index = index
+        return True
+
+    def take_tool_calls(self):
+        """
+        :return: the tool calls of the response in order, the current one last; `load_tool_call` makes one current
+        """
+        tool_calls = self.pending_tool_calls
+        tool_calls.append({attr_name: getattr(self, attr_name) for attr_name in TOOL_CALL_ATTRIBUTES})
+        self.pending_tool_calls = []
+        return tool_calls
+
+    def tool_call_names(self):
+        """
+        :return: the function names of the tool calls of the response so far, the current one last
+        """
+        return [tool_call['function_name'] for tool_call in self.pending_tool_calls] + [self.function_name]
+
+    def load_tool_call(self, tool_call: Dict):
+        for attr_name, value in tool_call.items():
+            setattr(self, attr_name, value)
+
+    def start_current_bubble(self, history: List):
+        self.current_bubble = ChatBubble(message=history[-1])
 
-    def copy_current_bot_history(self, bot_history: List):
-        self.bot_history = copy.deepcopy(bot_history)
+    def commit_current_bubble(self):
+        bubble, self.current_bubble = self.current_bubble, None
+        return bubble.commit() if bubble is not None else None
 
     def add_function_args_str(self, function_args_str: str):
         self.function_args_str += function_args_str
+        self.code_arguments_parser.feed(function_args_str)
 
     def update_code_str(self, code_str: str):
         self.code_str = code_str
 
     def update_display_code_block(self, display_code_block):
         self.display_code_block = display_code_block
+        if self.current_bubble is not None:
+            self.current_bubble.update(display_code_block)
 
     def update_finish_reason(self, finish_reason: str):
         self.finish_reason = finish_reason
+        if finish_reason == 'tool_calls':
+            self.function_executed_at = time.time()
 
     def update_stop_generating_state(self, stop_generating: bool):
         self.stop_generating = stop_generating
@@ -133,20 +300,46 @@ class GPTResponseLog:
 
 
 class BotBackend(GPTResponseLog):
-    def __init__(self):
+    def __init__(self, session_number=None):
         super().__init__()
         self.unique_id = hash(id(self))
         self.jupyter_work_dir = f'cache/work_dir_{self.unique_id}'
-        self.tool_log = f'cache/tool_{self.unique_id}.log'
-        self.jupyter_kernel = JupyterKernel(work_dir=self.jupyter_work_dir)
+        self.metrics = SessionMetrics()
+        register_session(self.unique_id, self.metrics)
+        self.notebook = create_notebook_recorder(
+            cache_dir=f'cache/temp_{self.unique_id}', session_number=session_number
+        )
+        self._init_api_config()
+        self.tool_log = ToolEventLog(
+            # unique_id is derived from an address that may be reused by a later run
+            path=f'cache/tool_{self.unique_id}_{uuid.uuid4().hex[:8]}.jsonl',
+            max_bytes=int(self.config.get('tool_log', {}).get('max_mb', 10) * 1024 ** 2),
+            backup_count=self.config.get('tool_log', {}).get('backup_count', 3)
+        )
+        self.jupyter_kernel = JupyterKernel(
+            work_dir=self.jupyter_work_dir,
+            kernel_pool=get_kernel_pool(self.config.get('kernel_pool')),
+            execution_timeout=self.config.get('execution_timeout'),
+            output_buffer_size=self.config.get('output_buffer_size'),
+            metrics=self.metrics,
+            checkpoint=create_kernel_checkpoint(
+                self.config.get('kernel_checkpoint'), directory=f'cache/checkpoint_{self.unique_id}'
+            ),
+            cell_rollback=self.config.get('cell_rollback', {}).get('enabled', False),
+            rollback_policy=self.config.get('cell_rollback', {}).get('policy', 'on_failure')
+        )
+        # whether code executions give control back while the kernel is silent, for asynchronous front ends
+        self.cooperative_kernel_wait = False
+        self.last_active = time.time()
+        self.noticed_kernel_suspensions = 0
         self.gpt_model_choice = "GPT-4"
         self.revocable_files = []
         self.system_msg = system_msg
         self.functions = copy.deepcopy(functions)
-        self._init_api_config()
         self._init_tools()
         self._init_conversation()
         self._init_kwargs_for_chat_completion()
+        get_session_reaper(self.config.get('session_reaper')).register(self)
 
     def _init_conversation(self):
         first_system_msg = {'role': 'system', 'content': self.system_msg}
@@ -154,9 +347,9 @@ class BotBackend(GPTResponseLog):
         self.sliced = False  # whether the conversion is sliced
         if hasattr(self, 'conversation'):
             self.conversation.clear()
-            self.conversation.append(first_system_msg)
         else:
-            self.conversation: List[Dict] = [first_system_msg]
+            self.conversation: List[Message] = []
+        self._append_message(first_system_msg)
 
     def _init_api_config(self):
         self.config = get_config()
@@ -164,7 +357,10 @@ class BotBackend(GPTResponseLog):
         api_base = self.config['API_base']
         api_version = self.config['API_VERSION']
         api_key = config['API_KEY']
-        self.client = create_openai_client(api_type, api_base, api_version, api_key)
+        # the client and its connection pool are shared by all sessions with the same API settings
+        self.client = get_client_registry(self.config.get('http_pool')).get_client(
+            api_type, api_base, api_version, api_key
+        )
 
     def _init_tools(self):
         self.additional_tools = {}
@@ -193,7 +389,7 @@ class BotBackend(GPTResponseLog):
         self.kwargs_for_chat_completion = {
             'stream': True,
             'messages': self.conversation,
-            'tools': self.functions,
+            'tools': tuple(self.functions),
             'tool_choice': 'auto'
         }
 
@@ -204,13 +400,23 @@ class BotBackend(GPTResponseLog):
         else:
             self.kwargs_for_chat_completion['model'] = model_name
 
+    def get_encoding_model(self):
+        if self.config['API_TYPE'] == 'azure':
+            return 'gpt-3.5-turbo' if self.gpt_model_choice == 'GPT-3.5' else 'gpt-4'
+        else:
+            return self.config['model'][self.gpt_model_choice]['model_name']
+
+    def _append_message(self, message):
+        # tokens are counted when the message is first sent, then cached in the message
+        message = Message(message)
+        self.conversation.append(message)
+        return message
+
     def _backup_all_files_in_work_dir(self):
-        count = 1
-        backup_dir = f'cache/backup_{self.unique_id}'
-        while os.path.exists(backup_dir):
-            count += 1
-            backup_dir = f'cache/backup_{self.unique_id}_{count}'
-        shutil.copytree(src=self.jupyter_work_dir, dst=backup_dir)
+        # files are linked into the snapshot store rather than copied, see snapshots.py
+        get_snapshot_engine(self.config.get('snapshots')).take(
+            work_dir=self.jupyter_work_dir, session_id=self.unique_id
+        )
 
     def _clear_all_files_in_work_dir(self, backup=True):
         if backup:
@@ -223,36 +429,63 @@ class BotBackend(GPTResponseLog):
                 os.remove(path)
 
     def _save_tool_log(self, tool_response):
-        with open(self.tool_log, 'a', encoding='utf-8') as log_file:
-            log_file.write(f'Previous conversion: {self.conversation}\n')
-            log_file.write(f'Model choice: {self.gpt_model_choice}\n')
-            log_file.write(f'Tool name: {self.function_name}\n')
-            log_file.write(f'Parameters: {self.function_args_str}\n')
-            log_file.write(f'Response: {tool_response}\n')
-            log_file.write('----------\n\n')
+        now = time.time()
+        timings = {}
+        if self.function_call_started_at is not None and self.function_executed_at is not None:
+            timings['arguments_streaming'] = self.function_executed_at - self.function_call_started_at
+        if self.function_executed_at is not None:
+            timings['execution'] = now - self.function_executed_at
+        self.tool_log.record_tool_call(
+            conversation=self.conversation,
+            tool_name=self.function_name,
+            arguments=self.function_args_str,
+            response=tool_response,
+            model_choice=self.gpt_model_choice,
+            timings=timings
+        )
 
     def add_gpt_response_content_message(self):
-        self.conversation.append(
+        self.last_active = time.time()
+        self._append_message(
             {'role': self.assistant_role_name, 'content': self.content}
         )
-        add_markdown_to_notebook(self.content, title="Assistant")
+        add_markdown_to_notebook(self.notebook, self.content, title="Assistant")
+
+    def kernel_suspended_unnoticed(self):
+        """
+        :return: whether the kernel was suspended since the model was last told, e.g. during the current turn
+        """
+        return self.jupyter_kernel.suspend_count > self.noticed_kernel_suspensions
+
+    def notice_kernel_suspension(self):
+        """
+        Tell the model that the kernel was suspended, once per suspension.
+        """
+        if self.kernel_suspended_unnoticed():
+            self.noticed_kernel_suspensions = self.jupyter_kernel.suspend_count
+            self.append_system_msg(
+                kernel_suspended_msg.format(lost_variables=self.jupyter_kernel.lost_variables_message())
+            )
 
     def add_text_message(self, user_text):
-        self.conversation.append(
+        self.last_active = time.time()
+        self.notice_kernel_suspension()
+        self._append_message(
             {'role': 'user', 'content': user_text}
         )
         self.revocable_files.clear()
         self.update_finish_reason(finish_reason='new_input')
-        add_markdown_to_notebook(user_text, title="User")
+        add_markdown_to_notebook(self.notebook, user_text, title="User")
 
     def add_file_message(self, path, bot_msg):
+        self.last_active = time.time()
         filename = os.path.basename(path)
         work_dir = self.jupyter_work_dir
 
-        shutil.copy(path, work_dir)
+        # the work dir gets a reflink of the upload in the shared content store, identical uploads are stored once
+        get_content_store(self.config.get('snapshots')).ingest(path, os.path.join(work_dir, filename))
 
-        gpt_msg = {'role': 'system', 'content': f'User uploaded a file: {filename}'}
-        self.conversation.append(gpt_msg)
+        gpt_msg = self._append_message({'role': 'system', 'content': f'User uploaded a file: {filename}'})
         self.revocable_files.append(
             {
                 'bot_msg': bot_msg,
@@ -262,10 +495,11 @@ class BotBackend(GPTResponseLog):
         )
 
     def add_function_call_response_message(self, function_response: Union[str, None], save_tokens=True):
+        self.last_active = time.time()
         if self.code_str is not None:
-            add_code_cell_to_notebook(self.code_str)
+            add_code_cell_to_notebook(self.notebook, self.code_str)
 
-        self.conversation.append(
+        self._append_message(
             {
                 "role": self.assistant_role_name,
                 "name": self.function_name,
@@ -276,7 +510,7 @@ class BotBackend(GPTResponseLog):
             if save_tokens and len(function_response) > 500:
                 function_response = f'{function_response[:200]}\n[Output too much, the middle part output is omitted]\n ' \
                                     f'End part of output:\n{function_response[-200:]}'
-            self.conversation.append(
+            self._append_message(
                 {
                     "role": "function",
                     "name": self.function_name,
@@ -286,7 +520,7 @@ class BotBackend(GPTResponseLog):
         self._save_tool_log(tool_response=function_response)
 
     def append_system_msg(self, prompt):
-        self.conversation.append(
+        self._append_message(
             {'role': 'system', 'content': prompt}
         )
 
@@ -322,9 +556,21 @@ class BotBackend(GPTResponseLog):
         self.jupyter_kernel.send_interrupt_signal()
         self.update_interrupt_signal_sent(interrupt_signal_sent=True)
 
+    def stop_response(self):
+        """
+        Interrupt the code being executed if any, otherwise stop generating the response.
+        """
+        if self.code_executing:
+            self.send_interrupt_signal()
+        else:
+            self.update_stop_generating_state(stop_generating=True)
+
     def restart(self):
         self.revocable_files.clear()
         self._init_conversation()
         self.reset_gpt_response_log_values()
+        if self.jupyter_kernel.checkpoint is not None:
+            # a restart by the user starts from an empty namespace
+            self.jupyter_kernel.checkpoint.clear()
         self.jupyter_kernel.restart_jupyter_kernel()
         self._clear_all_files_in_work_dir()
@@ -0,0 +1,98 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from metrics import register_collector
+
+
+class FairExecutionScheduler:
+    """
+    Limits the number of code executions running at the same time, so that the kernels of concurrent sessions share
+    the cores instead of oversubscribing them. When executions wait for a slot, the session that used the least kernel
+    time recently goes first (the usage of a session decays by half every `usage_half_life` seconds), so that a user
+    running long computations does not delay the short ones of the others.
+    Slots are acquired and released on the event loop of the web UI.
+    """
+
+    def __init__(self, max_concurrent_executions=None, usage_half_life=300.0):
+        self.max_concurrent_executions = max_concurrent_executions or os.cpu_count() or 1
+        self.usage_half_life = usage_half_life
+        self.running = 0
+        self._usage = {}  # session id -> (decayed seconds of execution, time of the last update)
+        self._waiters = []  # heap of (usage, order, future)
+        self._order = itertools.count()
+
+    def usage(self, session_id, now=None):
+        now = now or time.time()
+        seconds, updated_at = self._usage.get(session_id, (0.0, now))
+        return seconds * 0.5 ** ((now - updated_at) / self.usage_half_life)
+
+    async def acquire(self, session_id):
+        """
+        Wait for an execution slot.
+        :return: the time the slot was granted, to be given to `release`
+        """
+        if self.running < self.max_concurrent_executions and not self._waiters:
+            self.running += 1
+            return time.time()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (self.usage(session_id), next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was granted in the meantime, hand it over
+                self._release_slot()
+            raise
+        return time.time()
+
+    def release(self, session_id, granted_at):
+        now = time.time()
+        self._usage[session_id] = (self.usage(session_id, now) + now - granted_at, now)
+        self._release_slot()
+
+    def _release_slot(self):
+        self.running -= 1
+        while self._waiters and self.running < self.max_concurrent_executions:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+
+    def stats(self):
+        return {
+            'max_concurrent_executions': self.max_concurrent_executions,
+            'running': self.running,
+            'waiting': sum(not future.done() for _, _, future in self._waiters),
+        }
+
+    def metric_samples(self):
+        stats = self.stats()
+        return [
+            ('lci_executions_max_concurrent', 'gauge', 'Code executions allowed to run at once',
+             stats['max_concurrent_executions'], {}),
+            ('lci_executions_running', 'gauge', 'Code executions running', stats['running'], {}),
+            ('lci_executions_waiting', 'gauge', 'Code executions waiting for a slot', stats['waiting'], {}),
+        ]
+
+
+_execution_scheduler = None
+_execution_scheduler_lock = threading.Lock()
+
+
+def get_execution_scheduler(queue_config=None):
+    """
+    Return the process-wide execution scheduler, creating it from the "queue" config on first use.
+    """
+    global _execution_scheduler
+    with _execution_scheduler_lock:
+        if _execution_scheduler is None:
+            queue_config = queue_config or {}
+            _execution_scheduler = FairExecutionScheduler(
+                max_concurrent_executions=queue_config.get('max_concurrent_executions'),
+                usage_half_life=queue_config.get('usage_half_life', 300.0)
+            )
+            register_collector(_execution_scheduler.metric_samples)
+        return _execution_scheduler
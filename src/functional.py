@@ -1,10 +1,24 @@
 from bot_backend import *
 import base64
+import uuid
 import time
-import tiktoken
+from metrics import observe
 from notebook_serializer import add_code_cell_error_to_notebook, add_image_to_notebook, add_code_cell_output_to_notebook
 
-SLICED_CONV_MESSAGE = "[Rest of the conversation has been omitted to fit in the context window]"
+SLICED_CONV_MESSAGE = Message(
+    {'role': 'system', 'content': "[Rest of the conversation has been omitted to fit in the context window]"}
+)
+
+# minimum interval (in seconds) between two displays of partial code execution output
+OUTPUT_REFRESH_INTERVAL = config.get('output_refresh_interval', 0.5)
+# number of trailing characters of partial code execution output that is displayed
+OUTPUT_TAIL_LENGTH = 2000
+
+
+def count_message_tokens(message, encoding_for_which_model):
+    if isinstance(message, Message):
+        return message.count_tokens(encoding_for_which_model)
+    return len(get_encoder(encoding_for_which_model).encode(message['content'] or ''))
 
 
 def get_conversation_slice(conversation, model, encoding_for_which_model, min_output_tokens_count=500):
@@ -13,41 +27,52 @@ def get_conversation_slice(conversation, model, encoding_for_which_model, min_ou
     with the first message(explaining the role of the assistant) + the last x messages that can fit in the context
     window.
     """
-    encoder = tiktoken.encoding_for_model(encoding_for_which_model)
-    count_tokens = lambda txt: len(encoder.encode(txt))
-    nb_tokens = count_tokens(conversation[0]['content'])
-    sliced_conv = [conversation[0]]
+    count_tokens = lambda message: count_message_tokens(message, encoding_for_which_model)
+    nb_tokens = count_tokens(conversation[0])
     context_window_limit = int(config['model_context_window'][model])
     max_tokens = context_window_limit - count_tokens(SLICED_CONV_MESSAGE) - min_output_tokens_count
     sliced = False
-    for message in conversation[-1:0:-1]:
-        nb_tokens += count_tokens(message['content'])
-        if nb_tokens > max_tokens:
-            sliced_conv.insert(1, {'role': 'system', 'content': SLICED_CONV_MESSAGE})
+    start_index = len(conversation)
+    for index in range(len(conversation) - 1, 0, -1):
+        message_tokens = count_tokens(conversation[index])
+        if nb_tokens + message_tokens > max_tokens:
             sliced = True
             break
-        sliced_conv.insert(1, message)
+        nb_tokens += message_tokens
+        start_index = index
+    if sliced:
+        nb_tokens += count_tokens(SLICED_CONV_MESSAGE)
+        sliced_conv = [conversation[0], SLICED_CONV_MESSAGE] + conversation[start_index:]
+    else:
+        sliced_conv = [conversation[0]] + conversation[start_index:]
     return sliced_conv, nb_tokens, sliced
 
 
+def build_chat_completion_kwargs(kwargs_for_chat_completion, model, encoding_for_which_model):
+    """
+    Assemble the keyword arguments of a chat completion request without copying the conversation or the tools:
+    messages are immutable and the tools are a tuple, so the request shares them with the bot backend.
+    :return: kwargs, number of tokens of the messages, whether the conversation is sliced
+    """
+    kwargs = dict(kwargs_for_chat_completion)
+    kwargs['messages'], nb_tokens, sliced = get_conversation_slice(
+        conversation=kwargs_for_chat_completion['messages'],
+        model=model,
+        encoding_for_which_model=encoding_for_which_model
+    )
+    return kwargs, nb_tokens, sliced
+
+
 def chat_completion(bot_backend: BotBackend):
     model_choice = bot_backend.gpt_model_choice
     model_name = bot_backend.config['model'][model_choice]['model_name']
-    kwargs_for_chat_completion = copy.deepcopy(bot_backend.kwargs_for_chat_completion)
-    if bot_backend.config['API_TYPE'] == "azure":
-        kwargs_for_chat_completion['messages'], nb_tokens, sliced = \
-            get_conversation_slice(
-                conversation=kwargs_for_chat_completion['messages'],
-                model=model_name,
-                encoding_for_which_model='gpt-3.5-turbo' if model_choice == 'GPT-3.5' else 'gpt-4'
-            )
-    else:
-        kwargs_for_chat_completion['messages'], nb_tokens, sliced = \
-            get_conversation_slice(
-                conversation=kwargs_for_chat_completion['messages'],
-                model=model_name,
-                encoding_for_which_model=model_name
-            )
+    start_time = time.time()
+    kwargs_for_chat_completion, nb_tokens, sliced = build_chat_completion_kwargs(
+        kwargs_for_chat_completion=bot_backend.kwargs_for_chat_completion,
+        model=model_name,
+        encoding_for_which_model=bot_backend.get_encoding_model()
+    )
+    bot_backend.metrics.observe('lci_request_build_seconds', time.time() - start_time)
 
     bot_backend.update_token_count(num_tokens=nb_tokens)
     bot_backend.update_sliced_state(sliced=sliced)
@@ -57,12 +82,14 @@ def chat_completion(bot_backend: BotBackend):
     assert model_name in config['model_context_window'], \
         f"{model_name} lacks context window information. Please check the config.json file."
 
+    bot_backend.update_request_sent_at(request_sent_at=time.time())
     response = bot_backend.client.chat.completions.create(**kwargs_for_chat_completion)
     return response
 
 
-def add_code_execution_result_to_bot_history(content_to_display, history, unique_id):
+def add_code_execution_result_to_bot_history(content_to_display, history, unique_id, notebook=None, metrics=None):
     images, text = [], []
+    image_time = 0.0
 
     # terminal output
     error_occurred = False
@@ -70,19 +97,19 @@ def add_code_execution_result_to_bot_history(content_to_display, history, unique
     for mark, out_str in content_to_display:
         if mark in ('stdout', 'execute_result_text', 'display_text'):
             text.append(out_str)
-            add_code_cell_output_to_notebook(out_str)
+            add_code_cell_output_to_notebook(notebook, out_str)
         elif mark in ('execute_result_png', 'execute_result_jpeg', 'display_png', 'display_jpeg'):
-            if 'png' in mark:
-                images.append(('png', out_str))
-                add_image_to_notebook(out_str, 'image/png')
-            else:
-                add_image_to_notebook(out_str, 'image/jpeg')
-                images.append(('jpg', out_str))
+            filetype = 'png' if 'png' in mark else 'jpg'
+            start_time = time.time()
+            path = save_image_to_cache(out_str, filetype, unique_id)
+            image_time += time.time() - start_time
+            images.append(path)
+            add_image_to_notebook(notebook, path, 'image/png' if filetype == 'png' else 'image/jpeg')
         elif mark == 'error':
             # Set output type to error
             text.append(delete_color_control_char(out_str))
             error_occurred = True
-            add_code_cell_error_to_notebook(out_str)
+            add_code_cell_error_to_notebook(notebook, out_str)
     text = '\n'.join(text).strip('\n')
     if error_occurred:
         history.append([None, f'❌Terminal output:\n```shell\n\n{text}\n```'])
@@ -90,14 +117,8 @@ def add_code_execution_result_to_bot_history(content_to_display, history, unique
         history.append([None, f'✔️Terminal output:\n```shell\n{text}\n```'])
 
     # image output
-    for filetype, img in images:
-        image_bytes = base64.b64decode(img)
-        temp_path = f'cache/temp_{unique_id}'
-        if not os.path.exists(temp_path):
-            os.mkdir(temp_path)
-        path = f'{temp_path}/{hash(time.time())}.{filetype}'
-        with open(path, 'wb') as f:
-            f.write(image_bytes)
+    start_time = time.time()
+    for path in images:
         width, height = get_image_size(path)
         history.append(
             [
@@ -106,6 +127,37 @@ def add_code_execution_result_to_bot_history(content_to_display, history, unique
                 f'max-height:none\'> '
             ]
         )
+    if images:
+        observe(metrics, 'lci_image_postprocess_seconds', image_time + time.time() - start_time)
+
+
+def save_image_to_cache(img, filetype, unique_id):
+    """
+    Save a base64 encoded image to the session cache, where it is displayed from and referenced by the notebook.
+    """
+    image_bytes = base64.b64decode(img)
+    temp_path = f'cache/temp_{unique_id}'
+    os.makedirs(temp_path, exist_ok=True)
+    # a unique name, the notebook keeps referring to this file
+    path = f'{temp_path}/{uuid.uuid4().hex}.{filetype}'
+    with open(path, 'wb') as f:
+        f.write(image_bytes)
+    return path
+
+
+def update_output_tail(output_tail, output):
+    """
+    Append a (mark, out_str) code execution output to the displayed tail of terminal output, keeping at most
+    OUTPUT_TAIL_LENGTH characters.
+    """
+    mark, out_str = output
+    if mark in ('stdout', 'execute_result_text', 'display_text'):
+        output_tail += out_str
+    elif mark in ('execute_result_png', 'execute_result_jpeg', 'display_png', 'display_jpeg'):
+        output_tail += '[image]\n'
+    elif mark == 'error':
+        output_tail += delete_color_control_char(out_str)
+    return output_tail[-OUTPUT_TAIL_LENGTH:]
 
 
 def add_function_response_to_bot_history(hypertext_to_display, history):
@@ -1,5 +1,23 @@
+import collections
 import jupyter_client
+import os
+import queue
 import re
+import threading
+import time
+import zmq
+import zmq.asyncio
+from metrics import observe
+from kernel_rollback import ROLLBACK_MIMETYPE, ROLLBACK_POLICIES, rollback_install_code, fork_code, finish_code
+
+# interval (in seconds) for checking that the kernel is still alive while waiting for output
+KERNEL_CHECK_INTERVAL = 1
+# time (in seconds) given to the kernel to stop after an interrupt before it is restarted
+INTERRUPT_GRACE_PERIOD = 10
+# number of characters of the outputs of a code cell kept in memory, half for the head and half for the tail
+OUTPUT_BUFFER_SIZE = 4000000
+# yielded by a cooperative `execute_code_stream` when it has to wait for the kernel
+KERNEL_WAIT = object()
 
 
 def delete_color_control_char(string):
@@ -7,87 +25,344 @@ def delete_color_control_char(string):
     return ansi_escape.sub('', string)
 
 
+def get_outputs_from_iopub_msg(iopub_msg):
+    all_output = []
+    if iopub_msg['msg_type'] == 'stream':
+        if iopub_msg['content'].get('name') == 'stdout':
+            output = iopub_msg['content']['text']
+            all_output.append(('stdout', output))
+    elif iopub_msg['msg_type'] == 'execute_result':
+        if 'data' in iopub_msg['content']:
+            if 'text/plain' in iopub_msg['content']['data']:
+                output = iopub_msg['content']['data']['text/plain']
+                all_output.append(('execute_result_text', output))
+            if 'text/html' in iopub_msg['content']['data']:
+                output = iopub_msg['content']['data']['text/html']
+                all_output.append(('execute_result_html', output))
+            if 'image/png' in iopub_msg['content']['data']:
+                output = iopub_msg['content']['data']['image/png']
+                all_output.append(('execute_result_png', output))
+            if 'image/jpeg' in iopub_msg['content']['data']:
+                output = iopub_msg['content']['data']['image/jpeg']
+                all_output.append(('execute_result_jpeg', output))
+    elif iopub_msg['msg_type'] == 'display_data':
+        if 'data' in iopub_msg['content']:
+            if 'text/plain' in iopub_msg['content']['data']:
+                output = iopub_msg['content']['data']['text/plain']
+                all_output.append(('display_text', output))
+            if 'text/html' in iopub_msg['content']['data']:
+                output = iopub_msg['content']['data']['text/html']
+                all_output.append(('display_html', output))
+            if 'image/png' in iopub_msg['content']['data']:
+                output = iopub_msg['content']['data']['image/png']
+                all_output.append(('display_png', output))
+            if 'image/jpeg' in iopub_msg['content']['data']:
+                output = iopub_msg['content']['data']['image/jpeg']
+                all_output.append(('display_jpeg', output))
+    elif iopub_msg['msg_type'] == 'error':
+        if 'traceback' in iopub_msg['content']:
+            output = '\n'.join(iopub_msg['content']['traceback'])
+            all_output.append(('error', output))
+
+    return all_output
+
+
+def get_text_to_gpt(content_to_display):
+    text_to_gpt = []
+    for mark, out_str in content_to_display:
+        if mark in ('stdout', 'execute_result_text', 'display_text'):
+            text_to_gpt.append(out_str)
+        elif mark in ('execute_result_png', 'execute_result_jpeg', 'display_png', 'display_jpeg'):
+            text_to_gpt.append('[image]')
+        elif mark == 'error':
+            text_to_gpt.append(delete_color_control_char(out_str))
+
+    return '\n'.join(text_to_gpt)
+
+
+class OutputCollector:
+    """
+    Collects the (mark, out_str) outputs of a code cell within a budget of characters. The first outputs are kept
+    until half of the budget is used, then only the most recent outputs fitting in the other half are kept. Once the
+    budget is exceeded, the complete output stream is written to `log_path` as plain text.
+    """
+
+    def __init__(self, log_path, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.log_path = log_path
+        self.head_size = buffer_size // 2
+        self.tail_size = buffer_size - self.head_size
+        self.head = []
+        self.head_used = 0
+        self.tail = collections.deque()
+        self.tail_used = 0
+        self.omitted_size = 0
+        self.log_file = None
+
+    def add(self, output):
+        mark, out_str = output
+        if self.log_file is None:
+            head_left = self.head_size - self.head_used
+            if len(out_str) <= head_left:
+                self.head.append(output)
+                self.head_used += len(out_str)
+                return
+            self.log_file = open(self.log_path, 'w', encoding='utf-8')
+            for head_output in self.head:
+                self._write_log(head_output)
+            self._write_log(output)
+            if mark in ('stdout', 'execute_result_text', 'display_text', 'error') and head_left > 0:
+                # fill the rest of the head with the beginning of the text
+                self.head.append((mark, out_str[:head_left]))
+                self.head_used += head_left
+                out_str = out_str[head_left:]
+        else:
+            self._write_log(output)
+
+        self.tail.append((mark, out_str))
+        self.tail_used += len(out_str)
+        while self.tail_used > self.tail_size:
+            mark, out_str = self.tail.popleft()
+            self.tail_used -= len(out_str)
+            overflow = self.tail_used + len(out_str) - self.tail_size
+            if not self.tail and mark in ('stdout', 'execute_result_text', 'display_text', 'error'):
+                # a single output larger than the tail, keep its end
+                self.tail.append((mark, out_str[overflow:]))
+                self.tail_used += len(out_str) - overflow
+                self.omitted_size += overflow
+            else:
+                self.omitted_size += len(out_str)
+
+    def _write_log(self, output):
+        mark, out_str = output
+        if mark in ('stdout', 'execute_result_text', 'display_text'):
+            self.log_file.write(out_str)
+        elif mark in ('execute_result_png', 'execute_result_jpeg', 'display_png', 'display_jpeg'):
+            self.log_file.write('[image]\n')
+        elif mark == 'error':
+            self.log_file.write(delete_color_control_char(out_str) + '\n')
+
+    def get_outputs(self):
+        """
+        :return: the collected outputs, with a note in place of the omitted middle part if the budget was exceeded
+        """
+        if self.log_file is None:
+            return self.head
+
+        self.log_file.close()
+        outputs = list(self.head)
+        if self.omitted_size:
+            outputs.append(
+                ('stdout', f'\n[{self.omitted_size} characters of output omitted, the complete output is saved in '
+                           f'{os.path.basename(self.log_path)}]\n')
+            )
+        outputs.extend(self.tail)
+        return outputs
+
+
 class JupyterKernel:
-    def __init__(self, work_dir):
-        self.kernel_manager, self.kernel_client = jupyter_client.manager.start_new_kernel(kernel_name='python3')
+    def __init__(self, work_dir, kernel_pool=None, execution_timeout=None, output_buffer_size=None, metrics=None,
+                 checkpoint=None, cell_rollback=False, rollback_policy='on_failure'):
+        self.kernel_pool = kernel_pool
+        self.metrics = metrics
+        self.checkpoint = checkpoint
+        self.cell_rollback = cell_rollback
+        self.rollback_policy = None
+        self.set_rollback_policy(rollback_policy)
+        self.kernel_manager, self.kernel_client = self._start_kernel()
         self.work_dir = work_dir
+        self.execution_timeout = execution_timeout
+        self.output_buffer_size = output_buffer_size or OUTPUT_BUFFER_SIZE
+        self.cell_count = 0
         self.interrupt_signal = False
-        self._create_work_dir()
+        self.wait_timeout = None  # seconds a cooperative execution can wait for, None if it is not waiting
+        self.suspended = False
+        self.suspend_count = 0
+        self.closed = False  # shut down for good, see `shutdown`
+        self.running_executions = 0
+        self._state_lock = threading.Lock()
+        self._init_interrupt_sockets()
+        self._init_kernel()
         self.available_functions = {
             'execute_code': self.execute_code,
             'python': self.execute_code
         }
 
-    def execute_code_(self, code):
-        msg_id = self.kernel_client.execute(code)
+    def _init_interrupt_sockets(self):
+        # `send_interrupt_signal` is called from another thread, it wakes up the poller of `execute_code_stream`
+        # through this pair of sockets
+        context = zmq.Context.instance()
+        address = f'inproc://jupyter-kernel-interrupt-{id(self)}'
+        self._interrupt_receiver = context.socket(zmq.PULL)
+        self._interrupt_receiver.bind(address)
+        self._interrupt_sender = context.socket(zmq.PUSH)
+        self._interrupt_sender.setsockopt(zmq.LINGER, 0)
+        self._interrupt_sender.connect(address)
+        self._interrupt_sender_lock = threading.Lock()
+
+    def set_rollback_policy(self, policy):
+        """
+        Choose which code cells are rolled back with `cell_rollback`, one of ROLLBACK_POLICIES. Applies from the next
+        code execution.
+        """
+        if policy not in ROLLBACK_POLICIES:
+            raise ValueError(f'Unknown rollback policy: {policy}, expected one of {", ".join(ROLLBACK_POLICIES)}')
+        self.rollback_policy = policy
+
+    def _drain_interrupt_receiver(self):
+        while self._interrupt_receiver.poll(0):
+            self._interrupt_receiver.recv()
 
-        # Get the output of the code
-        msg_list = []
+    def execute_code_stream(self, code, timeout=None, cooperative=False):
+        """
+        Execute code and yield (mark, out_str) pairs as soon as the kernel produces them, see `_execute_code_stream`.
+        A suspended kernel is replaced by a new one first. With `cell_rollback`, the kernel forks before the code runs,
+        and goes back to the state of the fork if `rollback_policy` says so (by default, if the code fails).
+        """
+        if self.closed:
+            yield 'error', 'KernelError: The session is closed'
+            return
+        with self._state_lock:
+            if self.suspended:
+                self.kernel_manager, self.kernel_client = self._start_kernel()
+                self.interrupt_signal = False
+                self.suspended = False
+                self._init_kernel()
+            self.running_executions += 1
+        failed = False
+        rollback_policy = self.rollback_policy if self.cell_rollback else 'never'
+        try:
+            if rollback_policy != 'never':
+                self.kernel_client.execute(fork_code(code), silent=True, store_history=False)
+            for output in self._execute_code_stream(code, timeout=timeout, cooperative=cooperative):
+                if output is not KERNEL_WAIT and output[0] == 'error':
+                    failed = True
+                yield output
+            if rollback_policy != 'never':
+                # rolls back or keeps the changes of the code, a kernel restarted in the meantime has no fork
+                yield from self._execute_code_stream(
+                    finish_code(roll_back=ROLLBACK_POLICIES[rollback_policy](failed)), cooperative=cooperative,
+                    silent=True
+                )
+            if self.checkpoint is not None and not failed:
+                # the kernel saves the checkpoint before it runs the next code
+                self.kernel_client.execute(self.checkpoint.save_code(code), silent=True, store_history=False)
+        finally:
+            with self._state_lock:
+                self.running_executions -= 1
+
+    def _execute_code_stream(self, code, timeout=None, cooperative=False, silent=False):
+        """
+        Execute code and yield (mark, out_str) pairs as soon as the kernel produces them.
+        Waiting is driven by a poller over the iopub socket and the interrupt socket, so interrupts and timeouts take
+        effect as soon as they happen, even while the code is printing continuously.
+        If `cooperative`, the generator does not block while the kernel is silent: it yields KERNEL_WAIT instead, and
+        the caller is expected to wait (e.g. with `wait_for_output`) before resuming it.
+        `silent` code is left out of the kernel history and of the metrics of code cells.
+        """
+        timeout = timeout or self.execution_timeout
+        self._drain_interrupt_receiver()
+
+        msg_id = self.kernel_client.execute(code, silent=silent, store_history=not silent)
+        sent_at = time.time()
+        started_at = None
+        iopub_channel = self.kernel_client.iopub_channel
+
+        poller = zmq.Poller()
+        poller.register(iopub_channel.socket, zmq.POLLIN)
+        poller.register(self._interrupt_receiver, zmq.POLLIN)
+
+        deadline = time.time() + timeout if timeout else None
+        interrupted_at = None
         while True:
-            try:
-                iopub_msg = self.kernel_client.get_iopub_msg(timeout=1)
-                msg_list.append(iopub_msg)
-                if iopub_msg['msg_type'] == 'status' and iopub_msg['content'].get('execution_state') == 'idle':
-                    break
-            except:
-                if self.interrupt_signal:
+            poll_timeout = KERNEL_CHECK_INTERVAL
+            if interrupted_at is not None:
+                poll_timeout = min(poll_timeout, interrupted_at + INTERRUPT_GRACE_PERIOD - time.time())
+            elif deadline is not None:
+                poll_timeout = min(poll_timeout, deadline - time.time())
+            if cooperative:
+                events = dict(poller.poll(0))
+                if not events:
+                    self.wait_timeout = max(poll_timeout, 0)
+                    yield KERNEL_WAIT
+                    self.wait_timeout = None
+                    events = dict(poller.poll(0))
+            else:
+                events = dict(poller.poll(max(poll_timeout, 0) * 1000))
+
+            if self._interrupt_receiver in events:
+                self._drain_interrupt_receiver()
+
+            while True:
+                if self.interrupt_signal and interrupted_at is None:
                     self.kernel_manager.interrupt_kernel()
-                    self.interrupt_signal = False
-                continue
-
-        all_output = []
-        for iopub_msg in msg_list:
-            if iopub_msg['msg_type'] == 'stream':
-                if iopub_msg['content'].get('name') == 'stdout':
-                    output = iopub_msg['content']['text']
-                    all_output.append(('stdout', output))
-            elif iopub_msg['msg_type'] == 'execute_result':
-                if 'data' in iopub_msg['content']:
-                    if 'text/plain' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['text/plain']
-                        all_output.append(('execute_result_text', output))
-                    if 'text/html' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['text/html']
-                        all_output.append(('execute_result_html', output))
-                    if 'image/png' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['image/png']
-                        all_output.append(('execute_result_png', output))
-                    if 'image/jpeg' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['image/jpeg']
-                        all_output.append(('execute_result_jpeg', output))
-            elif iopub_msg['msg_type'] == 'display_data':
-                if 'data' in iopub_msg['content']:
-                    if 'text/plain' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['text/plain']
-                        all_output.append(('display_text', output))
-                    if 'text/html' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['text/html']
-                        all_output.append(('display_html', output))
-                    if 'image/png' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['image/png']
-                        all_output.append(('display_png', output))
-                    if 'image/jpeg' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['image/jpeg']
-                        all_output.append(('display_jpeg', output))
-            elif iopub_msg['msg_type'] == 'error':
-                if 'traceback' in iopub_msg['content']:
-                    output = '\n'.join(iopub_msg['content']['traceback'])
-                    all_output.append(('error', output))
-
-        return all_output
-
-    def execute_code(self, code):
-        text_to_gpt = []
-        content_to_display = self.execute_code_(code)
-        for mark, out_str in content_to_display:
-            if mark in ('stdout', 'execute_result_text', 'display_text'):
-                text_to_gpt.append(out_str)
-            elif mark in ('execute_result_png', 'execute_result_jpeg', 'display_png', 'display_jpeg'):
-                text_to_gpt.append('[image]')
-            elif mark == 'error':
-                text_to_gpt.append(delete_color_control_char(out_str))
-
-        return '\n'.join(text_to_gpt), content_to_display
+                    interrupted_at = time.time()
+                self.interrupt_signal = False
+
+                try:
+                    iopub_msg = iopub_channel.get_msg(timeout=0)
+                except queue.Empty:
+                    break
+                if iopub_msg['parent_header'].get('msg_id') != msg_id:
+                    continue
+                if iopub_msg['msg_type'] == 'status':
+                    execution_state = iopub_msg['content'].get('execution_state')
+                    if execution_state == 'busy' and started_at is None:
+                        started_at = time.time()
+                        if not silent:
+                            observe(self.metrics, 'lci_kernel_queue_seconds', started_at - sent_at)
+                    elif execution_state == 'idle':
+                        if started_at is not None and not silent:
+                            observe(self.metrics, 'lci_kernel_execution_seconds', time.time() - started_at)
+                        return
+                if iopub_msg['msg_type'] == 'display_data' and ROLLBACK_MIMETYPE in iopub_msg['content']['data']:
+                    self._observe_rollback(iopub_msg['content']['data'][ROLLBACK_MIMETYPE])
+                yield from get_outputs_from_iopub_msg(iopub_msg)
+
+            if deadline is not None and interrupted_at is None and time.time() >= deadline:
+                self.kernel_manager.interrupt_kernel()
+                interrupted_at = time.time()
+                yield 'error', f'TimeoutError: Code execution exceeded the time limit of {timeout} seconds'
+
+            if interrupted_at is not None and time.time() - interrupted_at >= INTERRUPT_GRACE_PERIOD:
+                yield 'error', 'KernelError: The kernel did not respond to the interrupt and has been restarted, ' \
+                               f'{self.lost_variables_message()}'
+                self.restart_jupyter_kernel()
+                return
+
+            if not events and not self.kernel_manager.is_alive():
+                yield 'error', f'KernelError: The kernel died unexpectedly and has been restarted, ' \
+                               f'{self.lost_variables_message()}'
+                self.restart_jupyter_kernel()
+                return
+
+    def _observe_rollback(self, report):
+        observe(self.metrics, 'lci_cell_fork_seconds', report['fork_seconds'])
+        if report['rollback_seconds'] is not None:
+            observe(self.metrics, 'lci_cell_rollback_seconds', report['rollback_seconds'])
+
+    async def wait_for_output(self):
+        """
+        Wait, without holding a thread, until the cooperative execution that yielded KERNEL_WAIT can go on.
+        """
+        poller = zmq.asyncio.Poller()
+        poller.register(self.kernel_client.iopub_channel.socket, zmq.POLLIN)
+        poller.register(self._interrupt_receiver, zmq.POLLIN)
+        await poller.poll((self.wait_timeout or 0) * 1000)
+
+    def create_output_collector(self):
+        self.cell_count += 1
+        log_path = os.path.join(self.work_dir, f'cell_{self.cell_count}_output.log')
+        return OutputCollector(log_path=log_path, buffer_size=self.output_buffer_size)
+
+    def execute_code_(self, code, timeout=None):
+        output_collector = self.create_output_collector()
+        for output in self.execute_code_stream(code, timeout=timeout):
+            output_collector.add(output)
+        return output_collector.get_outputs()
+
+    def execute_code(self, code, timeout=None):
+        content_to_display = self.execute_code_(code, timeout=timeout)
+        return get_text_to_gpt(content_to_display), content_to_display
 
     def _create_work_dir(self):
         # set work dir in jupyter environment
@@ -96,13 +371,81 @@ class JupyterKernel:
                     f"    os.mkdir('{self.work_dir}')\n" \
                     f"os.chdir('{self.work_dir}')\n" \
                     f"del os"
-        self.execute_code_(init_code)
+        for _ in self._execute_code_stream(init_code):
+            pass
+
+    def _init_kernel(self):
+        self._create_work_dir()
+        if self.cell_rollback:
+            self.kernel_client.execute(rollback_install_code(), silent=True, store_history=False)
+        if self.checkpoint is not None:
+            self.kernel_client.execute(self.checkpoint.restore_code(), silent=True, store_history=False)
+
+    def lost_variables_message(self):
+        """
+        :return: what happens to the variables when the session gets a new kernel
+        """
+        restored = self.checkpoint.describe() if self.checkpoint is not None else None
+        if restored is None:
+            return 'all variables are lost'
+        return f'{restored}, the other variables are lost'
+
+    def _start_kernel(self):
+        if self.kernel_pool is not None:
+            return self.kernel_pool.acquire()
+        return jupyter_client.manager.start_new_kernel(kernel_name='python3')
+
+    def _shutdown_kernel(self):
+        if self.suspended or self.closed:
+            return
+        if self.kernel_pool is not None:
+            self.kernel_pool.discard(self.kernel_manager, self.kernel_client)
+        else:
+            self.kernel_client.shutdown()
+
+    def suspend(self):
+        """
+        Shut down the kernel to free its memory, unless it is executing code. The next execution starts a new kernel:
+        the variables are lost, the files of the work dir are kept.
+        :return: whether the kernel was shut down
+        """
+        with self._state_lock:
+            if self.suspended or self.closed or self.running_executions:
+                return False
+            self._shutdown_kernel()
+            self.kernel_manager = self.kernel_client = None
+            self.suspended = True
+            self.suspend_count += 1
+            return True
+
+    def shutdown(self):
+        """
+        Shut down the kernel when its session is closed. Later restarts and suspensions do nothing, executions fail.
+        """
+        with self._state_lock:
+            if self.closed:
+                return
+            self._shutdown_kernel()
+            self.closed = True
+
+    def kernel_pid(self):
+        process = getattr(getattr(self.kernel_manager, 'provisioner', None), 'process', None)
+        return getattr(process, 'pid', None)
 
     def send_interrupt_signal(self):
         self.interrupt_signal = True
+        with self._interrupt_sender_lock:
+            try:
+                self._interrupt_sender.send(b'', zmq.NOBLOCK)
+            except zmq.Again:
+                # the poller has not consumed the previous wake-ups yet, it will see the flag anyway
+                pass
 
     def restart_jupyter_kernel(self):
-        self.kernel_client.shutdown()
-        self.kernel_manager, self.kernel_client = jupyter_client.manager.start_new_kernel(kernel_name='python3')
+        if self.suspended or self.closed:
+            # the next execution starts a new kernel anyway, or there is none
+            return
+        self._shutdown_kernel()
+        self.kernel_manager, self.kernel_client = self._start_kernel()
         self.interrupt_signal = False
-        self._create_work_dir()
+        self._init_kernel()
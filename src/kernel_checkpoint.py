@@ -0,0 +1,247 @@
+"""
+Checkpoints of the user namespace of the kernels, enabled by the "kernel_checkpoint" config. After each successful code
+execution, the variables the code may have changed are serialized into the session cache, one file per variable, with
+dill if it is installed, otherwise with pickle. Imported modules are recorded by name. Objects larger than the size
+limit, of a skipped type, or that cannot be serialized are left out. When a session gets a new kernel (after a crash, a
+restart or the suspension of an idle session), the namespace is restored in one execution.
+
+This file is also loaded in the kernels as the module `_lci_checkpoint`, where the functions after `KernelCheckpoint`
+run. It only imports the standard library and `kernel_namespace.py`.
+"""
+import os
+import ast
+import sys
+import json
+import types
+import shutil
+import hashlib
+import importlib
+
+try:
+    import _lci_namespace as kernel_namespace  # in the kernels, see `kernel_namespace.install_code`
+except ImportError:
+    import kernel_namespace
+
+INDEX_FILENAME = 'index.json'
+
+
+def load_index(directory):
+    try:
+        with open(os.path.join(directory, INDEX_FILENAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def touched_names(code):
+    """
+    :return: the names a cell may have changed (those it refers to), None if the code cannot be parsed (e.g. magics)
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+    return sorted(names)
+
+
+class KernelCheckpoint:
+    def __init__(self, directory, max_object_bytes=None, skip_types=()):
+        self.directory = os.path.abspath(directory)
+        self.max_object_bytes = max_object_bytes
+        self.skip_types = list(skip_types)
+
+    def restore_code(self):
+        """
+        :return: code loading this module in a new kernel and restoring the namespace of the checkpoint, if any
+        """
+        return kernel_namespace.install_code(
+            '_lci_checkpoint', __file__,
+            f'configure({self.directory!r}, {self.max_object_bytes!r}, {self.skip_types!r})', 'restore()'
+        )
+
+    @staticmethod
+    def save_code(code):
+        """
+        :return: code saving the variables changed by `code`
+        """
+        return f"__import__('_lci_checkpoint').save({touched_names(code)!r})"
+
+    def describe(self):
+        """
+        :return: what a new kernel gets from the checkpoint, for messages to the model, None if nothing
+        """
+        index = load_index(self.directory)
+        if not index or not (index['variables'] or index['modules']):
+            return None
+        description = 'the variables saved after the last successful execution are restored in the new kernel: ' + \
+                      ', '.join(sorted(set(index['variables']) | set(index['modules'])))
+        if index['skipped']:
+            description += f' (not restored: {", ".join(sorted(index["skipped"]))})'
+        return description
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def create_kernel_checkpoint(checkpoint_config, directory):
+    """
+    :return: the checkpoint of a session if enabled in the "kernel_checkpoint" config, otherwise None
+    """
+    if not (checkpoint_config or {}).get('enabled'):
+        return None
+    max_object_mb = checkpoint_config.get('max_object_mb', 100)
+    return KernelCheckpoint(
+        directory=directory,
+        max_object_bytes=int(max_object_mb * 1024 ** 2) if max_object_mb is not None else None,
+        skip_types=checkpoint_config.get('skip_types', [])
+    )
+
+
+# kernel side
+
+_directory = None
+_max_object_bytes = None
+_skip_types = set()
+_index = {'variables': {}, 'modules': {}, 'skipped': {}}  # name -> hash and size, module name, reason
+_ids = {}  # name -> id of the object when it was last saved
+
+
+class _SizeLimitExceeded(Exception):
+    pass
+
+
+class _HashingWriter:
+    def __init__(self, file, limit):
+        self.file = file
+        self.limit = limit
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit is not None and self.size > self.limit:
+            raise _SizeLimitExceeded()
+        self.hash.update(data)
+        return self.file.write(data)
+
+
+def _variable_path(name):
+    return os.path.join(_directory, f'{name}.pkl')
+
+
+def _write_index():
+    temp_path = os.path.join(_directory, INDEX_FILENAME + '.tmp')
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(_index, f)
+    os.replace(temp_path, os.path.join(_directory, INDEX_FILENAME))
+
+
+def _forget(name):
+    for entries in _index.values():
+        entries.pop(name, None)
+    _ids.pop(name, None)
+    if os.path.exists(_variable_path(name)):
+        os.remove(_variable_path(name))
+
+
+def _save_variable(name, value):
+    """
+    :return: whether the index changed
+    """
+    value_type = type(value)
+    reason = None
+    if f'{value_type.__module__}.{value_type.__qualname__}' in _skip_types:
+        reason = 'skipped type'
+    elif _max_object_bytes is not None and sys.getsizeof(value) > _max_object_bytes:
+        reason = 'too large'
+    else:
+        temp_path = _variable_path(name) + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                writer = _HashingWriter(f, _max_object_bytes)
+                kernel_namespace.serializer().dump(value, writer)
+        except _SizeLimitExceeded:
+            reason = 'too large'
+        except Exception as e:
+            reason = f'cannot be serialized ({type(e).__name__})'
+        if reason is not None:
+            os.remove(temp_path)
+        else:
+            entry = {'hash': writer.hash.hexdigest(), 'size': writer.size}
+            if _index['variables'].get(name) == entry:
+                os.remove(temp_path)
+                return False
+            os.replace(temp_path, _variable_path(name))
+            _index['modules'].pop(name, None)
+            _index['skipped'].pop(name, None)
+            _index['variables'][name] = entry
+            return True
+    if _index['skipped'].get(name) == reason:
+        return False
+    _forget(name)
+    _index['skipped'][name] = reason
+    return True
+
+
+def configure(directory, max_object_bytes=None, skip_types=()):
+    global _directory, _max_object_bytes, _skip_types
+    _directory = directory
+    _max_object_bytes = max_object_bytes
+    _skip_types = set(skip_types)
+    os.makedirs(directory, exist_ok=True)
+
+
+def save(touched=None):
+    """
+    Save the variables that are new, rebound, or among the `touched` names, None for all of them.
+    """
+    namespace, names = kernel_namespace.user_namespace()
+    changed = False
+    for name in set(_index['variables']) | set(_index['modules']) | set(_index['skipped']):
+        if name not in names:
+            _forget(name)
+            changed = True
+    for name in names:
+        value = namespace[name]
+        if isinstance(value, types.ModuleType):
+            if _index['modules'].get(name) != value.__name__:
+                _forget(name)
+                _index['modules'][name] = value.__name__
+                changed = True
+            continue
+        if touched is not None and name not in touched and _ids.get(name) == id(value):
+            continue
+        _ids[name] = id(value)
+        changed |= _save_variable(name, value)
+    if changed:
+        _write_index()
+
+
+def restore():
+    global _index
+    index = load_index(_directory)
+    if index is None:
+        return
+    namespace, _ = kernel_namespace.user_namespace()
+    for name, module_name in index['modules'].items():
+        try:
+            namespace[name] = importlib.import_module(module_name)
+        except Exception:
+            pass
+    serializer = kernel_namespace.serializer()
+    for name in list(index['variables']):
+        try:
+            with open(_variable_path(name), 'rb') as f:
+                namespace[name] = serializer.load(f)
+            _ids[name] = id(namespace[name])
+        except Exception as e:
+            del index['variables'][name]
+            index['skipped'][name] = f'cannot be restored ({type(e).__name__})'
+    _index = index
+    _write_index()
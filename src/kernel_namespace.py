@@ -0,0 +1,49 @@
+"""
+Helpers shared by the modules loaded in the kernels (`kernel_checkpoint.py`, `kernel_rollback.py`). `install_code`
+loads this file in a kernel as the module `_lci_namespace` before loading one of them. It only imports the standard
+library.
+"""
+import os
+
+NAMESPACE_MODULE_NAME = '_lci_namespace'
+
+
+def install_code(module_name, module_path, *calls):
+    """
+    :return: code loading the file `module_path` in a kernel as the module `module_name`, along with this module, then
+    running the `calls` of its functions
+    """
+    modules = [(NAMESPACE_MODULE_NAME, os.path.abspath(__file__)), (module_name, os.path.abspath(module_path))]
+    return f"def _lci_install():\n" \
+           f"    import sys, importlib.util\n" + \
+           ''.join(
+               f"    spec = importlib.util.spec_from_file_location({name!r}, {path!r})\n"
+               f"    module = importlib.util.module_from_spec(spec)\n"
+               f"    spec.loader.exec_module(module)\n"
+               f"    sys.modules[{name!r}] = module\n"
+               for name, path in modules
+           ) + \
+           ''.join(f"    module.{call}\n" for call in calls) + \
+           f"_lci_install()\n" \
+           f"del _lci_install"
+
+
+# kernel side
+
+def serializer():
+    try:
+        import dill
+        return dill
+    except ImportError:
+        import pickle
+        return pickle
+
+
+def user_namespace():
+    """
+    :return: the namespace of the user, the names of the user variables in it
+    """
+    from IPython import get_ipython
+    shell = get_ipython()
+    names = {name for name in shell.user_ns if not name.startswith('_') and name not in shell.user_ns_hidden}
+    return shell.user_ns, names
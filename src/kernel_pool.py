@@ -0,0 +1,194 @@
+import atexit
+import threading
+import time
+import jupyter_client
+from metrics import register_collector
+
+# seconds the pool waits after a kernel failed to start, doubled after each consecutive failure up to the maximum
+REFILL_RETRY_DELAY = 1.0
+REFILL_MAX_RETRY_DELAY = 60.0
+
+
+def build_bootstrap_code(bootstrap):
+    """
+    Translate the "bootstrap" profile of the "kernel_pool" config into code snippets. Each snippet is executed
+    separately, so a package missing from the environment does not prevent the rest of the profile from running.
+    """
+    snippets = []
+    for module in bootstrap.get('imports', []):
+        snippets.append(f'import {module}')
+
+    matplotlib_backend = bootstrap.get('matplotlib_backend')
+    if matplotlib_backend:
+        snippets.append(f'%matplotlib {matplotlib_backend}')
+
+    pandas_options = bootstrap.get('pandas_options', {})
+    if pandas_options:
+        lines = ['import pandas as _pd']
+        for option, value in pandas_options.items():
+            lines.append(f'_pd.set_option({option!r}, {value!r})')
+        lines.append('del _pd')
+        snippets.append('\n'.join(lines))
+
+    for code in bootstrap.get('code', []):
+        snippets.append(code)
+
+    return snippets
+
+
+def shutdown_kernel(kernel_manager, kernel_client):
+    try:
+        kernel_client.stop_channels()
+        kernel_manager.shutdown_kernel(now=True)
+    except Exception:
+        pass
+
+
+class KernelPool:
+    """
+    Keeps `size` idle kernels started and bootstrapped in the background, so that new sessions and restarts do not
+    wait for a cold kernel start.
+    """
+
+    def __init__(self, size=1, kernel_name='python3', bootstrap=None):
+        self.size = size
+        self.kernel_name = kernel_name
+        self.bootstrap_code = build_bootstrap_code(bootstrap or {})
+        self._idle_kernels = []
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self.hits = 0
+        self.misses = 0
+        self.refill_count = 0
+        self.refill_time_total = 0.0
+        self.refill_time_max = 0.0
+        self.refill_time_last = 0.0
+
+        self._refill_thread = threading.Thread(target=self._refill_loop, name='kernel-pool-refill', daemon=True)
+        self._refill_thread.start()
+        atexit.register(self.shutdown)
+
+    def _start_kernel(self):
+        kernel_manager, kernel_client = jupyter_client.manager.start_new_kernel(kernel_name=self.kernel_name)
+        try:
+            for code in self.bootstrap_code:
+                kernel_client.execute_interactive(
+                    code, silent=True, store_history=False, timeout=60, output_hook=lambda msg: None
+                )
+        except Exception:
+            # e.g. a snippet timed out or the kernel died
+            shutdown_kernel(kernel_manager, kernel_client)
+            raise
+        return kernel_manager, kernel_client
+
+    def _refill_loop(self):
+        retry_delay = REFILL_RETRY_DELAY
+        while True:
+            with self._condition:
+                while not self._closed and len(self._idle_kernels) >= self.size:
+                    self._condition.wait()
+                if self._closed:
+                    return
+
+            start_time = time.time()
+            try:
+                kernel = self._start_kernel()
+            except Exception as e:
+                print(f'Kernel pool failed to start a kernel, retrying in {retry_delay:.0f}s: {e}')
+                with self._condition:
+                    self._condition.wait_for(lambda: self._closed, timeout=retry_delay)
+                retry_delay = min(retry_delay * 2, REFILL_MAX_RETRY_DELAY)
+                continue
+            retry_delay = REFILL_RETRY_DELAY
+            refill_time = time.time() - start_time
+
+            with self._condition:
+                self.refill_count += 1
+                self.refill_time_total += refill_time
+                self.refill_time_max = max(self.refill_time_max, refill_time)
+                self.refill_time_last = refill_time
+                if self._closed:
+                    shutdown_kernel(*kernel)
+                    return
+                self._idle_kernels.append(kernel)
+                self._condition.notify_all()
+
+    def acquire(self):
+        """
+        :return: (kernel_manager, kernel_client) of a bootstrapped kernel, started on the spot if the pool is empty
+        """
+        with self._condition:
+            while self._idle_kernels:
+                kernel_manager, kernel_client = self._idle_kernels.pop(0)
+                self._condition.notify_all()
+                if kernel_manager.is_alive():
+                    self.hits += 1
+                    return kernel_manager, kernel_client
+                shutdown_kernel(kernel_manager, kernel_client)
+            self.misses += 1
+            self._condition.notify_all()
+
+        return self._start_kernel()
+
+    def discard(self, kernel_manager, kernel_client):
+        """
+        Shut down a kernel taken from the pool without blocking the caller.
+        """
+        threading.Thread(target=shutdown_kernel, args=(kernel_manager, kernel_client), daemon=True).start()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'size': self.size,
+                'idle': len(self._idle_kernels),
+                'hits': self.hits,
+                'misses': self.misses,
+                'refill_count': self.refill_count,
+                'refill_time_avg': self.refill_time_total / self.refill_count if self.refill_count else 0.0,
+                'refill_time_max': self.refill_time_max,
+                'refill_time_last': self.refill_time_last,
+            }
+
+    def metric_samples(self):
+        with self._condition:
+            return [
+                ('lci_kernel_pool_size', 'gauge', 'Target number of pre-started kernels', self.size, {}),
+                ('lci_kernel_pool_idle', 'gauge', 'Pre-started kernels waiting for a session',
+                 len(self._idle_kernels), {}),
+                ('lci_kernel_pool_hits_total', 'counter', 'Sessions given a pre-started kernel', self.hits, {}),
+                ('lci_kernel_pool_misses_total', 'counter', 'Sessions that had to start a kernel', self.misses, {}),
+                ('lci_kernel_pool_refills_total', 'counter', 'Kernels started to refill the pool',
+                 self.refill_count, {}),
+                ('lci_kernel_pool_refill_seconds_total', 'counter', 'Time spent refilling the pool',
+                 self.refill_time_total, {}),
+            ]
+
+    def shutdown(self):
+        with self._condition:
+            self._closed = True
+            idle_kernels, self._idle_kernels = self._idle_kernels, []
+            self._condition.notify_all()
+        for kernel in idle_kernels:
+            shutdown_kernel(*kernel)
+
+
+_kernel_pool = None
+_kernel_pool_lock = threading.Lock()
+
+
+def get_kernel_pool(pool_config=None):
+    """
+    Return the process-wide kernel pool, creating it from the "kernel_pool" config on first use.
+    """
+    global _kernel_pool
+    with _kernel_pool_lock:
+        if _kernel_pool is None:
+            pool_config = pool_config or {}
+            _kernel_pool = KernelPool(
+                size=pool_config.get('size', 1),
+                kernel_name=pool_config.get('kernel_name', 'python3'),
+                bootstrap=pool_config.get('bootstrap')
+            )
+            register_collector(_kernel_pool.metric_samples)
+        return _kernel_pool
@@ -0,0 +1,221 @@
+"""
+Rollback of failed code cells, enabled by the "cell_rollback" config (POSIX only). Before each cell, the kernel forks:
+the child process holds a copy-on-write copy of the user namespace and waits. After the cell, the session either adopts
+the new state (the child exits) or rolls back: the child serializes the variables the cell may have changed and the
+parent puts them back, the variables created by the cell are removed. The rollback policy of the session decides, see
+ROLLBACK_POLICIES. The cost of the fork and of the rollback is reported for each cell.
+
+A forked kernel cannot take over the connections of its parent, so the pre-cell state is copied back into the running
+kernel rather than the child replacing it: a rollback takes time in proportion to the size of the variables it
+restores, and variables that cannot be pickled are not restored.
+
+The kernel runs several threads, and only the forking thread exists in the child. If another thread held a lock when
+the kernel forked (e.g. one used by the `__reduce__` of a variable), serializing in the child can deadlock: the child
+is killed after ROLLBACK_TIMEOUT seconds, and the variables are then not restored.
+
+This file is also loaded in the kernels as the module `_lci_rollback`, where the functions after `finish_code` run.
+It only imports the standard library and `kernel_namespace.py`.
+"""
+import os
+import json
+import time
+import types
+import select
+import signal
+
+try:
+    import _lci_namespace as kernel_namespace  # in the kernels, see `kernel_namespace.install_code`
+except ImportError:
+    import kernel_namespace
+
+# mimetype of the display data reporting the cost of a cell rollback, not shown to the model or the user
+ROLLBACK_MIMETYPE = 'application/vnd.lci.rollback+json'
+# seconds the kernel waits for the forked process to send back the variables of a rollback
+ROLLBACK_TIMEOUT = 60
+# whether the changes of a cell are rolled back (the fork is adopted) or kept (the fork is discarded), per policy:
+# "on_failure" rolls back the cells that fail, "always" every cell (the state never changes), "never" none of them, and
+# the kernel does not fork
+ROLLBACK_POLICIES = {
+    'on_failure': lambda failed: failed,
+    'always': lambda failed: True,
+    'never': lambda failed: False,
+}
+
+
+def rollback_install_code():
+    return kernel_namespace.install_code('_lci_rollback', __file__)
+
+
+def fork_code(code):
+    """
+    :return: code keeping the state of the kernel before `code` runs
+    """
+    from kernel_checkpoint import touched_names
+    return f"__import__('_lci_rollback').fork({touched_names(code)!r})"
+
+
+def finish_code(roll_back):
+    """
+    :return: code rolling back the last code cell if `roll_back`, otherwise keeping its changes
+    """
+    return f"__import__('_lci_rollback').finish({roll_back!r})"
+
+
+# kernel side
+
+_child = None
+
+
+def _run_child(command_fd, result_fd):
+    """
+    Wait for the names to send back to the parent, or for the parent to close the pipe. Never returns.
+    """
+    try:
+        # interrupts of the kernel are sent to its process group
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        with os.fdopen(command_fd, 'rb') as f:
+            command = f.read()
+        if command:
+            namespace, _ = kernel_namespace.user_namespace()
+            serializer = kernel_namespace.serializer()
+            values = {}
+            for name in json.loads(command):
+                try:
+                    values[name] = serializer.dumps(namespace[name])
+                except Exception:
+                    values[name] = None
+            with os.fdopen(result_fd, 'wb') as f:
+                serializer.dump(values, f)
+    finally:
+        os._exit(0)
+
+
+def fork(touched=None):
+    """
+    Keep the current state in a child process. `touched` are the names the next cell may change, None for all of them.
+    """
+    global _child
+    if _child is not None:
+        _close(_child)
+        _child = None
+    if not hasattr(os, 'fork'):
+        return
+    namespace, names = kernel_namespace.user_namespace()
+    started_at = time.perf_counter()
+    command_read, command_write = os.pipe()
+    result_read, result_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(command_write)
+        os.close(result_read)
+        _run_child(command_read, result_write)
+    os.close(command_read)
+    os.close(result_write)
+    _child = {
+        'pid': pid,
+        'command_fd': command_write,
+        'result_fd': result_read,
+        'ids': {name: id(namespace[name]) for name in names},
+        'touched': set(touched) if touched is not None else None,
+        'fork_seconds': time.perf_counter() - started_at,
+    }
+
+
+def _close(child):
+    """
+    Close the pipes to the child, kill it and wait for it.
+    """
+    for fd in (child['command_fd'], child['result_fd']):
+        if fd is None:
+            continue
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    try:
+        os.kill(child['pid'], signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    os.waitpid(child['pid'], 0)
+
+
+def _read_result(fd, timeout):
+    """
+    :return: what the child wrote until it closed the pipe, None if it did not within `timeout` seconds
+    """
+    chunks = []
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+            return None
+        chunk = os.read(fd, 1 << 20)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def _roll_back(child):
+    namespace, names = kernel_namespace.user_namespace()
+    restored_names = []
+    for name, object_id in child['ids'].items():
+        value = namespace.get(name)
+        unchanged = name in names and id(value) == object_id
+        if unchanged and (isinstance(value, types.ModuleType) or
+                          child['touched'] is not None and name not in child['touched']):
+            continue
+        restored_names.append(name)
+    try:
+        with os.fdopen(child['command_fd'], 'wb') as f:
+            f.write(json.dumps(restored_names).encode())
+    except BrokenPipeError:
+        # the child is gone (e.g. killed for lack of memory), nothing can be restored
+        pass
+    child['command_fd'] = None
+    # None if the child is deadlocked, it is killed
+    data = _read_result(child['result_fd'], ROLLBACK_TIMEOUT)
+    _close(child)
+    serializer = kernel_namespace.serializer()
+    values = serializer.loads(data) if data else {}
+    restored, not_restored = [], []
+    for name in restored_names:
+        try:
+            namespace[name] = serializer.loads(values[name])
+            restored.append(name)
+        except Exception:
+            not_restored.append(name)
+    removed = sorted(name for name in names if name not in child['ids'])
+    for name in removed:
+        del namespace[name]
+    return restored, not_restored, removed
+
+
+def finish(roll_back):
+    """
+    Roll back the state of the kernel to before the last cell if `roll_back`, otherwise keep it. Displays the cost of
+    the fork and of the rollback, and what was rolled back.
+    """
+    global _child
+    child, _child = _child, None
+    if child is None:
+        return
+    report = {'fork_seconds': child['fork_seconds'], 'rollback_seconds': None}
+    data = {}
+    if roll_back:
+        started_at = time.perf_counter()
+        restored, not_restored, removed = _roll_back(child)
+        report['rollback_seconds'] = time.perf_counter() - started_at
+        notes = []
+        if restored:
+            notes.append(f'restored to their values before this cell: {", ".join(sorted(restored))}')
+        if removed:
+            notes.append(f'created by this cell and removed: {", ".join(removed)}')
+        if not_restored:
+            notes.append(f'could not be restored: {", ".join(sorted(not_restored))}')
+        if notes:
+            data['text/plain'] = f'[The changes of this cell were rolled back. Variables {"; ".join(notes)}]'
+    else:
+        _close(child)
+    data[ROLLBACK_MIMETYPE] = report
+    from IPython.display import display
+    display(data, raw=True)
@@ -0,0 +1,185 @@
+import json
+import math
+import threading
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.label_names = label_names
+        self._series = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        label_values = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            series = self._series.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series_items = [(label_values, list(counts), total, count)
+                            for label_values, (counts, total, count) in self._series.items()]
+        for label_values, counts, total, count in sorted(series_items):
+            labels = [f'{name}="{value}"' for name, value in zip(self.label_names, label_values)]
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = '+Inf' if upper_bound == math.inf else repr(float(upper_bound))
+                bucket_labels = ','.join(labels + [f'le="{le}"'])
+                lines.append(f'{self.name}_bucket{{{bucket_labels}}} {cumulative}')
+            label_str = '{' + ','.join(labels) + '}' if labels else ''
+            lines.append(f'{self.name}_sum{label_str} {total}')
+            lines.append(f'{self.name}_count{label_str} {count}')
+        return lines
+
+
+METRICS = {histogram.name: histogram for histogram in [
+    Histogram('lci_request_build_seconds', 'Time to slice and tokenize the conversation into a chat completion request'),
+    Histogram('lci_time_to_first_token_seconds', 'Time from sending a chat completion request to the first token'),
+    Histogram('lci_tokens_per_second', 'Streamed chunks (about one token each) per second after the first token',
+              buckets=RATE_BUCKETS),
+    Histogram('lci_kernel_queue_seconds', 'Time from sending code to the kernel to the kernel starting to run it'),
+    Histogram('lci_kernel_execution_seconds', 'Time the kernel spent running a code cell'),
+    Histogram('lci_cell_fork_seconds', 'Time for the kernel to fork before a code cell, for rollbacks'),
+    Histogram('lci_cell_rollback_seconds', 'Time to roll back the variables changed by a failed code cell'),
+    Histogram('lci_tool_seconds', 'Time spent in an additional tool', label_names=('tool',)),
+    Histogram('lci_image_postprocess_seconds', 'Time to save and measure the images of a code cell output'),
+    Histogram('lci_turn_seconds', 'Time to answer a user input, code execution included'),
+    Histogram('lci_ui_frames_per_turn', 'Updates pushed to the browser per user input', buckets=COUNT_BUCKETS),
+    Histogram('lci_ui_coalesced_updates_per_turn', 'Updates merged into a later frame per user input',
+              buckets=COUNT_BUCKETS),
+]}
+
+
+class SessionMetrics:
+    """
+    Summary of the observations of one session. Observations are also recorded in the process-wide histograms.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        METRICS[name].observe(value, **labels)
+        key = name + ''.join(f'[{value}]' for value in labels.values())
+        with self._lock:
+            stats = self._stats.setdefault(key, {'count': 0, 'total': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['total'] += value
+            stats['max'] = max(stats['max'], value)
+
+    def summary(self):
+        with self._lock:
+            return {
+                key: {**stats, 'avg': stats['total'] / stats['count']} for key, stats in sorted(self._stats.items())
+            }
+
+
+def observe(session_metrics, name, value, **labels):
+    """
+    Record an observation in the session summary if there is one, in the process-wide histogram in any case.
+    """
+    if session_metrics is not None:
+        session_metrics.observe(name, value, **labels)
+    else:
+        METRICS[name].observe(value, **labels)
+
+
+_sessions = weakref.WeakValueDictionary()
+_collectors = []
+
+
+def register_session(session_id, session_metrics: SessionMetrics):
+    _sessions[str(session_id)] = session_metrics
+
+
+def register_collector(collector):
+    """
+    Export the counters and gauges of a component (e.g. the kernel pool) at /metrics. `collector()` returns samples
+    (name, type, documentation, value, labels), the type being 'counter' or 'gauge'.
+    """
+    _collectors.append(collector)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_samples(samples):
+    series = {}  # name -> type, documentation, [(labels, value)]
+    for name, metric_type, documentation, value, labels in samples:
+        series.setdefault(name, (metric_type, documentation, []))[2].append((labels, value))
+    lines = []
+    for name, (metric_type, documentation, values) in series.items():
+        lines.extend([f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}'])
+        for labels, value in values:
+            label_str = ','.join(
+                f'{label}="{escape_label_value(label_value)}"'
+                for label, label_value in labels.items()
+            )
+            lines.append(f'{name}{{{label_str}}} {value}' if label_str else f'{name} {value}')
+    return lines
+
+
+def render_prometheus():
+    lines = []
+    for histogram in METRICS.values():
+        lines.extend(histogram.render())
+    samples = []
+    for collector in list(_collectors):
+        try:
+            samples.extend(collector())
+        except Exception as e:
+            print(f'Metrics collection failed: {e}')
+    lines.extend(render_samples(samples))
+    return '\n'.join(lines) + '\n'
+
+
+def render_session_summaries():
+    return json.dumps({session_id: metrics.summary() for session_id, metrics in list(_sessions.items())}, indent=2)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = render_prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/sessions':
+            body, content_type = render_session_summaries(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """
+    Serve the histograms at /metrics (Prometheus text format) and the per-session summaries at /sessions, from a
+    background thread.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
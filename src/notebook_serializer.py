@@ -2,12 +2,18 @@ import nbformat
 from nbformat import v4 as nbf
 import ansi2html
 import os
+import time
+import base64
+import atexit
+import weakref
 import argparse
+import threading
+import collections
 
 # main code
 parser = argparse.ArgumentParser()
 parser.add_argument("-n", "--notebook", help="Path to the output notebook", default=None, type=str)
-args = parser.parse_args()
+args, _ = parser.parse_known_args()
 if args.notebook:
     notebook_path = os.path.join(os.getcwd(), args.notebook)
     base, ext = os.path.splitext(notebook_path)
@@ -17,55 +23,303 @@ if args.notebook:
         print(f'File at {notebook_path} already exists. Please choose a different file name.')
         exit()
 
-# Global variable for code cells
-nb = nbf.new_notebook()
+# minimum interval (in seconds) between two writes of a notebook file
+NOTEBOOK_FLUSH_INTERVAL = 2.0
+# number of characters of notebook content a session keeps in memory, larger outputs are moved to the session cache
+NOTEBOOK_MEMORY_LIMIT = 4000000
+
+ansi_converter = ansi2html.Ansi2HTMLConverter()
+ansi_converter_lock = threading.Lock()
 
 
 def ansi_to_html(ansi_text):
-    converter = ansi2html.Ansi2HTMLConverter()
-    html_text = converter.convert(ansi_text)
-    return html_text
+    with ansi_converter_lock:
+        return ansi_converter.convert(ansi_text)
+
+
+class FileReference:
+    """
+    Output data kept in a file of the session cache, read back only when the notebook is exported.
+    Binary files (images) are exported base64 encoded.
+    """
+
+    def __init__(self, path, binary=False):
+        self.path = path
+        self.binary = binary
+
+    def read(self):
+        if self.binary:
+            with open(self.path, 'rb') as f:
+                return base64.b64encode(f.read()).decode()
+        with open(self.path, encoding='utf-8') as f:
+            return f.read()
+
+
+class NotebookRecorder:
+    """
+    Records the notebook of one session. Images are referenced by their file in the session cache, and HTML outputs
+    and tracebacks are moved there too when the content kept in memory exceeds `memory_limit` characters. They are
+    inlined when the notebook is exported, which the notebook writer thread does at most once per
+    NOTEBOOK_FLUSH_INTERVAL and on exit.
+    """
+
+    def __init__(self, path, cache_dir, memory_limit=NOTEBOOK_MEMORY_LIMIT):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.nb = nbf.new_notebook()
+        self.memory_usage = 0  # characters of notebook content kept in memory
+        self.image_count = 0
+        self.spilled_count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending_html = []  # (output, ansi_text) waiting to be converted
+        self._spillable_outputs = collections.deque()  # HTML and error outputs kept in memory, oldest first
+        self._closed = False
+
+    def add_cell(self, cell):
+        with self._lock:
+            self.nb['cells'].append(cell)
+            self.memory_usage += len(cell['source'])
+        notebook_writer.schedule(self)
+
+    def add_output(self, output):
+        with self._lock:
+            self.nb['cells'][-1]['outputs'].append(output)
+            self.memory_usage += sum(len(line) for line in output.get('traceback', []))
+            if output['output_type'] == 'error':
+                self._spillable_outputs.append(output)
+        notebook_writer.schedule(self)
+
+    def add_ansi_output(self, ansi_text):
+        output = nbf.new_output(output_type='display_data', data={'text/html': ''})
+        with self._lock:
+            self.nb['cells'][-1]['outputs'].append(output)
+            self._pending_html.append((output, ansi_text))
+            self.memory_usage += len(ansi_text)
+        notebook_writer.schedule(self)
+
+    def add_image_file(self, path, mime_type):
+        # built directly, `new_output` would validate the data
+        output = nbformat.NotebookNode(
+            output_type='display_data', data={mime_type: FileReference(path, binary=True)}, metadata={}
+        )
+        with self._lock:
+            self.nb['cells'][-1]['outputs'].append(output)
+            self.image_count += 1
+        notebook_writer.schedule(self)
+
+    def _convert_pending_html(self):
+        with self._lock:
+            pending_html, self._pending_html = self._pending_html, []
+        for output, ansi_text in pending_html:
+            html_text = ansi_to_html(ansi_text)
+            with self._lock:
+                output['data']['text/html'] = html_text
+                self.memory_usage += len(html_text) - len(ansi_text)
+                self._spillable_outputs.append(output)
+
+    def _spill_outputs(self):
+        while True:
+            with self._lock:
+                if self.memory_usage <= self.memory_limit or not self._spillable_outputs:
+                    return
+                output = self._spillable_outputs.popleft()
+                self.spilled_count += 1
+                if output['output_type'] == 'error':
+                    # the traceback is displayed with its lines joined, it is read back as a single line
+                    text = '\n'.join(output['traceback'])
+                    size = sum(len(line) for line in output['traceback'])
+                    spilled_path = os.path.join(self.cache_dir, f'notebook_output_{self.spilled_count}.txt')
+                else:
+                    text = output['data']['text/html']
+                    size = len(text)
+                    spilled_path = os.path.join(self.cache_dir, f'notebook_output_{self.spilled_count}.html')
+            with open(spilled_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            with self._lock:
+                if output['output_type'] == 'error':
+                    output['traceback'] = FileReference(spilled_path)
+                else:
+                    output['data']['text/html'] = FileReference(spilled_path)
+                self.memory_usage -= size
+
+    @staticmethod
+    def _export_output(output):
+        if isinstance(output.get('traceback'), FileReference):
+            return nbf.new_output(
+                output_type='error', ename=output['ename'], evalue=output['evalue'],
+                traceback=[output['traceback'].read()]
+            )
+        data = output.get('data', {})
+        if not any(isinstance(value, FileReference) for value in data.values()):
+            return output
+        exported_data = {
+            mime_type: value.read() if isinstance(value, FileReference) else value for mime_type, value in data.items()
+        }
+        return nbf.new_output(output_type=output['output_type'], data=exported_data)
+
+    def export(self):
+        """
+        :return: the notebook as a string, with the data kept in files inlined
+        """
+        with self._lock:
+            cells = [(cell, list(cell.get('outputs', []))) for cell in self.nb['cells']]
+            metadata = self.nb['metadata']
+        exported_cells = []
+        for cell, outputs in cells:
+            if cell['cell_type'] == 'code':
+                exported_cell = nbf.new_code_cell(source=cell['source'])
+                exported_cell['outputs'] = [self._export_output(output) for output in outputs]
+                exported_cells.append(exported_cell)
+            else:
+                exported_cells.append(cell)
+        return nbformat.writes(nbf.new_notebook(cells=exported_cells, metadata=metadata))
+
+    def flush(self):
+        with self._flush_lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._convert_pending_html()
+            self._spill_outputs()
+            content = self.export()
+
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(temp_path, self.path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'cells': len(self.nb['cells']),
+                'images': self.image_count,
+                'memory_usage': self.memory_usage,
+                'memory_limit': self.memory_limit,
+                'spilled_outputs': self.spilled_count,
+            }
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        stats = self.stats()
+        print(f'Notebook saved to {self.path} ({stats["cells"]} cells, {stats["images"]} images, '
+              f'{stats["memory_usage"]} characters in memory, {stats["spilled_outputs"]} outputs moved to cache)')
+
+
+class NotebookWriter:
+    """
+    Background thread that writes the notebooks of all sessions. Changes are batched, each notebook is rewritten at
+    most once per `flush_interval` seconds, and all of them are written on exit.
+    """
+
+    def __init__(self, flush_interval=NOTEBOOK_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._changed_recorders = set()
+        self._recorders = weakref.WeakSet()
+        self._condition = threading.Condition()
+        self._thread = None
+        atexit.register(self.close)
+
+    def schedule(self, recorder: NotebookRecorder):
+        with self._condition:
+            self._recorders.add(recorder)
+            self._changed_recorders.add(recorder)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_loop, name='notebook-writer', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._changed_recorders:
+                    self._condition.wait()
+            # let the changes that follow closely be written together
+            time.sleep(self.flush_interval)
+            with self._condition:
+                changed_recorders, self._changed_recorders = self._changed_recorders, set()
+            for recorder in changed_recorders:
+                try:
+                    recorder.flush()
+                except Exception as e:
+                    print(f'Failed to write notebook {recorder.path}: {e}')
+
+    def close(self):
+        with self._condition:
+            recorders = list(self._recorders)
+            self._changed_recorders = set()
+        for recorder in recorders:
+            recorder.close()
+
+
+notebook_writer = NotebookWriter()
+_session_count = 0
+_session_count_lock = threading.Lock()
+
+
+def session_notebook_path(session_number):
+    if session_number == 1:
+        return notebook_path
+    return f'{os.path.splitext(notebook_path)[0]}_{session_number}.ipynb'
+
+
+def reserve_session_number():
+    """
+    :return: the number of a new session, the first one whose notebook does not exist yet
+    """
+    global _session_count
+    with _session_count_lock:
+        while True:
+            _session_count += 1
+            if _session_count == 1 or not os.path.exists(session_notebook_path(_session_count)):
+                return _session_count
 
 
-def write_to_notebook():
-    if args.notebook:
-        with open(notebook_path, 'w', encoding='utf-8') as f:
-            nbformat.write(nb, f)
+def create_notebook_recorder(cache_dir, session_number=None):
+    """
+    :param session_number: given if the session was numbered by another process (see session_workers.py)
+    :return: a notebook recorder for a new session if `--notebook` is given, otherwise None. The first session is
+             saved to the given path, the following ones to the same path with a numbered suffix.
+    """
+    if not args.notebook:
+        return None
+    if session_number is None:
+        session_number = reserve_session_number()
+    return NotebookRecorder(path=session_notebook_path(session_number), cache_dir=cache_dir)
 
 
-def add_code_cell_to_notebook(code):
-    code_cell = nbf.new_code_cell(source=code)
-    nb['cells'].append(code_cell)
-    write_to_notebook()
+def add_code_cell_to_notebook(notebook, code):
+    if notebook:
+        notebook.add_cell(nbf.new_code_cell(source=code))
 
 
-def add_code_cell_output_to_notebook(output):
-    html_content = ansi_to_html(output)
-    cell_output = nbf.new_output(output_type='display_data', data={'text/html': html_content})
-    nb['cells'][-1]['outputs'].append(cell_output)
-    write_to_notebook()
+def add_code_cell_output_to_notebook(notebook, output):
+    if notebook:
+        notebook.add_ansi_output(output)
 
 
-def add_code_cell_error_to_notebook(error):
-    nbf_error_output = nbf.new_output(
-        output_type='error',
-        ename='Error',
-        evalue='Error message',
-        traceback=[error]
-    )
-    nb['cells'][-1]['outputs'].append(nbf_error_output)
-    write_to_notebook()
+def add_code_cell_error_to_notebook(notebook, error):
+    if notebook:
+        nbf_error_output = nbf.new_output(
+            output_type='error',
+            ename='Error',
+            evalue='Error message',
+            traceback=[error]
+        )
+        notebook.add_output(nbf_error_output)
 
 
-def add_image_to_notebook(image, mime_type):
-    image_output = nbf.new_output(output_type='display_data', data={mime_type: image})
-    nb['cells'][-1]['outputs'].append(image_output)
-    write_to_notebook()
+def add_image_to_notebook(notebook, path, mime_type):
+    if notebook:
+        notebook.add_image_file(path, mime_type)
 
 
-def add_markdown_to_notebook(content, title=None):
-    if title:
-        content = "##### " + title + ":\n" + content
-    markdown_cell = nbf.new_markdown_cell(content)
-    nb['cells'].append(markdown_cell)
-    write_to_notebook()
+def add_markdown_to_notebook(notebook, content, title=None):
+    if notebook:
+        if title:
+            content = "##### " + title + ":\n" + content
+        markdown_cell = nbf.new_markdown_cell(content)
+        notebook.add_cell(markdown_cell)
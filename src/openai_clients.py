@@ -0,0 +1,135 @@
+import atexit
+import threading
+import httpx
+import openai
+from metrics import register_collector
+
+
+class ConnectionCounter:
+    """
+    Counts the requests sent through a client and the connections it had to open for them, using the httpcore
+    "trace" extension. Requests that do not open a connection reused a kept-alive one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+
+    def on_request(self, request: httpx.Request):
+        with self._lock:
+            self.requests += 1
+        request.extensions['trace'] = self.trace
+
+    def trace(self, event_name, info):
+        if event_name == 'connection.connect_tcp.complete':
+            with self._lock:
+                self.new_connections += 1
+        elif event_name == 'connection.start_tls.complete':
+            with self._lock:
+                self.tls_handshakes += 1
+
+    def stats(self):
+        with self._lock:
+            reused = max(self.requests - self.new_connections, 0)
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'tls_handshakes': self.tls_handshakes,
+                'reused_connections': reused,
+                'reuse_ratio': reused / self.requests if self.requests else 0.0,
+            }
+
+
+class OpenAIClientRegistry:
+    """
+    Process-wide OpenAI clients, one per (API_TYPE, API_base, API_VERSION, API_KEY). All sessions and tools using the
+    same API settings share a client, and thus its pool of kept-alive HTTP connections.
+    """
+
+    def __init__(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0, timeout=600.0):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(timeout, connect=5.0)
+        self._clients = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _create_client(self, api_type, api_base, api_version, api_key, counter):
+        http_client = openai.DefaultHttpxClient(
+            limits=self.limits, timeout=self.timeout, event_hooks={'request': [counter.on_request]}
+        )
+        if api_type == "azure":
+            return openai.AzureOpenAI(
+                api_version=api_version, azure_endpoint=api_base, api_key=api_key, http_client=http_client
+            )
+        else:
+            return openai.OpenAI(base_url=api_base, api_key=api_key, http_client=http_client)
+
+    def get_client(self, api_type, api_base, api_version, api_key):
+        key = (api_type, api_base, api_version, api_key)
+        with self._lock:
+            if key not in self._clients:
+                counter = ConnectionCounter()
+                self._clients[key] = self._create_client(api_type, api_base, api_version, api_key, counter)
+                self._counters[key] = counter
+            return self._clients[key]
+
+    def stats(self):
+        """
+        :return: connection reuse counters of each client, the API key is left out
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+        return [
+            {'api_type': api_type, 'api_base': api_base, 'api_version': api_version, **counter.stats()}
+            for (api_type, api_base, api_version, api_key), counter in counters
+        ]
+
+    def metric_samples(self):
+        documentation = {
+            'requests': 'API requests sent',
+            'new_connections': 'HTTP connections opened',
+            'tls_handshakes': 'TLS handshakes performed',
+            'reused_connections': 'API requests sent over a kept-alive connection',
+        }
+        samples = []
+        for client_stats in self.stats():
+            labels = {label: client_stats[label] for label in ('api_type', 'api_base', 'api_version')}
+            for name, doc in documentation.items():
+                samples.append((f'lci_openai_{name}_total', 'counter', doc, client_stats[name], labels))
+        return samples
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+            self._counters = {}
+        for client in clients:
+            client.close()
+
+
+_client_registry = None
+_client_registry_lock = threading.Lock()
+
+
+def get_client_registry(http_pool_config=None):
+    """
+    Return the process-wide client registry, creating it from the "http_pool" config on first use.
+    """
+    global _client_registry
+    with _client_registry_lock:
+        if _client_registry is None:
+            http_pool_config = http_pool_config or {}
+            _client_registry = OpenAIClientRegistry(
+                max_connections=http_pool_config.get('max_connections', 100),
+                max_keepalive_connections=http_pool_config.get('max_keepalive_connections', 20),
+                keepalive_expiry=http_pool_config.get('keepalive_expiry', 60.0),
+                timeout=http_pool_config.get('timeout', 600.0)
+            )
+            register_collector(_client_registry.metric_samples)
+        return _client_registry
@@ -1,33 +1,38 @@
+import openai
 from functional import *
 
 
 class ChoiceStrategy(metaclass=ABCMeta):
-    def __init__(self, choice):
-        self.choice = choice
-        self.delta = choice.delta
+    """
+    Strategies hold no state, a single instance of each handles every chunk. The state of the response being streamed
+    lives in the bot backend.
+    """
 
     @abstractmethod
-    def support(self):
+    def support(self, choice):
         pass
 
     @abstractmethod
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+    def execute(self, choice, bot_backend: BotBackend, history: List, whether_exit: bool):
+        """
+        Generator, yields (history, whether_exit) every time there is something new to display.
+        """
         pass
 
 
 class RoleChoiceStrategy(ChoiceStrategy):
 
-    def support(self):
-        return self.delta.role is not None
+    def support(self, choice):
+        return choice.delta.role is not None
 
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
-        bot_backend.set_assistant_role_name(assistant_role_name=self.delta.role)
-        return history, whether_exit
+    def execute(self, choice, bot_backend: BotBackend, history: List, whether_exit: bool):
+        bot_backend.set_assistant_role_name(assistant_role_name=choice.delta.role)
+        yield history, whether_exit
 
 
 class ContentChoiceStrategy(ChoiceStrategy):
-    def support(self):
-        return self.delta.content is not None
+    def support(self, choice):
+        return choice.delta.content is not None
         # null value of content often occur in function call:
         #     {
         #       "role": "assistant",
@@ -38,42 +43,63 @@ class ContentChoiceStrategy(ChoiceStrategy):
         #       }
         #     }
 
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
-        bot_backend.add_content(content=self.delta.content)
+    def execute(self, choice, bot_backend: BotBackend, history: List, whether_exit: bool):
+        bot_backend.add_content(content=choice.delta.content)
         history[-1][1] = bot_backend.content
-        return history, whether_exit
+        bot_backend.emit('text', content=choice.delta.content)
+        yield history, whether_exit
 
 
 class NameFunctionCallChoiceStrategy(ChoiceStrategy):
-    def support(self):
-        return self.delta.tool_calls is not None and self.delta.tool_calls[0].function.name is not None
+    def support(self, choice):
+        return choice.delta.tool_calls is not None and \
+            any(tool_call.function.name is not None for tool_call in choice.delta.tool_calls)
 
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+    def execute(self, choice, bot_backend: BotBackend, history: List, whether_exit: bool):
         python_function_dict = bot_backend.jupyter_kernel.available_functions
         additional_tools = bot_backend.additional_tools
-        bot_backend.set_function_name(function_name=self.delta.tool_calls[0].function.name)
-        bot_backend.copy_current_bot_history(bot_history=history)
-        if bot_backend.function_name not in python_function_dict and bot_backend.function_name not in additional_tools:
-            history.append(
-                [
-                    None,
-                    f'GPT attempted to call a function that does '
-                    f'not exist: {bot_backend.function_name}\n '
-                ]
-            )
-            whether_exit = True
+        for tool_call in choice.delta.tool_calls:
+            if tool_call.function.name is None:
+                continue
+            new_call = bot_backend.start_tool_call(index=tool_call.index or 0)
+            if new_call and history[-1][1] and tool_call.function.name in python_function_dict:
+                # the code of each call is displayed in its own message
+                history.append([None, ""])
+            bot_backend.set_function_name(function_name=tool_call.function.name)
+            bot_backend.start_current_bubble(history=history)
+            bot_backend.emit('function_call', name=bot_backend.function_name)
+            if bot_backend.function_name not in python_function_dict and \
+                    bot_backend.function_name not in additional_tools:
+                history.append(
+                    [
+                        None,
+                        f'GPT attempted to call a function that does '
+                        f'not exist: {bot_backend.function_name}\n '
+                    ]
+                )
+                whether_exit = True
+                break
 
-        return history, whether_exit
+        yield history, whether_exit
 
 
 class ArgumentsFunctionCallChoiceStrategy(ChoiceStrategy):
 
-    def support(self):
-        return self.delta.tool_calls is not None and self.delta.tool_calls[0].function.arguments is not None
+    def support(self, choice):
+        return choice.delta.tool_calls is not None and \
+            any(tool_call.function.arguments is not None for tool_call in choice.delta.tool_calls)
 
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
-        bot_backend.add_function_args_str(function_args_str=self.delta.tool_calls[0].function.arguments)
+    def execute(self, choice, bot_backend: BotBackend, history: List, whether_exit: bool):
+        for tool_call in choice.delta.tool_calls:
+            if tool_call.function.arguments is not None:
+                bot_backend.start_tool_call(index=tool_call.index or 0)
+                bot_backend.add_function_args_str(function_args_str=tool_call.function.arguments)
+                self.update_code_display(bot_backend=bot_backend)
 
+        yield history, whether_exit
+
+    @staticmethod
+    def update_code_display(bot_backend: BotBackend):
         if bot_backend.function_name == 'python':  # handle hallucinatory function calls
             """
             In practice, we have noticed that GPT, especially GPT-3.5, may occasionally produce hallucinatory
@@ -81,59 +107,76 @@ class ArgumentsFunctionCallChoiceStrategy(ChoiceStrategy):
             solely of raw code text (not a JSON format).
             """
             temp_code_str = bot_backend.function_args_str
+        elif bot_backend.function_name == 'execute_code':
+            temp_code_str = bot_backend.code_arguments_parser.code
+        else:
+            temp_code_str = None
+
+        # the display block is rewritten in place in the current bubble of history
+        if temp_code_str is not None:
+            # the code usually grows at the end, only the new part is sent to the event hooks then
+            previous_code_str = bot_backend.code_str
+            if temp_code_str.startswith(previous_code_str):
+                bot_backend.emit('code', content=temp_code_str[len(previous_code_str):], replace=False)
+            else:
+                bot_backend.emit('code', content=temp_code_str, replace=True)
             bot_backend.update_code_str(code_str=temp_code_str)
             bot_backend.update_display_code_block(
                 display_code_block="\n🔴Working:\n```python\n{}\n```".format(temp_code_str)
             )
-            history = copy.deepcopy(bot_backend.bot_history)
-            history[-1][1] += bot_backend.display_code_block
-        elif bot_backend.function_name == 'execute_code':
-            temp_code_str = parse_json(function_args=bot_backend.function_args_str, finished=False)
-            if temp_code_str is not None:
-                bot_backend.update_code_str(code_str=temp_code_str)
-                bot_backend.update_display_code_block(
-                    display_code_block="\n🔴Working:\n```python\n{}\n```".format(
-                        temp_code_str
-                    )
-                )
-                history = copy.deepcopy(bot_backend.bot_history)
-                history[-1][1] += bot_backend.display_code_block
-            else:
-                history = copy.deepcopy(bot_backend.bot_history)
-                history[-1][1] += bot_backend.display_code_block
-        else:
-            pass
-
-        return history, whether_exit
 
 
 class FinishReasonChoiceStrategy(ChoiceStrategy):
-    def support(self):
-        return self.choice.finish_reason is not None
+    def support(self, choice):
+        return choice.finish_reason is not None
 
-    def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+    def execute(self, choice, bot_backend: BotBackend, history: List, whether_exit: bool):
 
         if bot_backend.content:
             bot_backend.add_gpt_response_content_message()
 
-        bot_backend.update_finish_reason(finish_reason=self.choice.finish_reason)
+        bot_backend.update_finish_reason(finish_reason=choice.finish_reason)
         if bot_backend.finish_reason == 'tool_calls':
-
-            if bot_backend.function_name in bot_backend.jupyter_kernel.available_functions:
-                history, whether_exit = self.handle_execute_code_finish_reason(
-                    bot_backend=bot_backend, history=history, whether_exit=whether_exit
-                )
+            # the calls run in order, the additional tools concurrently in the tool pool; all the function
+            # responses are sent back in the next request
+            tool_calls = bot_backend.take_tool_calls()
+            if bot_backend.interrupt_signal_sent or bot_backend.stop_generating:
+                tool_futures = [None] * len(tool_calls)
             else:
-                history, whether_exit = self.handle_tool_finish_reason(
-                    bot_backend=bot_backend, history=history, whether_exit=whether_exit
-                )
+                tool_futures = self.start_tools(bot_backend=bot_backend, tool_calls=tool_calls)
+            try:
+                for tool_call, tool_future in zip(tool_calls, tool_futures):
+                    bot_backend.load_tool_call(tool_call)
+                    # a kernel suspended during the turn lost its variables, the turn ends, see `stream_bot_response`
+                    if bot_backend.interrupt_signal_sent or bot_backend.stop_generating or \
+                            bot_backend.kernel_suspended_unnoticed():
+                        stop_tool_call(bot_backend=bot_backend)
+                        continue
+
+                    if bot_backend.function_name in bot_backend.jupyter_kernel.available_functions:
+                        handle_finish_reason = self.handle_execute_code_finish_reason(
+                            bot_backend=bot_backend, history=history, whether_exit=whether_exit
+                        )
+                    else:
+                        handle_finish_reason = self.handle_tool_finish_reason(
+                            bot_backend=bot_backend, history=history, whether_exit=whether_exit,
+                            tool_future=tool_future
+                        )
+                    for history, whether_exit in handle_finish_reason:
+                        yield history, whether_exit
+            finally:
+                # the tools of stopped calls, or of an abandoned response, are not run if they have not started yet
+                for tool_future in tool_futures:
+                    if tool_future is not None:
+                        tool_future.cancel()
+            if bot_backend.kernel_suspended_unnoticed():
+                bot_backend.update_finish_reason(finish_reason='stop')
 
         bot_backend.reset_gpt_response_log_values(exclude=['finish_reason'])
 
-        return history, whether_exit
+        yield history, whether_exit
 
     def handle_execute_code_finish_reason(self, bot_backend: BotBackend, history: List, whether_exit: bool):
-        function_dict = bot_backend.jupyter_kernel.available_functions
         try:
 
             code_str = self.get_code_str(bot_backend)
@@ -142,15 +185,39 @@ class FinishReasonChoiceStrategy(ChoiceStrategy):
             bot_backend.update_display_code_block(
                 display_code_block="\n🟢Finished:\n```python\n{}\n```".format(code_str)
             )
-            history = copy.deepcopy(bot_backend.bot_history)
-            history[-1][1] += bot_backend.display_code_block
+            bot_backend.commit_current_bubble()
+            bot_backend.emit('code_finished', code=code_str)
+            yield history, whether_exit
 
-            # function response
+            # function response, partial outputs are displayed at most once per refresh interval
             bot_backend.update_code_executing_state(code_executing=True)
-            text_to_gpt, content_to_display = function_dict[
-                bot_backend.function_name
-            ](code_str)
+            output_collector = bot_backend.jupyter_kernel.create_output_collector()
+            output_tail = ''
+            last_refresh_time = time.time()
+            output_message = [None, None]
+            history.append(output_message)
+            try:
+                for output in bot_backend.jupyter_kernel.execute_code_stream(
+                    code_str, cooperative=bot_backend.cooperative_kernel_wait
+                ):
+                    if output is KERNEL_WAIT:
+                        # the driver of the response waits for the kernel, see `JupyterKernel.wait_for_output`
+                        yield history, whether_exit
+                        continue
+                    output_collector.add(output)
+                    bot_backend.emit('output', type=output[0], content=output[1])
+                    output_tail = update_output_tail(output_tail, output)
+                    if time.time() - last_refresh_time >= OUTPUT_REFRESH_INTERVAL:
+                        output_message[1] = f'⏳Terminal output:\n```shell\n{output_tail}\n```'
+                        yield history, whether_exit
+                        last_refresh_time = time.time()
+            finally:
+                # the partial outputs are replaced by the final ones, or dropped if the execution fails
+                remove_message(history=history, message=output_message)
+            content_to_display = output_collector.get_outputs()
+            text_to_gpt = get_text_to_gpt(content_to_display)
             bot_backend.update_code_executing_state(code_executing=False)
+            bot_backend.emit('execution_finished', output=text_to_gpt, interrupted=bot_backend.interrupt_signal_sent)
 
             # add function call to conversion
             bot_backend.add_function_call_response_message(function_response=text_to_gpt, save_tokens=True)
@@ -159,101 +226,245 @@ class FinishReasonChoiceStrategy(ChoiceStrategy):
                 bot_backend.append_system_msg(prompt='Code execution is manually stopped by user, no need to fix.')
 
             add_code_execution_result_to_bot_history(
-                content_to_display=content_to_display, history=history, unique_id=bot_backend.unique_id
+                content_to_display=content_to_display, history=history, unique_id=bot_backend.unique_id,
+                notebook=bot_backend.notebook, metrics=bot_backend.metrics
             )
-            return history, whether_exit
+            yield history, whether_exit
 
         except json.JSONDecodeError:
             history.append(
                 [None, f"GPT generate wrong function args: {bot_backend.function_args_str}"]
             )
             whether_exit = True
-            return history, whether_exit
+            yield history, whether_exit
 
         except KeyError as key_error:
             history.append([None, f'Backend key_error: {key_error}'])
             whether_exit = True
-            return history, whether_exit
+            yield history, whether_exit
 
         except Exception as e:
             history.append([None, f'Backend error: {e}'])
             whether_exit = True
-            return history, whether_exit
+            yield history, whether_exit
+
+    @staticmethod
+    def start_tools(bot_backend: BotBackend, tool_calls: List[Dict]):
+        """
+        Submit the calls of additional tools to the tool pool. Code executions are left to the caller.
+        :return: for each call, the future of its result, None if it is not an additional tool or its arguments are
+        invalid
+        """
+        tool_futures = []
+        for tool_call in tool_calls:
+            tool = bot_backend.additional_tools.get(tool_call['function_name'])
+            if tool is not None:
+                try:
+                    kwargs = json.loads(tool_call['function_args_str'])
+                    kwargs.update(tool['additional_parameters'])
+                except json.JSONDecodeError:
+                    tool = None
+            tool_futures.append(get_tool_executor().submit(run_tool, tool['tool'], kwargs) if tool else None)
+        return tool_futures
 
     @staticmethod
-    def handle_tool_finish_reason(bot_backend: BotBackend, history: List, whether_exit: bool):
-        function_dict = bot_backend.additional_tools
+    def handle_tool_finish_reason(bot_backend: BotBackend, history: List, whether_exit: bool, tool_future):
         function_name = bot_backend.function_name
-        function = function_dict[function_name]['tool']
 
-        # parser function args
-        try:
-            kwargs = json.loads(bot_backend.function_args_str)
-            kwargs.update(function_dict[function_name]['additional_parameters'])
-        except json.JSONDecodeError:
+        if tool_future is None:
             history.append(
                 [None, f"GPT generate wrong function args: {bot_backend.function_args_str}"]
             )
             whether_exit = True
-            return history, whether_exit
+            yield history, whether_exit
 
         else:
             # function response
-            function_response, hypertext_to_display = function(**kwargs)
+            function_response, hypertext_to_display, seconds = tool_future.result()
+            bot_backend.metrics.observe('lci_tool_seconds', seconds, tool=function_name)
 
             # add function call to conversion
             bot_backend.add_function_call_response_message(function_response=function_response, save_tokens=False)
 
+            bot_backend.emit('tool_result', tool=function_name, content=hypertext_to_display)
+
             # add hypertext response to bot history
             add_function_response_to_bot_history(hypertext_to_display=hypertext_to_display, history=history)
 
-            return history, whether_exit
+            yield history, whether_exit
 
     @staticmethod
     def get_code_str(bot_backend):
         if bot_backend.function_name == 'python':
             code_str = bot_backend.function_args_str
         else:
-            code_str = parse_json(function_args=bot_backend.function_args_str, finished=True)
+            code_str = bot_backend.code_arguments_parser.finish()
             if code_str is None:
-                raise json.JSONDecodeError
+                code_str = parse_json(function_args=bot_backend.function_args_str, finished=True)
+            if not isinstance(code_str, str):
+                raise json.JSONDecodeError('Invalid function arguments', bot_backend.function_args_str, 0)
         return code_str
 
 
+def remove_message(history: List, message: List):
+    for index in range(len(history) - 1, -1, -1):
+        if history[index] is message:
+            del history[index]
+            return
+
+
+def run_tool(function, kwargs):
+    """
+    Runs in the tool pool.
+    :return: function_response, hypertext_to_display, time taken in seconds
+    """
+    start_time = time.time()
+    function_response, hypertext_to_display = function(**kwargs)
+    return function_response, hypertext_to_display, time.time() - start_time
+
+
+def stop_tool_call(bot_backend: BotBackend):
+    """
+    Mark the current tool call as stopped by the user, it is not run.
+    """
+    if bot_backend.display_code_block:
+        bot_backend.update_display_code_block(
+            display_code_block="\n⚫Stopped:\n```python\n{}\n```".format(bot_backend.code_str)
+        )
+        bot_backend.commit_current_bubble()
+        bot_backend.add_function_call_response_message(function_response=None)
+
+
 class ChoiceHandler:
-    strategies = [
-        RoleChoiceStrategy, ContentChoiceStrategy, NameFunctionCallChoiceStrategy,
-        ArgumentsFunctionCallChoiceStrategy, FinishReasonChoiceStrategy
-    ]
-
-    def __init__(self, choice):
-        self.choice = choice
-
-    def handle(self, bot_backend: BotBackend, history: List, whether_exit: bool):
-        for Strategy in self.strategies:
-            strategy_instance = Strategy(choice=self.choice)
-            if not strategy_instance.support():
+    def __init__(self):
+        self.strategies = [
+            RoleChoiceStrategy(), ContentChoiceStrategy(), NameFunctionCallChoiceStrategy(),
+            ArgumentsFunctionCallChoiceStrategy(), FinishReasonChoiceStrategy()
+        ]
+
+    def handle(self, choice, bot_backend: BotBackend, history: List, whether_exit: bool):
+        for strategy in self.strategies:
+            if not strategy.support(choice):
                 continue
-            history, whether_exit = strategy_instance.execute(
+            for history, whether_exit in strategy.execute(
+                choice=choice,
                 bot_backend=bot_backend,
                 history=history,
                 whether_exit=whether_exit
+            ):
+                yield history, whether_exit
+
+
+choice_handler = ChoiceHandler()
+
+
+def record_stream_metrics(choice, bot_backend: BotBackend):
+    """
+    Time to first token and streaming rate, every chunk with content or function arguments counting as a token.
+    """
+    if choice.delta.content or choice.delta.tool_calls:
+        if bot_backend.mark_token_received() and bot_backend.request_sent_at is not None:
+            bot_backend.metrics.observe(
+                'lci_time_to_first_token_seconds', bot_backend.first_token_at - bot_backend.request_sent_at
             )
-        return history, whether_exit
+    if choice.finish_reason is not None and bot_backend.streamed_chunks > 1:
+        duration = time.time() - bot_backend.first_token_at
+        if duration > 0:
+            bot_backend.metrics.observe('lci_tokens_per_second', (bot_backend.streamed_chunks - 1) / duration)
 
 
 def parse_response(chunk, history: List, bot_backend: BotBackend):
     """
-    :return: history, whether_exit
+    Generator, a chunk may produce several updates (e.g. the outputs of a long-running code execution).
+    The last message of history is updated in place, history is never copied.
+    :return: yields history, whether_exit
     """
     whether_exit = False
     if chunk.choices:
-        choice = chunk.choices[0]
-        choice_handler = ChoiceHandler(choice=choice)
-        history, whether_exit = choice_handler.handle(
+        record_stream_metrics(choice=chunk.choices[0], bot_backend=bot_backend)
+        yield from choice_handler.handle(
+            choice=chunk.choices[0],
             history=history,
             bot_backend=bot_backend,
             whether_exit=whether_exit
         )
 
-    return history, whether_exit
+
+def get_response_state(bot_backend: BotBackend) -> Dict:
+    """
+    :return: the state of the response that front ends show along with an update (e.g. on the stop button)
+    """
+    return {
+        # parallel tool calls take an execution slot if any of them executes code
+        'executes_code': any(
+            function_name in bot_backend.jupyter_kernel.available_functions
+            for function_name in bot_backend.tool_call_names()
+        ),
+        'stopping': bot_backend.stop_generating or bot_backend.interrupt_signal_sent,
+        'code_executing': bot_backend.code_executing
+    }
+
+
+def stream_bot_response(bot_backend: BotBackend, history: List):
+    """
+    Generator, the conversation loop shared by the front ends: requests chat completions and parses them until the
+    model stops calling functions, the user stops the generation, the kernel is suspended, or the response cannot be
+    handled.
+    The last message of history is updated in place, as in `parse_response`.
+    :return: yields history, event; the event is one of
+        'delta': an update of the streamed response, front ends may skip it if another one follows shortly,
+        'function_call': the arguments of a function call are complete, it is about to run,
+        'update': any other update (e.g. code execution output),
+        'end_of_response': a chat completion response is over, the loop may request another one,
+        'exit': the response could not be handled, the loop is over.
+    """
+    while bot_backend.finish_reason in ('new_input', 'tool_calls'):
+        if history[-1][1]:
+            history.append([None, ""])
+        else:
+            history[-1][1] = ""
+
+        try:
+            response = chat_completion(bot_backend=bot_backend)
+            for chunk in response:
+                # the finish chunk ends the streaming phase, its updates are never skipped
+                finish_chunk = bool(chunk.choices and chunk.choices[0].finish_reason)
+                if chunk.choices and chunk.choices[0].finish_reason == 'tool_calls':
+                    yield history, 'function_call'
+
+                if bot_backend.stop_generating:
+                    response.close()
+                    if bot_backend.content:
+                        bot_backend.add_gpt_response_content_message()
+                    for tool_call in bot_backend.take_tool_calls():
+                        bot_backend.load_tool_call(tool_call)
+                        stop_tool_call(bot_backend=bot_backend)
+
+                    bot_backend.reset_gpt_response_log_values()
+                    break
+
+                for history, whether_exit in parse_response(chunk=chunk, history=history, bot_backend=bot_backend):
+                    if whether_exit:
+                        try:
+                            bot_backend.emit('error', message=history[-1][1])
+                        finally:
+                            # nothing of the abandoned response is carried over to the next turn
+                            bot_backend.reset_gpt_response_log_values()
+                        yield history, 'exit'
+                        return
+                    yield history, 'update' if finish_chunk else 'delta'
+            yield history, 'end_of_response'
+        except openai.OpenAIError:
+            bot_backend.reset_gpt_response_log_values(exclude=['finish_reason'])
+            raise
+        except Exception:
+            bot_backend.reset_gpt_response_log_values()
+            raise
+
+    if bot_backend.kernel_suspended_unnoticed():
+        # the session reaper suspended the kernel while the model generated, the user and the model are told now
+        # rather than at the next message
+        history.append([None, f'⚠️{kernel_suspended_in_turn_msg}'])
+        bot_backend.emit('kernel_suspended', message=kernel_suspended_in_turn_msg)
+        bot_backend.notice_kernel_suspension()
+        yield history, 'update'
@@ -0,0 +1,133 @@
+import time
+import weakref
+import threading
+from metrics import register_collector
+
+try:
+    import psutil
+except ImportError:  # memory is read from /proc instead (Linux only)
+    psutil = None
+
+
+def process_rss(pid):
+    """
+    :return: the resident memory of a process in bytes, 0 if it cannot be read
+    """
+    if pid is None:
+        return 0
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class SessionReaper:
+    """
+    Suspends the kernels of the sessions of this process: those idle for more than `idle_ttl` seconds, and, while the
+    kernels together use more than `memory_budget` bytes, the least recently active ones. A suspended session keeps its
+    conversation and the files of its work dir, its next code execution starts a new kernel.
+    Kernels executing code are never suspended.
+    """
+
+    def __init__(self, idle_ttl=None, memory_budget=None, check_interval=60.0):
+        self.idle_ttl = idle_ttl
+        self.memory_budget = memory_budget
+        self.check_interval = check_interval
+        self.suspended_count = 0
+        self._sessions = weakref.WeakSet()
+        self._lock = threading.Lock()
+        if idle_ttl is not None or memory_budget is not None:
+            threading.Thread(target=self._check_loop, name='session-reaper', daemon=True).start()
+
+    def register(self, bot_backend):
+        with self._lock:
+            self._sessions.add(bot_backend)
+
+    def _check_loop(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.check()
+            except Exception as e:
+                print(f'Session reaper check failed: {e}')
+
+    def check(self):
+        """
+        Suspend the idle kernels, then the least recently active ones until the memory budget is met.
+        """
+        with self._lock:
+            sessions = [
+                bot_backend for bot_backend in self._sessions
+                if not (bot_backend.jupyter_kernel.suspended or bot_backend.jupyter_kernel.closed)
+            ]
+        now = time.time()
+        if self.idle_ttl is not None:
+            for bot_backend in sessions:
+                if now - bot_backend.last_active > self.idle_ttl:
+                    self.suspend(bot_backend, reason=f'idle for {now - bot_backend.last_active:.0f}s')
+            sessions = [bot_backend for bot_backend in sessions if not bot_backend.jupyter_kernel.suspended]
+
+        if self.memory_budget is not None:
+            kernel_rss = {bot_backend: process_rss(bot_backend.jupyter_kernel.kernel_pid()) for bot_backend in sessions}
+            total_rss = sum(kernel_rss.values())
+            for bot_backend in sorted(sessions, key=lambda bot_backend: bot_backend.last_active):
+                if total_rss <= self.memory_budget:
+                    break
+                if self.suspend(bot_backend, reason=f'kernels use {total_rss / 1024 ** 2:.0f} MB'):
+                    total_rss -= kernel_rss[bot_backend]
+
+    def suspend(self, bot_backend, reason):
+        if not bot_backend.jupyter_kernel.suspend():
+            return False
+        self.suspended_count += 1
+        print(f'Suspended the kernel of session {bot_backend.unique_id} ({reason})')
+        return True
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions)
+        return {
+            'sessions': len(sessions),
+            'suspended': sum(bot_backend.jupyter_kernel.suspended for bot_backend in sessions),
+            'suspended_total': self.suspended_count,
+        }
+
+    def metric_samples(self):
+        stats = self.stats()
+        return [
+            ('lci_sessions', 'gauge', 'Open sessions', stats['sessions'], {}),
+            ('lci_sessions_suspended', 'gauge', 'Sessions whose kernel is suspended', stats['suspended'], {}),
+            ('lci_sessions_suspended_total', 'counter', 'Kernels suspended for idleness', stats['suspended_total'], {}),
+        ]
+
+
+_session_reaper = None
+_session_reaper_lock = threading.Lock()
+
+
+def get_session_reaper(reaper_config=None):
+    """
+    Return the process-wide session reaper, creating it from the "session_reaper" config on first use.
+    """
+    global _session_reaper
+    with _session_reaper_lock:
+        if _session_reaper is None:
+            reaper_config = reaper_config or {}
+            idle_minutes = reaper_config.get('idle_minutes')
+            memory_budget_gb = reaper_config.get('memory_budget_gb')
+            _session_reaper = SessionReaper(
+                idle_ttl=idle_minutes * 60 if idle_minutes is not None else None,
+                memory_budget=int(memory_budget_gb * 1024 ** 3) if memory_budget_gb is not None else None,
+                check_interval=reaper_config.get('check_interval', 60.0)
+            )
+            register_collector(_session_reaper.metric_samples)
+        return _session_reaper
@@ -0,0 +1,427 @@
+"""
+Multi-process deployment of the web UI. With "backend_workers" set in the config, the sessions are spread over that
+many worker processes, which own the `BotBackend` and the kernel of their sessions, so that the responses of
+different sessions run on all the cores instead of sharing the interpreter of the web UI process. A session stays
+on the worker it was placed on, the one with the fewest sessions at the time.
+
+The web UI talks to the workers through `RemoteBotBackend`, over local `multiprocessing.connection` connections;
+the updates of a response are streamed back as they come. Code executions still wait for a slot of the execution
+scheduler of the web UI process, which is shared by all the workers.
+
+A worker is started by the web UI as:
+    python session_workers.py --address <address> --index <n> [-n <notebook>]
+"""
+import sys
+import json
+import uuid
+import atexit
+import openai
+import signal
+import asyncio
+import argparse
+import itertools
+import threading
+import subprocess
+from multiprocessing.connection import Listener, Client
+from response_parser import *
+from execution_scheduler import get_execution_scheduler
+from metrics import SessionMetrics, register_session, start_metrics_server
+import notebook_serializer
+
+AUTHKEY_ENV = 'LCI_WORKER_AUTHKEY'
+# methods of `BotBackend` the web UI calls on a session
+BOT_BACKEND_COMMANDS = {
+    'add_text_message', 'add_file_message', 'revoke_file', 'update_gpt_model_choice', 'restart', 'stop_response'
+}
+
+
+class SessionWorkerError(Exception):
+    pass
+
+
+def raise_worker_error(error):
+    name, message, openai_error = error
+    if openai_error:
+        raise openai.OpenAIError(message)
+    raise SessionWorkerError(f'{name}: {message}')
+
+
+def get_session_state(bot_backend: BotBackend) -> Dict:
+    return {
+        'gpt_model_choice': bot_backend.gpt_model_choice,
+        'context_window_tokens': bot_backend.context_window_tokens,
+        'sliced': bot_backend.sliced
+    }
+
+
+class HistoryDelta:
+    """
+    The chat history last sent to the web UI. An update is sent as the index of the first changed message and the
+    messages from there. A response mostly changes the end of the history, but it also updates earlier messages in
+    place (e.g. the code bubbles of parallel tool calls), so the history is compared from the start.
+    """
+
+    def __init__(self, history: List):
+        self.sent = [tuple(message) for message in history]
+
+    def diff(self, history: List):
+        start = 0
+        end = min(len(self.sent), len(history))
+        while start < end and tuple(history[start]) == self.sent[start]:
+            start += 1
+        messages = [list(message) for message in history[start:]]
+        self.sent[start:] = [tuple(message) for message in messages]
+        return start, messages
+
+
+def apply_history_delta(history: List, delta):
+    start, messages = delta
+    del history[start:]
+    history.extend(messages)
+
+
+class SessionWorker:
+    """
+    Runs in a worker process: owns the sessions placed on it and runs the requests of the web UI, each in a thread of
+    its own, since requests of a session arrive while it responds (e.g. stop_response).
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.bot_backends: Dict[str, BotBackend] = {}
+        self.execution_grants: Dict[int, threading.Semaphore] = {}  # request id of a response -> slots granted
+        self._send_lock = threading.Lock()
+
+    def send(self, request_id, kind, payload):
+        with self._send_lock:
+            self.connection.send((request_id, kind, payload))
+
+    def serve(self):
+        while True:
+            try:
+                request_id, command, session_id, kwargs = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            threading.Thread(
+                target=self.run_request, args=(request_id, command, session_id, kwargs), daemon=True
+            ).start()
+        # the web UI exited
+        for bot_backend in list(self.bot_backends.values()):
+            bot_backend.jupyter_kernel.shutdown()
+
+    def run_request(self, request_id, command, session_id, kwargs):
+        try:
+            if command == 'respond':
+                result = self.respond(request_id, session_id, **kwargs)
+            elif command == 'create':
+                result = self.create(session_id, **kwargs)
+            elif command == 'close':
+                bot_backend = self.bot_backends.pop(session_id)
+                bot_backend.jupyter_kernel.shutdown()
+                result = None
+            elif command == 'grant_execution':
+                grants = self.execution_grants.get(kwargs['response'])
+                if grants is not None:
+                    grants.release()
+                result = None
+            elif command in BOT_BACKEND_COMMANDS:
+                bot_backend = self.bot_backends[session_id]
+                result = getattr(bot_backend, command)(**kwargs), get_session_state(bot_backend)
+            else:
+                raise ValueError(f'Unknown command: {command}')
+        except Exception as e:
+            self.send(request_id, 'error', (type(e).__name__, str(e), isinstance(e, openai.OpenAIError)))
+        else:
+            self.send(request_id, 'result', result)
+
+    def create(self, session_id, session_number=None):
+        bot_backend = BotBackend(session_number=session_number)
+        self.bot_backends[session_id] = bot_backend
+        return {'jupyter_work_dir': bot_backend.jupyter_work_dir, **get_session_state(bot_backend)}
+
+    def respond(self, request_id, session_id, history):
+        bot_backend = self.bot_backends[session_id]
+        history_delta = HistoryDelta(history)
+        self.execution_grants[request_id] = grants = threading.Semaphore(0)
+        try:
+            for history, event in stream_bot_response(bot_backend=bot_backend, history=history):
+                response_state = get_response_state(bot_backend)
+                self.send(request_id, 'step', (history_delta.diff(history), event, response_state))
+                if event == 'function_call' and response_state['executes_code']:
+                    grants.acquire()
+        finally:
+            del self.execution_grants[request_id]
+        return get_session_state(bot_backend)
+
+
+class WorkerConnection:
+    """
+    The connection to a worker process, on the side of the web UI. Replies are dispatched to the handlers of their
+    requests by a thread reading the connection.
+    """
+
+    def __init__(self, index, process, connection):
+        self.index = index
+        self.process = process
+        self.connection = connection
+        self.sessions = 0
+        self.closed = False
+        self._handlers = {}  # request id -> handler(kind, payload)
+        self._request_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        threading.Thread(target=self._receive, daemon=True, name=f'session-worker-{index}').start()
+
+    def request(self, command, session_id, handler=None, **kwargs):
+        """
+        Send a request, the replies are given to `handler` in the thread reading the connection.
+        :return: the request id
+        """
+        request_id = next(self._request_ids)
+        with self._lock:
+            if self.closed:
+                raise SessionWorkerError(f'Session worker {self.index} exited')
+            if handler is not None:
+                self._handlers[request_id] = handler
+        with self._send_lock:
+            self.connection.send((request_id, command, session_id, kwargs))
+        return request_id
+
+    def call(self, command, session_id, **kwargs):
+        """
+        Blocking request.
+        :return: its result
+        """
+        replied = threading.Event()
+        replies = []
+
+        def handler(kind, payload):
+            replies.append((kind, payload))
+            replied.set()
+
+        self.request(command, session_id, handler=handler, **kwargs)
+        replied.wait()
+        kind, payload = replies[0]
+        if kind == 'error':
+            raise_worker_error(payload)
+        return payload
+
+    def _receive(self):
+        while True:
+            try:
+                request_id, kind, payload = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                if kind == 'step':
+                    handler = self._handlers.get(request_id)
+                else:
+                    handler = self._handlers.pop(request_id, None)
+            if handler is not None:
+                handler(kind, payload)
+        with self._lock:
+            self.closed = True
+            handlers = list(self._handlers.values())
+            self._handlers.clear()
+        for handler in handlers:
+            handler('error', ('SessionWorkerError', f'Session worker {self.index} exited', False))
+
+    def close(self, timeout=10):
+        self.connection.close()
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class SessionWorkerPool:
+    def __init__(self, num_workers):
+        authkey = os.urandom(32)
+        self.listener = Listener(authkey=authkey)
+        self._lock = threading.Lock()
+        command = [
+            sys.executable, os.path.abspath(__file__), '--address', json.dumps(self.listener.address)
+        ]
+        if notebook_serializer.args.notebook:
+            command += ['--notebook', notebook_serializer.notebook_path]
+        env = dict(os.environ, **{AUTHKEY_ENV: authkey.hex()})
+        processes = [
+            subprocess.Popen(command + ['--index', str(index)], env=env) for index in range(num_workers)
+        ]
+        starting = [True]
+
+        def watch(process):
+            # a worker exiting before it connects would leave `accept` waiting
+            process.wait()
+            if starting[0]:
+                with Client(self.listener.address, authkey=authkey) as connection:
+                    connection.send(None)
+
+        for process in processes:
+            threading.Thread(target=watch, args=(process,), daemon=True).start()
+        workers = {}
+        while len(workers) < num_workers:
+            connection = self.listener.accept()
+            hello = connection.recv()
+            if hello is None:
+                starting[0] = False
+                for process in processes:
+                    process.kill()
+                raise SessionWorkerError('A session worker exited at startup')
+            workers[hello] = WorkerConnection(hello, processes[hello], connection)
+        starting[0] = False
+        self.workers = [workers[index] for index in range(num_workers)]
+
+    def place_session(self) -> WorkerConnection:
+        with self._lock:
+            worker = min(
+                (worker for worker in self.workers if not worker.closed), key=lambda worker: worker.sessions,
+                default=None
+            )
+            if worker is None:
+                raise SessionWorkerError('All session workers exited')
+            worker.sessions += 1
+            return worker
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.listener.close()
+
+
+_session_worker_pool = None
+_session_worker_pool_lock = threading.Lock()
+
+
+def get_session_worker_pool(num_workers=None):
+    """
+    Return the process-wide pool of session workers, starting `num_workers` workers on first use.
+    """
+    global _session_worker_pool
+    with _session_worker_pool_lock:
+        if _session_worker_pool is None:
+            _session_worker_pool = SessionWorkerPool(num_workers or os.cpu_count() or 1)
+            atexit.register(_session_worker_pool.close)
+        return _session_worker_pool
+
+
+class RemoteBotBackend:
+    """
+    Stands for the `BotBackend` of a session living in a worker process, with the attributes and methods the web UI
+    uses.
+    """
+
+    def __init__(self, pool: SessionWorkerPool):
+        self.unique_id = uuid.uuid4().hex
+        self.worker = pool.place_session()
+        self.metrics = SessionMetrics()
+        register_session(self.unique_id, self.metrics)
+        self.revocable_files = []  # bot messages of the uploads that can be revoked
+        session_number = notebook_serializer.reserve_session_number() if notebook_serializer.args.notebook else None
+        try:
+            state = self.worker.call('create', self.unique_id, session_number=session_number)
+        except Exception:
+            with pool._lock:
+                self.worker.sessions -= 1
+            raise
+        self.jupyter_work_dir = state.pop('jupyter_work_dir')
+        self._update_state(state)
+
+    def _update_state(self, state):
+        self.gpt_model_choice = state['gpt_model_choice']
+        self.context_window_tokens = state['context_window_tokens']
+        self.sliced = state['sliced']
+
+    def _call(self, command, **kwargs):
+        returned, state = self.worker.call(command, self.unique_id, **kwargs)
+        self._update_state(state)
+        return returned
+
+    def add_text_message(self, user_text):
+        self._call('add_text_message', user_text=user_text)
+        self.revocable_files.clear()
+
+    def add_file_message(self, path, bot_msg):
+        self._call('add_file_message', path=path, bot_msg=bot_msg)
+        self.revocable_files.append(bot_msg)
+
+    def revoke_file(self):
+        if self._call('revoke_file') is None:
+            return None
+        return self.revocable_files.pop()
+
+    def update_gpt_model_choice(self, model_choice):
+        self._call('update_gpt_model_choice', model_choice=model_choice)
+
+    def restart(self):
+        self._call('restart')
+        self.revocable_files.clear()
+
+    def stop_response(self):
+        self.worker.request('stop_response', self.unique_id)
+
+    def close(self):
+        self.worker.call('close', self.unique_id)
+
+    async def response_steps(self, history: List):
+        """
+        Async generator, yields history, event, response state like `local_response_steps` of web_ui.py while the
+        worker responds. `history` is updated in place.
+        """
+        scheduler = get_execution_scheduler(config.get('queue'))
+        loop = asyncio.get_running_loop()
+        replies = asyncio.Queue()
+
+        def handler(kind, payload):
+            loop.call_soon_threadsafe(replies.put_nowait, (kind, payload))
+
+        request_id = self.worker.request('respond', self.unique_id, handler=handler, history=history)
+        slot_granted_at = None
+        finished = False
+        try:
+            while True:
+                kind, payload = await replies.get()
+                if kind != 'step':
+                    finished = True
+                    if kind == 'error':
+                        raise_worker_error(payload)
+                    self._update_state(payload)
+                    break
+                delta, event, response_state = payload
+                apply_history_delta(history, delta)
+                yield history, event, response_state
+                if event == 'function_call' and response_state['executes_code']:
+                    slot_granted_at = await scheduler.acquire(self.unique_id)
+                    self.worker.request('grant_execution', self.unique_id, response=request_id)
+                elif event == 'end_of_response' and slot_granted_at is not None:
+                    scheduler.release(self.unique_id, slot_granted_at)
+                    slot_granted_at = None
+        finally:
+            if slot_granted_at is not None:
+                scheduler.release(self.unique_id, slot_granted_at)
+            if not finished and not self.worker.closed:
+                # nobody listens to the response anymore (e.g. the browser went away), it is stopped
+                self.worker.request('stop_response', self.unique_id)
+                self.worker.request('grant_execution', self.unique_id, response=request_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', required=True, help='address of the listener of the web UI, in JSON')
+    parser.add_argument('--index', type=int, required=True)
+    args, _ = parser.parse_known_args()  # `--notebook` is read by notebook_serializer
+    address = json.loads(args.address)
+    # Ctrl+C is handled by the web UI, a worker exits when its connection is closed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    connection = Client(tuple(address) if isinstance(address, list) else address,
+                        authkey=bytes.fromhex(os.environ.pop(AUTHKEY_ENV)))
+    connection.send(args.index)
+    # start filling the kernel pool before the first session needs a kernel
+    get_kernel_pool(config.get('kernel_pool'))
+    if config.get('metrics_port'):
+        start_metrics_server(config['metrics_port'] + 1 + args.index)
+    SessionWorker(connection).serve()
+
+
+if __name__ == '__main__':
+    main()
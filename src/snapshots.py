@@ -0,0 +1,499 @@
+import os
+import json
+import time
+import uuid
+import errno
+import queue
+import shutil
+import hashlib
+import argparse
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # ioctl that makes a copy-on-write clone of a file (Btrfs, XFS, ...)
+HASH_CHUNK_SIZE = 1 << 20
+# files linked or renamed into the store less than this many seconds ago are never garbage collected
+GC_GRACE_PERIOD = 600
+
+
+def reflink(src, dst):
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def copy_and_hash(src, dst):
+    """
+    Copy a file, hashing it on the way so that it is read only once.
+    :return: the hash
+    """
+    sha256 = hashlib.sha256()
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        for chunk in iter(lambda: src_file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            dst_file.write(chunk)
+    shutil.copystat(src, dst)
+    return sha256.hexdigest()
+
+
+def atomic_write_json(path, data):
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+class ContentStore:
+    """
+    Content-addressed file store, each distinct content is kept once as `objects/<sha256>`.
+    Files are brought in without copying their bytes when possible: by reflink where the filesystem supports it,
+    otherwise by hardlink, and only copied as a last resort (e.g. across filesystems). Files brought in before their
+    hash is known wait in `pending/` until `hash_pending` is called.
+    An index keyed by inode remembers the hash of files already hashed, so hardlinks of objects are never rehashed.
+    Work dir files reflinked from an object (uploads) are recorded as references, which keep the object from being
+    garbage collected while they exist unmodified.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.pending_dir = os.path.join(root, 'pending')
+        self.index_path = os.path.join(root, 'index.json')
+        self.references_path = os.path.join(root, 'references.json')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.pending_dir, exist_ok=True)
+        self.reflink_supported = fcntl is not None
+        self._lock = threading.Lock()
+        self._index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, encoding='utf-8') as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        self._references = {}  # absolute path of a file reflinked from an object -> hash
+        if os.path.exists(self.references_path):
+            try:
+                with open(self.references_path, encoding='utf-8') as f:
+                    self._references = json.load(f)
+            except (OSError, ValueError):
+                self._references = {}
+
+    @staticmethod
+    def _inode_key(st):
+        return f'{st.st_dev}:{st.st_ino}'
+
+    def object_path(self, content_hash):
+        return os.path.join(self.objects_dir, content_hash)
+
+    def pending_path(self, pending_name):
+        return os.path.join(self.pending_dir, pending_name)
+
+    def place(self, src, dst, allow_hardlink=True, allow_copy=True):
+        """
+        Make `dst` a file with the content of `src`, by reflink, hardlink or copy.
+        :return: the method used, None if the file could not be placed without copying and copying is not allowed
+        """
+        if self.reflink_supported:
+            try:
+                reflink(src, dst)
+                return 'reflink'
+            except OSError as e:
+                if os.path.exists(dst):
+                    os.remove(dst)
+                if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS):
+                    self.reflink_supported = False
+        if allow_hardlink:
+            try:
+                os.link(src, dst)
+                return 'hardlink'
+            except OSError:
+                pass
+        if not allow_copy:
+            return None
+        shutil.copy2(src, dst)
+        return 'copy'
+
+    def lookup(self, st):
+        """
+        :return: the hash of the file with stat result `st` if it is known and its object still exists, otherwise None
+        """
+        with self._lock:
+            entry = self._index.get(self._inode_key(st))
+        if entry is None or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+            return None
+        if not os.path.exists(self.object_path(entry['hash'])):
+            return None
+        return entry['hash']
+
+    def remember(self, st, content_hash):
+        with self._lock:
+            self._index[self._inode_key(st)] = {
+                'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': content_hash
+            }
+
+    def add_pending(self, path):
+        """
+        Bring a file into the store without reading it.
+        :return: the name of the pending file
+        """
+        pending_name = uuid.uuid4().hex
+        self.place(path, self.pending_path(pending_name))
+        return pending_name
+
+    def hash_pending(self, pending_name):
+        """
+        Hash a pending file and turn it into an object, or drop it if the object already exists.
+        :return: the hash
+        """
+        pending_path = self.pending_path(pending_name)
+        content_hash = hash_file(pending_path)
+        object_path = self.object_path(content_hash)
+        if os.path.exists(object_path):
+            os.remove(pending_path)
+        else:
+            os.replace(pending_path, object_path)
+        self.remember(os.stat(object_path), content_hash)
+        return content_hash
+
+    def _object_intact(self, content_hash):
+        """
+        An object linked into a work dir may have been modified in place, in which case its size or mtime no longer
+        match the index.
+        """
+        try:
+            st = os.stat(self.object_path(content_hash))
+        except FileNotFoundError:
+            return False
+        return self.lookup(st) == content_hash
+
+    def ingest(self, path, dest):
+        """
+        Bring a file (e.g. an upload) into the store and reflink its object to `dest`, so that identical files are
+        stored once whatever the number of sessions using them. The file is hashed while it is copied into the store,
+        or read once if it could be linked there. `dest` is a reference to the object as long as it is not modified.
+        Without reflinks the store cannot deduplicate `dest`, which is then copied from `path` directly.
+        :return: the hash, None if `dest` is a plain copy
+        """
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if not self.reflink_supported:
+            shutil.copy(path, dest)
+            return None
+
+        temp_path = self.pending_path(uuid.uuid4().hex)
+        method = self.place(path, temp_path, allow_copy=False)
+        if not self.reflink_supported:
+            # found out by this first attempt
+            if method:
+                os.remove(temp_path)
+            shutil.copy(path, dest)
+            return None
+        if method:
+            content_hash = hash_file(temp_path)
+        else:
+            content_hash = copy_and_hash(path, temp_path)
+
+        object_path = self.object_path(content_hash)
+        if self._object_intact(content_hash):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, object_path)
+            self.remember(os.stat(object_path), content_hash)
+
+        # never a hardlink: code may modify the file in place, which must not alter the object shared by other sessions
+        if self.place(object_path, dest, allow_hardlink=False) == 'reflink':
+            with self._lock:
+                self._references[os.path.abspath(dest)] = content_hash
+        self.remember(os.stat(dest), content_hash)
+        return content_hash
+
+    def referenced_hashes(self):
+        """
+        Forget the references whose file was deleted or modified.
+        :return: the hashes of the objects still referenced
+        """
+        with self._lock:
+            references = list(self._references.items())
+        stale = []
+        for path, content_hash in references:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stale.append(path)
+                continue
+            if self.lookup(st) != content_hash:
+                stale.append(path)
+        with self._lock:
+            for path in stale:
+                self._references.pop(path, None)
+            return set(self._references.values())
+
+    def prune_index(self):
+        with self._lock:
+            self._index = {
+                key: entry for key, entry in self._index.items() if os.path.exists(self.object_path(entry['hash']))
+            }
+
+    def save_index(self):
+        with self._lock:
+            index = dict(self._index)
+            references = dict(self._references)
+        atomic_write_json(self.index_path, index)
+        atomic_write_json(self.references_path, references)
+
+
+class SnapshotEngine:
+    """
+    Snapshots of session work dirs, recorded as manifests in `snapshots/` that refer to the objects of a shared
+    content store. Taking a snapshot only costs metadata operations per file, the files are hashed and deduplicated
+    afterwards in a background thread, which then applies the retention policy and deletes unreferenced objects.
+    """
+
+    def __init__(self, root='cache', max_count=5, max_age_days=None, max_bytes=None):
+        self.store = ContentStore(os.path.join(root, 'blobs'))
+        self.snapshots_dir = os.path.join(root, 'snapshots')
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        self.max_count = max_count
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._hash_loop, name='snapshot-hashing', daemon=True)
+        self._thread.start()
+
+        # resume the hashing interrupted by a previous shutdown
+        for manifest_path, manifest in self._list_manifests():
+            if any(entry['hash'] is None for entry in manifest['files']):
+                self._queue.put(manifest_path)
+
+    def _list_manifests(self):
+        manifests = []
+        for filename in os.listdir(self.snapshots_dir):
+            if not filename.endswith('.json'):
+                continue
+            manifest_path = os.path.join(self.snapshots_dir, filename)
+            try:
+                with open(manifest_path, encoding='utf-8') as f:
+                    manifests.append((manifest_path, json.load(f)))
+            except (OSError, ValueError):
+                continue
+        manifests.sort(key=lambda item: item[1]['created'])
+        return manifests
+
+    def take(self, work_dir, session_id):
+        """
+        Record a snapshot of `work_dir`.
+        :return: the path of the manifest
+        """
+        files, dirs, symlinks = [], [], []
+        with self._lock:
+            for dir_path, dir_names, file_names in os.walk(work_dir):
+                relative_dir = os.path.relpath(dir_path, work_dir)
+                for name in dir_names + file_names:
+                    path = os.path.join(dir_path, name)
+                    relative_path = os.path.normpath(os.path.join(relative_dir, name))
+                    st = os.lstat(path)
+                    if os.path.islink(path):
+                        symlinks.append({'path': relative_path, 'target': os.readlink(path)})
+                    elif name in dir_names:
+                        dirs.append(relative_path)
+                    elif os.path.isfile(path):
+                        content_hash = self.store.lookup(st)
+                        files.append({
+                            'path': relative_path,
+                            'size': st.st_size,
+                            'mode': st.st_mode & 0o777,
+                            'mtime_ns': st.st_mtime_ns,
+                            'hash': content_hash,
+                            'pending': None if content_hash else self.store.add_pending(path),
+                        })
+
+            created = time.time()
+            manifest_path = os.path.join(
+                self.snapshots_dir, f'{session_id}_{int(created * 1000)}_{uuid.uuid4().hex[:8]}.json'
+            )
+            atomic_write_json(manifest_path, {
+                'session': str(session_id), 'created': created, 'work_dir': os.path.abspath(work_dir),
+                'files': files, 'dirs': dirs, 'symlinks': symlinks
+            })
+        self._queue.put(manifest_path)
+        return manifest_path
+
+    def _hash_loop(self):
+        while True:
+            manifest_path = self._queue.get()
+            try:
+                self._hash_manifest(manifest_path)
+                self.apply_retention()
+                self.collect_garbage()
+            except Exception as e:
+                print(f'Snapshot maintenance failed for {manifest_path}: {e}')
+            finally:
+                self._queue.task_done()
+
+    def _hash_manifest(self, manifest_path):
+        with self._lock:
+            if not os.path.exists(manifest_path):
+                return
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        pending_entries = [entry for entry in manifest['files'] if entry['hash'] is None]
+        hashes = {entry['pending']: self.store.hash_pending(entry['pending']) for entry in pending_entries}
+        with self._lock:
+            if not os.path.exists(manifest_path):
+                return
+            for entry in pending_entries:
+                entry['hash'], entry['pending'] = hashes[entry['pending']], None
+            atomic_write_json(manifest_path, manifest)
+
+    def apply_retention(self):
+        """
+        Delete the snapshots beyond `max_count` per session, older than `max_age_days`, and the oldest ones while all
+        snapshots together refer to more than `max_bytes` of distinct content.
+        """
+        with self._lock:
+            manifests = self._list_manifests()
+            expired = set()
+
+            if self.max_count is not None:
+                per_session = {}
+                for manifest_path, manifest in reversed(manifests):
+                    per_session[manifest['session']] = per_session.get(manifest['session'], 0) + 1
+                    if per_session[manifest['session']] > self.max_count:
+                        expired.add(manifest_path)
+
+            if self.max_age_days is not None:
+                oldest_allowed = time.time() - self.max_age_days * 86400
+                expired.update(path for path, manifest in manifests if manifest['created'] < oldest_allowed)
+
+            if self.max_bytes is not None:
+                kept = [(path, manifest) for path, manifest in manifests if path not in expired]
+                while kept and self._distinct_bytes(manifest for _, manifest in kept) > self.max_bytes:
+                    expired.add(kept.pop(0)[0])
+
+            for manifest_path in expired:
+                os.remove(manifest_path)
+
+    @staticmethod
+    def _distinct_bytes(manifests):
+        sizes = {}
+        for manifest in manifests:
+            for entry in manifest['files']:
+                sizes[entry['hash'] or entry['pending']] = entry['size']
+        return sum(sizes.values())
+
+    def collect_garbage(self):
+        """
+        Delete the objects that no snapshot or upload refers to and that are not linked anywhere else (nlink == 1),
+        except those brought in during the last GC_GRACE_PERIOD seconds that may be about to be linked.
+        """
+        with self._lock:
+            referenced_hashes, referenced_pending = self.store.referenced_hashes(), set()
+            for _, manifest in self._list_manifests():
+                for entry in manifest['files']:
+                    referenced_hashes.add(entry['hash'])
+                    referenced_pending.add(entry['pending'])
+
+            for directory, referenced in (
+                    (self.store.objects_dir, referenced_hashes), (self.store.pending_dir, referenced_pending)
+            ):
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    st = os.stat(path)
+                    if name in referenced or st.st_nlink > 1 or time.time() - st.st_ctime < GC_GRACE_PERIOD:
+                        continue
+                    os.remove(path)
+
+            self.store.prune_index()
+            self.store.save_index()
+
+    def restore(self, manifest_path, dest_dir):
+        """
+        Recreate the files of a snapshot in `dest_dir`. Files are reflinked or copied, never hardlinked, so that
+        modifying them does not alter the snapshot.
+        """
+        with self._lock:
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            os.makedirs(dest_dir, exist_ok=True)
+            for relative_path in manifest['dirs']:
+                os.makedirs(os.path.join(dest_dir, relative_path), exist_ok=True)
+            for entry in manifest['files']:
+                if entry['hash'] is not None:
+                    src = self.store.object_path(entry['hash'])
+                else:
+                    src = self.store.pending_path(entry['pending'])
+                dst = os.path.join(dest_dir, entry['path'])
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                self.store.place(src, dst, allow_hardlink=False)
+                os.chmod(dst, entry['mode'])
+                os.utime(dst, ns=(entry['mtime_ns'], entry['mtime_ns']))
+            for entry in manifest['symlinks']:
+                os.symlink(entry['target'], os.path.join(dest_dir, entry['path']))
+
+    def wait(self):
+        """
+        Block until the pending hashing work has been done, for tools and tests.
+        """
+        while self._queue.unfinished_tasks:
+            time.sleep(0.05)
+
+
+_snapshot_engine = None
+_snapshot_engine_lock = threading.Lock()
+
+
+def get_snapshot_engine(snapshot_config=None):
+    """
+    Return the process-wide snapshot engine, creating it from the "snapshots" config on first use.
+    """
+    global _snapshot_engine
+    with _snapshot_engine_lock:
+        if _snapshot_engine is None:
+            snapshot_config = snapshot_config or {}
+            max_gb = snapshot_config.get('max_gb')
+            _snapshot_engine = SnapshotEngine(
+                root='cache',
+                max_count=snapshot_config.get('max_count', 5),
+                max_age_days=snapshot_config.get('max_age_days'),
+                max_bytes=int(max_gb * 1024 ** 3) if max_gb is not None else None
+            )
+        return _snapshot_engine
+
+
+def get_content_store(snapshot_config=None):
+    """
+    Return the content store shared by snapshots and uploads.
+    """
+    return get_snapshot_engine(snapshot_config).store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List or restore work dir snapshots (run from the `src` directory)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='list the snapshots')
+    restore_parser = subparsers.add_parser('restore', help='restore a snapshot into a directory')
+    restore_parser.add_argument('manifest', help='path of the snapshot manifest')
+    restore_parser.add_argument('dest', help='directory to restore the files into')
+    args = parser.parse_args()
+
+    engine = SnapshotEngine(root='cache', max_count=None)
+    if args.command == 'list':
+        for path, snapshot in engine._list_manifests():
+            size = sum(entry['size'] for entry in snapshot['files'])
+            created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['created']))
+            print(f'{path}  {created}  {len(snapshot["files"])} files  {size} bytes')
+    else:
+        engine.restore(args.manifest, args.dest)
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import argparse
+import threading
+
+
+class ToolLogWriter:
+    """
+    Background thread that appends the lines of all tool logs to their files, and rotates them when asked to.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def put(self, log_path, lines, rotate=False, backup_count=0):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_loop, name='tool-log-writer', daemon=True)
+                self._thread.start()
+        self._queue.put((log_path, lines, rotate, backup_count))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                log_path, lines, rotate, backup_count = item
+                if rotate:
+                    self._rotate(log_path, backup_count)
+                with open(log_path, 'a', encoding='utf-8') as log_file:
+                    log_file.writelines(lines)
+            except Exception as e:
+                print(f'Failed to write tool log: {e}')
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _rotate(log_path, backup_count):
+        if not os.path.exists(log_path) or os.path.getsize(log_path) == 0:
+            return
+        if backup_count <= 0:
+            os.remove(log_path)
+            return
+        for index in range(backup_count - 1, 0, -1):
+            if os.path.exists(f'{log_path}.{index}'):
+                os.replace(f'{log_path}.{index}', f'{log_path}.{index + 1}')
+        os.replace(log_path, f'{log_path}.1')
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+
+
+tool_log_writer = ToolLogWriter()
+
+
+class ToolEventLog:
+    """
+    JSONL log of the tool calls of a session. Each "tool_call" event only records the messages added to the
+    conversation since the previous event (and how many messages were removed, e.g. by a revoked upload), along with
+    the tool name, arguments, response and timings. Lines are written by the background writer.
+    When the file would exceed `max_bytes` it is rotated, keeping `backup_count` old files, and the new file starts with
+    a "snapshot" event of the whole conversation, so that any file can be read on its own.
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 ** 2, backup_count=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.seq = 0
+        self._logged_messages = []  # conversation as of the last event
+        # the first event rotates any file left at `path`, so the log of this instance starts with a snapshot
+        self._file_size = 0
+
+    def _event_line(self, event, fields_json):
+        self.seq += 1
+        # the fields are serialized beforehand (their size decides the rotation), they are spliced after the header
+        header = json.dumps({'seq': self.seq, 'time': time.time(), 'event': event})
+        return f'{header[:-1]}, {fields_json[1:]}\n' if fields_json != '{}' else f'{header}\n'
+
+    def record_tool_call(self, conversation, tool_name, arguments, response, model_choice=None, timings=None):
+        # length of the part of the conversation that has not changed since the last event
+        kept = min(len(self._logged_messages), len(conversation))
+        while kept and self._logged_messages[kept - 1] is not conversation[kept - 1]:
+            kept -= 1
+        fields = {}
+        if kept < len(self._logged_messages):
+            fields['truncate_to'] = kept
+        fields.update(
+            messages=conversation[kept:], model_choice=model_choice, tool=tool_name, arguments=arguments,
+            response=response, timings=timings or {}
+        )
+        fields_json = json.dumps(fields, ensure_ascii=False)
+
+        # a new file starts with a snapshot of the conversation before this event
+        rotate = self._file_size == 0 or self._file_size + len(fields_json.encode('utf-8')) > self.max_bytes
+        lines = []
+        if rotate:
+            self._file_size = 0
+            snapshot_json = json.dumps({'messages': self._logged_messages}, ensure_ascii=False)
+            lines.append(self._event_line('snapshot', snapshot_json))
+        lines.append(self._event_line('tool_call', fields_json))
+        self._file_size += sum(len(line.encode('utf-8')) for line in lines)
+
+        tool_log_writer.put(self.path, lines, rotate=rotate, backup_count=self.backup_count)
+        self._logged_messages = list(conversation)
+
+
+def read_events(path):
+    """
+    Yield the events of a tool log, oldest first, including its rotated files.
+    """
+    paths = []
+    index = 1
+    while os.path.exists(f'{path}.{index}'):
+        paths.insert(0, f'{path}.{index}')
+        index += 1
+    if os.path.exists(path):
+        paths.append(path)
+    for log_path in paths:
+        with open(log_path, encoding='utf-8') as log_file:
+            for line in log_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def rebuild_conversation(path, seq=None):
+    """
+    :return: the conversation as it was right after the event `seq` (the last event by default)
+    """
+    conversation = []
+    for event in read_events(path):
+        if seq is not None and event['seq'] > seq:
+            break
+        if event['event'] == 'snapshot':
+            conversation = list(event['messages'])
+        else:
+            conversation = conversation[:event.get('truncate_to', len(conversation))] + event['messages']
+    return conversation
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the conversation of a session from its tool log')
+    parser.add_argument('path', help='path of the tool log, e.g. cache/tool_<id>_<suffix>.jsonl')
+    parser.add_argument('--seq', type=int, default=None, help='rebuild the conversation at this event')
+    args = parser.parse_args()
+    json.dump(rebuild_conversation(args.path, args.seq), sys.stdout, ensure_ascii=False, indent=2)
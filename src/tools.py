@@ -2,6 +2,8 @@ import base64
 import os
 import io
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from abc import ABCMeta, abstractmethod
 
@@ -212,3 +214,21 @@ def get_available_tools(client, config):
         if tool_instance.support():
             available_tools.append(tool_instance.get_tool_data())
     return available_tools
+
+
+# threads running the calls of additional tools, the calls requested together by a response run concurrently
+TOOL_WORKERS = 8
+
+_tool_executor = None
+_tool_executor_lock = threading.Lock()
+
+
+def get_tool_executor():
+    """
+    Return the process-wide pool of threads running additional tools, creating it on first use.
+    """
+    global _tool_executor
+    with _tool_executor_lock:
+        if _tool_executor is None:
+            _tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix='tool')
+        return _tool_executor
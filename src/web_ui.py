@@ -1,18 +1,87 @@
 import openai
+import asyncio
 import gradio as gr
+from concurrent.futures import ThreadPoolExecutor
 from response_parser import *
+from metrics import start_metrics_server
+from execution_scheduler import get_execution_scheduler
+from session_workers import RemoteBotBackend, get_session_worker_pool
+
+# maximum number of chatbot updates per second while a response is streamed
+UI_MAX_FPS = config.get('ui_max_fps', 15)
+# number of queued events (e.g. responses) processed at the same time
+QUEUE_CONCURRENCY = config.get('queue', {}).get('concurrency_count', 64)
+# threads running the steps of the responses, a response runs one step at a time and none while its code executes
+response_step_executor = ThreadPoolExecutor(max_workers=QUEUE_CONCURRENCY, thread_name_prefix='response-step')
+# number of worker processes the sessions are spread over, 0 to keep them in this process (see session_workers.py)
+BACKEND_WORKERS = config.get('backend_workers', 0)
+
+
+class FrameRenderer:
+    """
+    Coalesces the updates of a streamed response into frames, pushed to the browser at most `max_fps` times per
+    second. A frame that changes a button, or is forced (e.g. at the end of a phase), is pushed immediately.
+    Only the button properties that changed since the last frame are sent.
+    """
+
+    def __init__(self, max_fps):
+        self.frame_interval = 1 / max_fps if max_fps else 0
+        self.last_frame_time = 0.0
+        self.pending = False
+        self.frame_count = 0
+        self.coalesced_count = 0
+        self.button_states = [{}, {}]  # stop generation button, retry button
+
+    def _button_changes(self, index, button_update):
+        state = self.button_states[index]
+        return {
+            key: value for key, value in (button_update or {}).items() if key not in state or state[key] != value
+        }
+
+    def render(self, history: List, stop_button: Dict = None, retry_button: Dict = None, force: bool = False):
+        """
+        Generator, yields the outputs of `bot` if the frame is due, otherwise the frame stays pending.
+        """
+        stop_button_changes = self._button_changes(0, stop_button)
+        retry_button_changes = self._button_changes(1, retry_button)
+        self.pending = True
+        if (force or stop_button_changes or retry_button_changes
+                or time.time() - self.last_frame_time >= self.frame_interval):
+            yield from self._push(history, stop_button_changes, retry_button_changes)
+        else:
+            self.coalesced_count += 1
+
+    def flush(self, history: List):
+        """
+        Generator, pushes the pending frame, if any.
+        """
+        if self.pending:
+            yield from self._push(history, {}, {})
+
+    def _push(self, history, stop_button_changes, retry_button_changes):
+        self.pending = False
+        self.frame_count += 1
+        self.last_frame_time = time.time()
+        outputs = [history]
+        for index, changes in enumerate((stop_button_changes, retry_button_changes)):
+            self.button_states[index].update(changes)
+            outputs.append(gr.Button.update(**changes) if changes else gr.update())
+        yield tuple(outputs)
 
 
 def initialization(state_dict: Dict) -> None:
     if not os.path.exists('cache'):
         os.mkdir('cache')
     if state_dict["bot_backend"] is None:
-        state_dict["bot_backend"] = BotBackend()
+        if BACKEND_WORKERS:
+            state_dict["bot_backend"] = RemoteBotBackend(get_session_worker_pool(BACKEND_WORKERS))
+        else:
+            state_dict["bot_backend"] = BotBackend()
         if 'OPENAI_API_KEY' in os.environ:
             del os.environ['OPENAI_API_KEY']
 
 
-def get_bot_backend(state_dict: Dict) -> BotBackend:
+def get_bot_backend(state_dict: Dict) -> Union[BotBackend, RemoteBotBackend]:
     return state_dict["bot_backend"]
 
 
@@ -115,71 +184,113 @@ def restart_bot_backend(state_dict: Dict) -> None:
 
 def stop_generating(state_dict: Dict) -> None:
     bot_backend = get_bot_backend(state_dict)
-    if bot_backend.code_executing:
-        bot_backend.send_interrupt_signal()
-    else:
-        bot_backend.update_stop_generating_state(stop_generating=True)
-
-
-def bot(state_dict: Dict, history: List) -> List:
+    bot_backend.stop_response()
+
+
+def record_turn_metrics(
+        bot_backend: Union[BotBackend, RemoteBotBackend], renderer: FrameRenderer, start_time: float
+) -> None:
+    bot_backend.metrics.observe('lci_turn_seconds', time.time() - start_time)
+    bot_backend.metrics.observe('lci_ui_frames_per_turn', renderer.frame_count)
+    bot_backend.metrics.observe('lci_ui_coalesced_updates_per_turn', renderer.coalesced_count)
+
+
+async def local_response_steps(bot_backend: BotBackend, history: List):
+    """
+    Async generator, yields history, event, response state while the response is computed in this process. A response
+    holds no thread while it waits: its steps run in `response_step_executor`, and the kernel executing its code is
+    waited for on the event loop. Code executions take turns for the cores through the fair execution scheduler.
+    """
+    bot_backend.cooperative_kernel_wait = True
+    scheduler = get_execution_scheduler(config.get('queue'))
+    loop = asyncio.get_running_loop()
+    responses = stream_bot_response(bot_backend=bot_backend, history=history)
+    slot_granted_at = None
+    try:
+        while True:
+            step = await loop.run_in_executor(response_step_executor, next, responses, None)
+            if step is None:
+                break
+            history, event = step
+            if bot_backend.jupyter_kernel.wait_timeout is not None:
+                await bot_backend.jupyter_kernel.wait_for_output()
+                continue
+            response_state = get_response_state(bot_backend)
+            yield history, event, response_state
+            if event == 'function_call' and response_state['executes_code']:
+                slot_granted_at = await scheduler.acquire(bot_backend.unique_id)
+            elif event == 'end_of_response' and slot_granted_at is not None:
+                scheduler.release(bot_backend.unique_id, slot_granted_at)
+                slot_granted_at = None
+    finally:
+        if slot_granted_at is not None:
+            scheduler.release(bot_backend.unique_id, slot_granted_at)
+
+
+async def bot(state_dict: Dict, history: List) -> List:
     bot_backend = get_bot_backend(state_dict)
-
-    while bot_backend.finish_reason in ('new_input', 'tool_calls'):
-        if history[-1][1]:
-            history.append([None, ""])
-        else:
-            history[-1][1] = ""
-
-        try:
-            response = chat_completion(bot_backend=bot_backend)
-            for chunk in response:
-                if chunk.choices and chunk.choices[0].finish_reason == 'tool_calls':
-                    if bot_backend.function_name in bot_backend.jupyter_kernel.available_functions:
-                        yield history, gr.Button.update(value='⏹️ Interrupt execution'), gr.Button.update(visible=False)
-                    else:
-                        yield history, gr.Button.update(interactive=False), gr.Button.update(visible=False)
-
-                if bot_backend.stop_generating:
-                    response.close()
-                    if bot_backend.content:
-                        bot_backend.add_gpt_response_content_message()
-                    if bot_backend.display_code_block:
-                        bot_backend.update_display_code_block(
-                            display_code_block="\n⚫Stopped:\n```python\n{}\n```".format(bot_backend.code_str)
-                        )
-                        history = copy.deepcopy(bot_backend.bot_history)
-                        history[-1][1] += bot_backend.display_code_block
-                        bot_backend.add_function_call_response_message(function_response=None)
-
-                    bot_backend.reset_gpt_response_log_values()
-                    break
-
-                history, whether_exit = parse_response(
-                    chunk=chunk,
-                    history=history,
-                    bot_backend=bot_backend
-                )
-
-                yield (
+    renderer = FrameRenderer(max_fps=UI_MAX_FPS)
+    start_time = time.time()
+    if isinstance(bot_backend, RemoteBotBackend):
+        steps = bot_backend.response_steps(history)
+    else:
+        steps = local_response_steps(bot_backend, history)
+
+    try:
+        async for history, event, response_state in steps:
+            # streamed updates are coalesced, the others (e.g. code execution output) are pushed immediately
+            if event == 'function_call':
+                if response_state['executes_code']:
+                    stop_button = {'value': '⏹️ Interrupt execution'}
+                else:
+                    stop_button = {'interactive': False}
+                for outputs in renderer.render(
+                    history, stop_button=stop_button, retry_button={'visible': False}, force=True
+                ):
+                    yield outputs
+            elif event == 'end_of_response':
+                for outputs in renderer.flush(history):
+                    yield outputs
+            else:
+                for outputs in renderer.render(
                     history,
-                    gr.Button.update(
-                        interactive=False if bot_backend.stop_generating else True,
-                        value='⏹️ Stop generating'
-                    ),
-                    gr.Button.update(visible=False)
-                )
-                if whether_exit:
+                    stop_button={
+                        'interactive': not response_state['stopping'],
+                        'value': '⏹️ Interrupt execution' if response_state['code_executing'] else '⏹️ Stop generating'
+                    },
+                    retry_button={'visible': False},
+                    force=event != 'delta'
+                ):
+                    yield outputs
+                if event == 'exit':
                     exit(-1)
-        except openai.OpenAIError as openai_error:
-            bot_backend.reset_gpt_response_log_values(exclude=['finish_reason'])
-            yield history, gr.Button.update(interactive=False), gr.Button.update(visible=True)
-            raise openai_error
-
-    yield history, gr.Button.update(interactive=False, value='⏹️ Stop generating'), gr.Button.update(visible=False)
+    except openai.OpenAIError as openai_error:
+        for outputs in renderer.render(
+            history, stop_button={'interactive': False}, retry_button={'visible': True}, force=True
+        ):
+            yield outputs
+        record_turn_metrics(bot_backend, renderer, start_time)
+        raise openai_error
+
+    for outputs in renderer.render(
+        history,
+        stop_button={'interactive': False, 'value': '⏹️ Stop generating'},
+        retry_button={'visible': False},
+        force=True
+    ):
+        yield outputs
+    record_turn_metrics(bot_backend, renderer, start_time)
 
 
 if __name__ == '__main__':
     config = get_config()
+    if BACKEND_WORKERS:
+        get_session_worker_pool(BACKEND_WORKERS)
+    else:
+        # start filling the kernel pool before the first session needs a kernel
+        get_kernel_pool(config.get('kernel_pool'))
+    if config.get('metrics_port'):
+        start_metrics_server(config['metrics_port'])
     with gr.Blocks(theme=gr.themes.Base()) as block:
         """
         Reference: https://www.gradio.app/guides/creating-a-chatbot-fast
@@ -277,5 +388,6 @@ if __name__ == '__main__':
 
         block.load(fn=initialization, inputs=[state])
 
-    block.queue()
+    queue_config = config.get('queue', {})
+    block.queue(concurrency_count=QUEUE_CONCURRENCY, max_size=queue_config.get('max_size'))
     block.launch(inbrowser=True)
@@ -0,0 +1,32 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from session_workers import HistoryDelta, apply_history_delta
+
+
+def test_history_delta_appended_message():
+    history = [['hi', 'hello']]
+    remote_history = [list(message) for message in history]
+    history_delta = HistoryDelta(history)
+
+    history.append([None, 'more'])
+    apply_history_delta(remote_history, history_delta.diff(history))
+    assert remote_history == history
+
+
+def test_history_delta_earlier_message_changed_in_place():
+    history = [['run two cells', None], [None, '🔴Working: a'], [None, '🔴Working: b']]
+    remote_history = [list(message) for message in history]
+    history_delta = HistoryDelta(history)
+
+    history[1][1] = '🟢Finished: a'
+    history.append([None, 'output of a'])
+    start, messages = history_delta.diff(history)
+    assert start == 1
+    apply_history_delta(remote_history, (start, messages))
+    assert remote_history == history
+
+    # nothing changed since the last update
+    assert history_delta.diff(history) == (len(history), [])